@@ -1,8 +1,12 @@
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template, g
+import click
 from dataclasses import dataclass, field
-from datetime import datetime
-import os, random, re, unicodedata, json, sqlite3
-from typing import Dict, List, Optional, Tuple, Any
+from datetime import datetime, timedelta, timezone
+import os, sys, random, re, unicodedata, json, sqlite3, threading, queue, time, atexit, copy, html, bisect, zlib, multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Any
 
 app = Flask(__name__)
 
@@ -12,24 +16,540 @@ app = Flask(__name__)
 PLATFORMS = ["whatsapp", "instagram", "facebook"]
 AUTO_USER = "Atención"
 MSG_CAP = 400  # limite de caracteres 
+MSG_PAGE_SIZE = 100  # default page for /api/messages (?limit= up to MSG_CAP)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "oneinbox.db")
+DB_PATH = os.environ.get("ONEINBOX_DB") or os.path.join(BASE_DIR, "oneinbox.db")
 SCHEMA_PATH = os.path.join(BASE_DIR, "oneinbox_schema.sql")
+# Schema migrations (MIGRATIONS, PRAGMA user_version) run under a file lock by
+# `flask migrate`, or by the first process that finds the DB behind when this is
+# "auto"; with "check", a process whose DB is behind refuses to start instead.
+MIGRATE_MODE = os.environ.get("ONEINBOX_MIGRATE", "auto")
+
+# automation_events group-commit writer
+EVENT_ASYNC = True          # False: write events inline, inside the request transaction
+EVENT_QUEUE_MAX = 10000     # bounded queue; producers wait EVENT_PUT_TIMEOUT_S, then drop
+EVENT_PUT_TIMEOUT_S = 0.05
+EVENT_BATCH_SIZE = 256      # flush when this many events are pending...
+EVENT_FLUSH_MS = 200        # ...or when the oldest pending event is this old
+EVENT_LATE_MS = 5000        # events committed later than this count as "late"
+
+# /api/stream (Server-Sent Events)
+SSE_CLIENT_BUFFER = 500     # per-client queue; on overflow the client is told to resync
+SSE_HEARTBEAT_S = 15.0      # keep-alive comment + DB catch-up check when idle
+SSE_RETRY_MS = 3000         # reconnect delay suggested to EventSource
+
+# Rule-engine state per thread (write-through cache over threads.state_json)
+STATE_CACHE_MAX = 10000     # LRU entries kept in memory
+STATE_LOCK_STRIPES = 1024   # per-thread locks (striped by thread id)
+
+IDENTITY_CACHE_MAX = 50000  # (platform, user) -> (customer_id, thread_id, ext_id) LRU entries
+INBOUND_KEY_CACHE_MAX = 20000  # (platform, external_message_id) -> stored (inbound, reply) LRU entries
+INBOUND_KEY_MAX_LEN = 200      # longer platform message ids / idempotency keys are rejected
+
+# Bulk ingestion (/api/send_batch, `flask import-jsonl`)
+BATCH_CHUNK = 5000          # items per transaction
+BATCH_MAX_ERRORS = 100      # rejected items reported individually (the count is always exact)
+
+SEARCH_PAGE_SIZE = 20       # /api/search default page (?limit= up to SEARCH_PAGE_MAX)
+SEARCH_PAGE_MAX = 100
+
+# Queued ingestion: /api/webhook (and /api/send with ONEINBOX_INGEST=queue) stores the
+# inbound message plus a reply_jobs row and acks; worker threads run the bot later.
+INGEST_MODE = os.environ.get("ONEINBOX_INGEST", "sync")
+REPLY_WORKERS = int(os.environ.get("ONEINBOX_REPLY_WORKERS", "4"))  # threads per process (0: none)
+JOB_POLL_S = 1.0             # idle workers re-check the table (jobs enqueued by other processes)
+JOB_MAX_ATTEMPTS = 5         # then the job is marked 'failed'
+JOB_RETRY_BASE_S = 1.0       # retry backoff: base * 2**(attempt - 1)
+JOB_LEASE_S = 60.0           # 'running' jobs older than this (crashed worker) are requeued
+
+# Retention: messages/events older than RETENTION_DAYS move to monthly archive DB files
+RETENTION_DAYS = int(os.environ.get("ONEINBOX_RETENTION_DAYS", "0"))  # 0: keep everything (archive by hand)
+ARCHIVE_DIR = os.environ.get("ONEINBOX_ARCHIVE_DIR") or os.path.join(BASE_DIR, "archive")
+ARCHIVE_CHUNK = 2000         # rows moved per transaction
+RETENTION_EVERY_S = 3600.0   # background retention pass (when RETENTION_DAYS > 0)
+VACUUM_STEP_PAGES = 2000     # pages released per incremental_vacuum transaction
+
+# Latency histograms (/api/metrics): pipeline stages and SQL calls on the hot path
+METRICS_ENABLED = True
+LATENCY_BUCKETS_S = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+STATS_REFRESH_S = 5.0       # /api/stats re-reads metrics_daily sums (other workers' writes) at most this often
+ROLLUP_CHUNK = 5000          # rows folded per rollup transaction (event counts, metrics backfill)
+ROLLUP_EVERY_S = 60.0        # background rollup pass (run by the storage maintenance thread)...
+ROLLUP_PASS_CHUNKS = 200     # ...folding at most this many chunks per job (`flask rollup` has no cap)
+ANALYTICS_DEFAULT_DAYS = 30  # /api/analytics window without ?from=
+RECLASSIFY_CHUNK = 5000      # messages per reclassification task / UPDATE transaction
+EXPORT_CHUNK = 2000          # rows per export query (short read transactions, flat memory)
+EXPORT_THREAD_CACHE = 10000  # thread ids already exported (bounded: a thread may repeat after eviction)
+
+RULES_RELOAD_S = 5.0        # how often the matcher checks the rules table version
+CATALOG_RELOAD_S = 5.0      # how often the catalog index checks the products table version
+
+# Storage profile: PRAGMAs applied to every connection (journal_mode once, at startup).
+# Pick with ONEINBOX_STORAGE; "legacy" is SQLite's defaults (rollback journal).
+STORAGE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "wal": {
+        "journal_mode": "WAL",          # readers don't block the writer (nor each other)
+        "synchronous": "NORMAL",        # durable at checkpoints; safe against corruption in WAL
+        "cache_size": -16000,           # KiB of page cache per connection
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,           # ms to wait on another process's write lock
+    },
+    "legacy": {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": 5000},
+}
+STORAGE_PROFILE = os.environ.get("ONEINBOX_STORAGE", "wal")
+READ_POOL_SIZE = 8           # idle read-only connections kept per process (GET routes)
+MAINT_CHECKPOINT_S = 30.0    # background PASSIVE wal_checkpoint this often
+MAINT_OPTIMIZE_S = 3600.0    # ...and PRAGMA optimize this often
+WAL_TRUNCATE_BYTES = 64 * 1024 * 1024  # TRUNCATE checkpoint when the -wal file grows past this
+
+# Sharded storage: threads (with their messages, events, state and reply jobs)
+# are partitioned across SHARDS database files by a hash of external_thread_id.
+# Shard 0 is DB_PATH and also holds rules and products. Set it on a fresh DB.
+SHARDS = max(1, int(os.environ.get("ONEINBOX_SHARDS", "1")))
+SHARD_ID_TICKS_PER_MS = 1024  # sharded message ids start at epoch_ms * this (time-ordered across files)
+SHARD_SETTLE_S = 2.0          # sharded /api/messages cursors stay this far behind the clock
 
 def _utc_iso() -> str:
     # ISO 8601 in UTC-like format; SQLite stores TEXT
     return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+def _utc_iso_ms(offset_s: float = 0.0) -> str:
+    # Same format as the schema defaults (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+    return (datetime.utcnow() + timedelta(seconds=offset_s)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def _age_s(iso_ms: str) -> float:
+    """Seconds since a _utc_iso_ms() / schema-default timestamp."""
+    return (datetime.utcnow() - datetime.strptime(iso_ms, "%Y-%m-%dT%H:%M:%S.%fZ")).total_seconds()
+
+def storage_profile() -> Dict[str, Any]:
+    try:
+        return STORAGE_PROFILES[STORAGE_PROFILE]
+    except KeyError:
+        raise RuntimeError(f"Unknown ONEINBOX_STORAGE profile: {STORAGE_PROFILE!r} (choose from {sorted(STORAGE_PROFILES)})")
+
+def shard_path(shard: int) -> str:
+    """Database file of a shard: DB_PATH, then oneinbox.shard1.db, ..."""
+    if shard == 0:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.shard{shard}{ext or '.db'}"
+
+def shard_for(external_thread_id: str) -> int:
+    """Shard that owns a thread (stable across processes: crc32, not hash())."""
+    return zlib.crc32(external_thread_id.encode("utf-8")) % SHARDS if SHARDS > 1 else 0
+
+def shard_of(row_id: int) -> int:
+    """Shard holding a thread or message id (sharded ids are = shard mod SHARDS)."""
+    return row_id % SHARDS
+
+class ShardConnection(sqlite3.Connection):
+    shard = 0
+
+def db(readonly: bool = False, shard: int = 0) -> sqlite3.Connection:
+    """New connection to a shard's file with the storage profile applied.
+    readonly: PRAGMA query_only, usable from any thread (pooled connections move
+    between request threads). The first one in a process checks the schema
+    version (ensure_schema)."""
+    ensure_schema()
+    return _connect(readonly, shard)
+
+def _connect(readonly: bool = False, shard: int = 0) -> sqlite3.Connection:
+    """db() without the schema check (migrations)."""
+    prof = storage_profile()
+    conn = sqlite3.connect(shard_path(shard), timeout=prof.get("busy_timeout", 5000) / 1000.0, check_same_thread=not readonly,
+                           factory=ShardConnection)
+    conn.shard = shard
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    for pragma in ("synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout"):
+        if pragma in prof:
+            conn.execute(f"PRAGMA {pragma} = {prof[pragma]}")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
     return conn
 
+class ReadPool:
+    """Per-process pool of read-only connections for GET routes.
+
+    acquire() reuses an idle connection or opens a new one (never blocks);
+    release() keeps up to `size` idle connections and closes the rest. A forked
+    worker starts with an empty pool instead of reusing its parent's handles."""
+
+    def __init__(self, size: int, shard: int = 0) -> None:
+        self.size = size
+        self.shard = shard
+        self._lock = threading.Lock()
+        self._idle: List[sqlite3.Connection] = []
+        self._pid = os.getpid()
+        self.counters = {"reused": 0, "opened": 0, "closed": 0}
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle, self._pid = [], os.getpid()
+            if self._idle:
+                self.counters["reused"] += 1
+                return self._idle.pop()
+            self.counters["opened"] += 1
+        return db(readonly=True, shard=self.shard)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+            self.counters["closed"] += 1
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters, idle=len(self._idle))
+
+READ_POOLS = [ReadPool(READ_POOL_SIZE, shard) for shard in range(SHARDS)]
+
+# In-process writers queue here instead of polling SQLite's busy handler for the
+# write lock; other processes still serialize on BEGIN IMMEDIATE + busy_timeout.
+# One per shard: writes to different files never wait for each other.
+WRITE_LOCKS = [threading.Lock() for _ in range(SHARDS)]
+
+def get_db(shard: int = 0) -> sqlite3.Connection:
+    """Request-scoped writer connection to a shard: opened on first use, closed on teardown."""
+    if "dbs" not in g:
+        g.dbs = {}
+        MAINTENANCE.ensure_started()
+        REPLY_QUEUE.ensure_started()  # also picks up jobs left by a previous run
+    if shard not in g.dbs:
+        g.dbs[shard] = db(shard=shard)
+    return g.dbs[shard]
+
+def get_read_db(shard: int = 0) -> sqlite3.Connection:
+    """Request-scoped read-only connection from the shard's READ_POOLS entry (GET routes)."""
+    if "read_dbs" not in g:
+        g.read_dbs = {}
+        MAINTENANCE.ensure_started()
+        REPLY_QUEUE.ensure_started()
+    if shard not in g.read_dbs:
+        g.read_dbs[shard] = READ_POOLS[shard].acquire()
+    return g.read_dbs[shard]
+
+def get_read_dbs() -> List[sqlite3.Connection]:
+    """One read-only connection per shard, for reads that fan out and merge."""
+    return [get_read_db(shard) for shard in range(SHARDS)]
+
+def thread_db(platform: str, user: str) -> sqlite3.Connection:
+    """Writer connection to the shard that owns (platform, user)'s thread."""
+    return get_db(shard_for(thread_external_id(platform, (user or "Usuario").strip() or "Usuario")))
+
+@app.teardown_appcontext
+def close_db(exc: Optional[BaseException]) -> None:
+    for conn in g.pop("dbs", {}).values():
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+    for shard, conn in g.pop("read_dbs", {}).items():
+        READ_POOLS[shard].release(conn)
+
+class UnitOfWork:
+    """One transaction over one connection.
+
+    Used as a context manager: BEGIN IMMEDIATE on enter, COMMIT on clean exit,
+    ROLLBACK if the block raises. Callbacks registered with on_commit() run
+    only after the COMMIT succeeded (side effects outside the DB); on_close()
+    callbacks always run last (e.g. releasing locks). The process-wide write
+    lock of the connection's shard is held from BEGIN to COMMIT/ROLLBACK."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.shard = getattr(conn, "shard", 0)
+        self._write_lock = WRITE_LOCKS[self.shard]
+        self._after_commit: List[Callable[[], None]] = []
+        self._on_close: List[Callable[[], None]] = []
+
+    def on_commit(self, fn: Callable[[], None]) -> None:
+        self._after_commit.append(fn)
+
+    def on_close(self, fn: Callable[[], None]) -> None:
+        self._on_close.append(fn)
+
+    def __enter__(self) -> "UnitOfWork":
+        with SQL_TIMES.time("begin"):  # includes waiting for the write lock
+            self._write_lock.acquire()
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+            except BaseException:
+                self._write_lock.release()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is not None:
+                try:
+                    self.conn.rollback()
+                finally:
+                    self._write_lock.release()
+                self._after_commit.clear()
+                return
+            try:
+                with SQL_TIMES.time("commit"):
+                    self.conn.commit()
+            except BaseException:
+                try:
+                    self.conn.rollback()
+                finally:
+                    self._write_lock.release()
+                raise
+            self._write_lock.release()
+            callbacks, self._after_commit = self._after_commit, []
+            for fn in callbacks:
+                fn()
+        finally:
+            closers, self._on_close = self._on_close, []
+            for fn in reversed(closers):
+                fn()
+
+# =========================
+# Instrumentation (/api/metrics)
+# =========================
+
+class _Span:
+    __slots__ = ("hist", "key", "t0")
+
+    def __init__(self, hist: "LatencyHistogram", key: str):
+        self.hist = hist
+        self.key = key
+
+    def __enter__(self) -> "_Span":
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.hist.observe(self.key, time.perf_counter() - self.t0)
+
+class _NoSpan:
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+_NO_SPAN = _NoSpan()
+
+class LatencyHistogram:
+    """Cumulative latency histogram (seconds) per value of one label, rendered
+    in the Prometheus text format. observe() is a bisect plus a few integer
+    adds under a lock, cheap enough to leave on. Counts are per process."""
+
+    def __init__(self, name: str, label: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS_S):
+        self.name = name
+        self.label = label
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: Dict[str, List[Any]] = {}  # key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, key: str, seconds: float) -> None:
+        if not METRICS_ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += seconds
+
+    def time(self, key: str) -> Any:
+        """Context manager that observes the elapsed time of its block."""
+        return _Span(self, key) if METRICS_ENABLED else _NO_SPAN
+
+    def since(self, key: str, t0: float) -> float:
+        """Observe perf_counter() - t0; returns the new perf_counter() for chaining stages."""
+        now = time.perf_counter()
+        self.observe(key, now - t0)
+        return now
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        out = {}
+        for k, s in sorted(series.items()):
+            n = sum(s[:-1])
+            out[k] = {"count": n, "avg_ms": round(s[-1] / n * 1000.0, 3) if n else 0.0}
+        return out
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, s in sorted(series.items()):
+            lbl = f'{self.label}="{key}"'
+            acc = 0
+            for le, n in zip(self.buckets, s):
+                acc += n
+                lines.append(f'{self.name}_bucket{{{lbl},le="{le:g}"}} {acc}')
+            acc += s[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{lbl},le="+Inf"}} {acc}')
+            lines.append(f"{self.name}_sum{{{lbl}}} {s[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{lbl}}} {acc}")
+        return lines
+
+STAGE_TIMES = LatencyHistogram(
+    "oneinbox_stage_seconds", "stage",
+    "Time per pipeline stage (identity, ingest, normalize, classify, respond, persist); classify is part of respond.",
+)
+SQL_TIMES = LatencyHistogram(
+    "oneinbox_sql_seconds", "op",
+    "Time per SQL call on the message hot path (begin includes waiting for the write lock).",
+)
+MESSAGE_TIMES = LatencyHistogram(
+    "oneinbox_message_seconds", "source",
+    "Inbound message to committed reply, per ingestion source.",
+)
+JOB_TIMES = LatencyHistogram(
+    "oneinbox_reply_job_seconds", "phase",
+    "Queued ingestion: ack (webhook request), wait (enqueue to claim), process (claim to committed reply).",
+)
+
+# =========================
+# Storage maintenance (WAL checkpoints, PRAGMA optimize)
+# =========================
+
+class StorageMaintenance:
+    """Background thread, one per process: a PASSIVE wal_checkpoint every
+    MAINT_CHECKPOINT_S (TRUNCATE once the -wal file passes WAL_TRUNCATE_BYTES)
+    and PRAGMA optimize every MAINT_OPTIMIZE_S and at exit; a bounded
+    run_rollup() every ROLLUP_EVERY_S; with RETENTION_DAYS set, also
+    run_retention() every RETENTION_EVERY_S. Started by the first request;
+    `flask db-maintenance` runs one full pass by hand."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._wake = threading.Event()
+        self.counters = {"checkpoints": 0, "truncates": 0, "optimizes": 0, "busy": 0, "errors": 0, "retention_runs": 0, "rollup_runs": 0}
+
+    def run_once(self, conn: sqlite3.Connection, optimize: bool = False, truncate: bool = False) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        if str(storage_profile().get("journal_mode", "")).upper() == "WAL":
+            wal = shard_path(getattr(conn, "shard", 0)) + "-wal"
+            wal_bytes = os.path.getsize(wal) if os.path.exists(wal) else 0
+            mode = "TRUNCATE" if truncate or wal_bytes > WAL_TRUNCATE_BYTES else "PASSIVE"
+            with SQL_TIMES.time("maint.checkpoint"):
+                busy, log_pages, done = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            self.counters["checkpoints"] += 1
+            self.counters["truncates"] += int(mode == "TRUNCATE")
+            self.counters["busy"] += int(busy)
+            out.update({"checkpoint": mode, "busy": busy, "wal_pages": log_pages, "checkpointed": done, "wal_bytes_before": wal_bytes})
+        if optimize:
+            with SQL_TIMES.time("maint.optimize"):
+                conn.execute("PRAGMA optimize")
+            self.counters["optimizes"] += 1
+            out["optimize"] = True
+        return out
+
+    def ensure_started(self) -> None:
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wake.clear()
+            self._thread = threading.Thread(target=self._run, name="storage-maintenance", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._wake.set()
+        for shard in range(SHARDS):
+            try:
+                conn = db(shard=shard)
+                try:
+                    self.run_once(conn, optimize=True)
+                finally:
+                    conn.close()
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters)
+
+    def _run(self) -> None:
+        conns = [db(shard=shard) for shard in range(SHARDS)]
+        last_optimize = last_retention = time.monotonic()
+        last_rollup = 0.0
+        try:
+            while not self._wake.wait(MAINT_CHECKPOINT_S):
+                due = time.monotonic() - last_optimize >= MAINT_OPTIMIZE_S
+                try:
+                    if time.monotonic() - last_rollup >= ROLLUP_EVERY_S:
+                        last_rollup = time.monotonic()
+                        run_rollup(max_chunks=ROLLUP_PASS_CHUNKS)
+                        self.counters["rollup_runs"] += 1
+                    if RETENTION_DAYS > 0 and time.monotonic() - last_retention >= RETENTION_EVERY_S:
+                        last_retention = time.monotonic()
+                        run_retention(RETENTION_DAYS)
+                        self.counters["retention_runs"] += 1
+                    for conn in conns:
+                        self.run_once(conn, optimize=due)
+                    if due:
+                        last_optimize = time.monotonic()
+                except sqlite3.Error:
+                    self.counters["errors"] += 1
+        finally:
+            for conn in conns:
+                conn.close()
+
+MAINTENANCE = StorageMaintenance()
+atexit.register(MAINTENANCE.close)
+for _pool in READ_POOLS:
+    atexit.register(_pool.close)
+
+def ensure_storage_profile(shard: int = 0) -> None:
+    """journal_mode is stored in the DB file: switch it once at startup."""
+    mode = storage_profile().get("journal_mode")
+    if not mode:
+        return
+    conn = _connect(shard=shard)
+    try:
+        current = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if str(current).upper() != str(mode).upper():
+            conn.execute(f"PRAGMA journal_mode = {mode}")
+    finally:
+        conn.close()
+
 def ensure_products() -> None:
     """Create + seed a tiny demo catalog so the bot can answer 'mochilas', 'remeras', etc.
-    Idempotent: safe to call on every startup."""
+    Idempotent (a migration step; older DBs may already have the table)."""
     products = [
         {"name": "Mochila urbana",      "category": "mochilas", "price": 150000, "currency": "PYG", "stock": 12, "keywords": ["mochila", "urbana", "mochilas"]},
         {"name": "Mochila escolar",     "category": "mochilas", "price": 120000, "currency": "PYG", "stock": 20, "keywords": ["mochila", "escolar", "mochilas"]},
@@ -38,7 +558,7 @@ def ensure_products() -> None:
         {"name": "Calzado deportivo",   "category": "calzado",  "price": 250000, "currency": "PYG", "stock":  8, "keywords": ["calzado", "deportivo", "zapatilla", "zapatillas"]},
         {"name": "Zapatillas running",  "category": "calzado",  "price": 300000, "currency": "PYG", "stock":  5, "keywords": ["zapatillas", "running", "calzado"]},
     ]
-    conn = db()
+    conn = _connect()
     try:
         conn.execute(
             """CREATE TABLE IF NOT EXISTS products (
@@ -56,6 +576,7 @@ def ensure_products() -> None:
         )
         conn.execute("CREATE INDEX IF NOT EXISTS ix_products_category ON products(category);")
         conn.execute("CREATE INDEX IF NOT EXISTS ix_products_active ON products(active);")
+        ensure_table_version(conn, "products")
 
         row = conn.execute("SELECT COUNT(*) AS n FROM products;").fetchone()
         if int(row["n"]) == 0:
@@ -64,269 +585,1152 @@ def ensure_products() -> None:
                     "INSERT INTO products(name, category, price, currency, stock, keywords_json, active) VALUES (?,?,?,?,?,?,1)",
                     (p["name"], p["category"], p["price"], p["currency"], p["stock"], json.dumps(p["keywords"], ensure_ascii=False)),
                 )
-            conn.commit()
+        conn.commit()
     finally:
         conn.close()
 
 
-def init_db_if_needed() -> None:
-    """Use bundled DB when present. If DB is missing, initialize from schema file.
-    Also applies lightweight migrations for demo tables (e.g., products catalog)."""
-    if not os.path.exists(DB_PATH):
-        if not os.path.exists(SCHEMA_PATH):
-            raise FileNotFoundError("Missing schema file: oneinbox_schema.sql")
-        with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
-            schema = f.read()
-        conn = db()
-        try:
-            conn.executescript(schema)
+def ensure_thread_state_column(shard: int = 0) -> None:
+    """Lightweight migration: dedicated threads.state_json (was threads.tags._state)."""
+    conn = _connect(shard=shard)
+    try:
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(threads)")}
+        if "state_json" not in cols:
+            conn.execute("ALTER TABLE threads ADD COLUMN state_json TEXT")
             conn.commit()
-        finally:
-            conn.close()
-
-    # Ensure optional demo tables exist (idempotent)
-    ensure_products()
+    finally:
+        conn.close()
 
+def ensure_thread_state_version(shard: int = 0) -> None:
+    """Lightweight migration: threads.state_version, bumped with every state_json
+    write, so each process can tell whether its cached state is current."""
+    conn = _connect(shard=shard)
+    try:
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(threads)")}
+        if "state_version" not in cols:
+            conn.execute("ALTER TABLE threads ADD COLUMN state_version INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+    finally:
+        conn.close()
 
-# Ensure DB exists at startup
-init_db_if_needed()
-def strip_accents(s: str) -> str:
-    return "".join(c for c in unicodedata.normalize("NFKD", s) if not unicodedata.combining(c))
+def ensure_thread_platform_index(shard: int = 0) -> None:
+    """Lightweight migration: ix_threads_platform_last_activity gains the id
+    column, so a ?platform= page of /api/threads walks it without a sort."""
+    conn = _connect(shard=shard)
+    try:
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'ix_threads_platform_last_activity'").fetchone()
+        if not row or "id DESC" not in row[0]:
+            with conn:
+                conn.execute("DROP INDEX IF EXISTS ix_threads_platform_last_activity")
+                conn.execute("CREATE INDEX ix_threads_platform_last_activity ON threads(platform, last_activity_at DESC, id DESC)")
+    finally:
+        conn.close()
 
-def norm_text(s: str) -> str:
-    s = strip_accents(s or "").lower()
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+def ensure_metrics_response_column(shard: int = 0) -> None:
+    """Lightweight migration: sample count behind metrics_daily.avg_response_ms (running mean)."""
+    conn = _connect(shard=shard)
+    try:
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(metrics_daily)")}
+        if "response_count" not in cols:
+            conn.execute("ALTER TABLE metrics_daily ADD COLUMN response_count INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+    finally:
+        conn.close()
 
-def thread_external_id(platform: str, user: str) -> str:
-    return f"{platform}:{user.strip()}"
+REPLY_JOBS_DDL = """
+CREATE TABLE IF NOT EXISTS reply_jobs (
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  thread_id    INTEGER NOT NULL,
+  message_id   INTEGER NOT NULL,
+  status       TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued','running','failed')),
+  attempts     INTEGER NOT NULL DEFAULT 0,
+  available_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  locked_by    TEXT,
+  locked_at    TEXT,
+  last_error   TEXT,
+  created_at   TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  FOREIGN KEY(thread_id) REFERENCES threads(id) ON DELETE CASCADE,
+  FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_reply_jobs_status_available ON reply_jobs(status, available_at);
+CREATE INDEX IF NOT EXISTS ix_reply_jobs_thread ON reply_jobs(thread_id, id);
+CREATE INDEX IF NOT EXISTS ix_reply_jobs_message ON reply_jobs(message_id);
+"""
 
-def ensure_customer_and_thread(platform: str, user_name: str) -> Tuple[int, int, str]:
-    """Returns (customer_id, thread_db_id, thread_external_id)."""
-    user_name = (user_name or "Usuario").strip() or "Usuario"
-    ext_id = thread_external_id(platform, user_name)
-    conn = db()
+def ensure_message_keys(shard: int = 0) -> None:
+    """Lightweight migration: messages.external_message_id (platform message id or
+    idempotency key, unique per platform) and messages.reply_to (the inbound a
+    bot reply answers), so a retried webhook gets the stored reply back."""
+    conn = _connect(shard=shard)
     try:
-        # customer by display_name (MVP)
-        row = conn.execute("SELECT id FROM customers WHERE display_name = ?", (user_name,)).fetchone()
-        if row:
-            customer_id = int(row["id"])
-        else:
-            cur = conn.execute("INSERT INTO customers(display_name, opt_in) VALUES (?, 1)", (user_name,))
-            customer_id = int(cur.lastrowid)
-
-        # identity (best-effort; avoid UNIQUE collisions by using user_name)
-        try:
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(messages)")}
+        with conn:
+            if "external_message_id" not in cols:
+                conn.execute("ALTER TABLE messages ADD COLUMN external_message_id TEXT")
+            if "reply_to" not in cols:
+                conn.execute("ALTER TABLE messages ADD COLUMN reply_to INTEGER")
             conn.execute(
-                "INSERT OR IGNORE INTO customer_identities(customer_id, platform, platform_user_id, handle) VALUES (?,?,?,?)",
-                (customer_id, platform, user_name, user_name),
+                "CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_platform_external "
+                "ON messages(platform, external_message_id) WHERE external_message_id IS NOT NULL"
             )
-        except Exception:
-            pass
+    finally:
+        conn.close()
 
-        # thread by platform + external_thread_id (stable across restarts)
-        trow = conn.execute(
-            "SELECT id FROM threads WHERE platform = ? AND external_thread_id = ? ORDER BY last_activity_at DESC LIMIT 1",
-            (platform, ext_id),
-        ).fetchone()
-        if trow:
-            thread_id = int(trow["id"])
-        else:
-            cur = conn.execute(
-                "INSERT INTO threads(platform, customer_id, external_thread_id, status, priority, tags) VALUES (?,?,?,?,?,?)",
-                (platform, customer_id, ext_id, "open", "normal", None),
-            )
-            thread_id = int(cur.lastrowid)
+def ensure_reply_jobs(shard: int = 0) -> None:
+    """Lightweight migration: durable queue behind /api/webhook (done jobs are deleted)."""
+    conn = _connect(shard=shard)
+    try:
+        conn.executescript(REPLY_JOBS_DDL)
+    finally:
+        conn.close()
 
-        conn.commit()
-        return customer_id, thread_id, ext_id
+ROLLUP_DDL = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+  name       TEXT PRIMARY KEY,
+  last_id    INTEGER NOT NULL DEFAULT 0,
+  until_id   INTEGER,
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+);
+CREATE TABLE IF NOT EXISTS event_metrics_daily (
+  day        TEXT NOT NULL,
+  platform   TEXT NOT NULL,
+  event_type TEXT NOT NULL,
+  status     TEXT NOT NULL,
+  n          INTEGER NOT NULL DEFAULT 0,
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  PRIMARY KEY(day, platform, event_type, status)
+);
+"""
+
+def ensure_rollups(shard: int = 0) -> None:
+    """Lightweight migration: rollup high-water marks (checkpoints) and the
+    per-day event counts folded from automation_events."""
+    conn = _connect(shard=shard)
+    try:
+        conn.executescript(ROLLUP_DDL)
     finally:
         conn.close()
 
-def load_thread_state(thread_id: int) -> Dict[str, Any]:
-    """Persisted state for the rule-engine (stored inside threads.tags as JSON)."""
-    conn = db()
+THREAD_ACTIVITY_TRIGGER = """
+CREATE TRIGGER trg_messages_ai_thread_activity
+AFTER INSERT ON messages
+BEGIN
+  UPDATE threads
+  SET last_activity_at = new.created_at,
+      last_message_id = new.id,
+      last_message_preview = substr(new.content, 1, 140),
+      updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+  WHERE id = new.thread_id
+    AND (last_message_id IS NULL OR new.created_at >= last_activity_at);  -- backfilled history doesn't rewind
+END
+"""
+
+THREAD_LATEST_VIEW = """
+CREATE VIEW v_thread_latest_message AS
+SELECT
+  t.id AS thread_id,
+  t.platform,
+  t.customer_id,
+  t.status,
+  t.priority,
+  t.last_activity_at,
+  m.id AS message_id,
+  m.sender_type,
+  m.content,
+  m.created_at AS message_created_at
+FROM threads t
+LEFT JOIN messages m
+  ON m.id = t.last_message_id
+"""
+
+def ensure_thread_latest_message(shard: int = 0) -> None:
+    """Lightweight migration: threads.last_message_id/last_message_preview kept by
+    trg_messages_ai_thread_activity (the view no longer sorts each thread's
+    messages), plus the /api/threads keyset indexes. Backfills once."""
+    conn = _connect(shard=shard)
     try:
-        row = conn.execute("SELECT tags FROM threads WHERE id = ?", (thread_id,)).fetchone()
-        if not row or not row["tags"]:
-            return {}
-        try:
-            blob = json.loads(row["tags"])
-            if isinstance(blob, dict) and isinstance(blob.get("_state"), dict):
-                return blob["_state"]
-        except Exception:
-            return {}
-        return {}
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(threads)")}
+        trigger = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_messages_ai_thread_activity'").fetchone()
+        view = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'v_thread_latest_message'").fetchone()
+        stale = "last_message_id" not in cols or not trigger or "last_message_id" not in trigger[0]
+        with conn:
+            if "last_message_id" not in cols:
+                conn.execute("ALTER TABLE threads ADD COLUMN last_message_id INTEGER")
+            if "last_message_preview" not in cols:
+                conn.execute("ALTER TABLE threads ADD COLUMN last_message_preview TEXT")
+            if stale:
+                conn.execute("DROP TRIGGER IF EXISTS trg_messages_ai_thread_activity")
+                conn.execute(THREAD_ACTIVITY_TRIGGER)
+                # ix_messages_thread_time: one index probe per thread
+                conn.execute(
+                    "UPDATE threads SET last_message_id = (SELECT id FROM messages WHERE thread_id = threads.id "
+                    "ORDER BY created_at DESC, id DESC LIMIT 1) WHERE last_message_id IS NULL"
+                )
+                conn.execute(
+                    "UPDATE threads SET (last_message_preview, last_activity_at) = "
+                    "(SELECT substr(content, 1, 140), created_at FROM messages WHERE id = threads.last_message_id) "
+                    "WHERE last_message_id IS NOT NULL"
+                )
+            if not view or "last_message_id" not in view[0]:
+                conn.execute("DROP VIEW IF EXISTS v_thread_latest_message")
+                conn.execute(THREAD_LATEST_VIEW)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_threads_last_activity ON threads(last_activity_at DESC, id DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_threads_status_last_activity ON threads(status, last_activity_at DESC, id DESC)")
     finally:
         conn.close()
 
-def save_thread_state(thread_id: int, state: Dict[str, Any]) -> None:
-    conn = db()
+def ensure_identity_indexes(shard: int = 0) -> None:
+    """Lightweight migration: unique thread key + indexed customer name lookup.
+    Older DBs may hold duplicate (platform, external_thread_id) threads; those
+    are merged into the most recently active one before the index is built."""
+    conn = _connect(shard=shard)
     try:
-        row = conn.execute("SELECT tags FROM threads WHERE id = ?", (thread_id,)).fetchone()
-        blob = {}
-        if row and row["tags"]:
-            try:
-                blob = json.loads(row["tags"]) if row["tags"] else {}
-                if not isinstance(blob, dict):
-                    blob = {}
-            except Exception:
-                blob = {}
-        blob["_state"] = state or {}
-        conn.execute(
-            "UPDATE threads SET tags = ?, updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now')) WHERE id = ?",
-            (json.dumps(blob, ensure_ascii=False), thread_id),
-        )
-        conn.commit()
+        with conn:
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_customers_display_name ON customers(display_name);")
+            has_ux = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_threads_platform_external'"
+            ).fetchone()
+            if not has_ux:
+                dups = conn.execute(
+                    "SELECT platform, external_thread_id FROM threads WHERE external_thread_id IS NOT NULL "
+                    "GROUP BY platform, external_thread_id HAVING COUNT(*) > 1"
+                ).fetchall()
+                for d in dups:
+                    ids = [int(r["id"]) for r in conn.execute(
+                        "SELECT id FROM threads WHERE platform=? AND external_thread_id=? ORDER BY last_activity_at DESC, id DESC",
+                        (d["platform"], d["external_thread_id"]),
+                    )]
+                    keep, drop = ids[0], ids[1:]
+                    marks = ",".join("?" * len(drop))
+                    conn.execute(f"UPDATE messages SET thread_id=? WHERE thread_id IN ({marks})", [keep] + drop)
+                    conn.execute(f"UPDATE automation_events SET thread_id=? WHERE thread_id IN ({marks})", [keep] + drop)
+                    conn.execute(f"DELETE FROM threads WHERE id IN ({marks})", drop)
+                conn.execute(
+                    "CREATE UNIQUE INDEX ux_threads_platform_external ON threads(platform, external_thread_id);"
+                )
     finally:
         conn.close()
 
-def log_event(thread_id: int, message_id: Optional[int], event_type: str, status: str = "ok", details: Optional[dict] = None) -> None:
-    conn = db()
+FTS_DDL = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+  content,
+  content='messages',
+  content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER trg_messages_ai_fts
+AFTER INSERT ON messages
+BEGIN
+  INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+
+CREATE TRIGGER trg_messages_ad_fts
+AFTER DELETE ON messages
+BEGIN
+  INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+
+CREATE TRIGGER trg_messages_au_fts
+AFTER UPDATE OF content ON messages
+BEGIN
+  INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+  INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+def ensure_fts_external_content(shard: int = 0) -> None:
+    """Lightweight migration: messages_fts used to keep its own copy of every
+    message body (+ message_id column). Rebuild it as an external-content index
+    over messages(id, content)."""
+    conn = _connect(shard=shard)
     try:
-        conn.execute(
-            "INSERT INTO automation_events(thread_id, message_id, event_type, status, details_json) VALUES (?,?,?,?,?)",
-            (thread_id, message_id, event_type, status, json.dumps(details or {}, ensure_ascii=False) if details else None),
-        )
-        conn.commit()
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='messages_fts'").fetchone()
+        if row and "content='messages'" in (row["sql"] or ""):
+            return
+        with conn:
+            for trg in ("trg_messages_ai_fts", "trg_messages_ad_fts", "trg_messages_au_fts"):
+                conn.execute(f"DROP TRIGGER IF EXISTS {trg}")
+            conn.execute("DROP TABLE IF EXISTS messages_fts")
+            for stmt in FTS_DDL.split(";\n\n"):
+                if stmt.strip():
+                    conn.execute(stmt)
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
     finally:
         conn.close()
 
-def insert_message(thread_id: int, platform: str, role: str, user: str, text: str, reply_to: Optional[str] = None, intent: Optional[str] = None, confidence: Optional[float] = None, is_auto: bool = False) -> dict:
-    """
-    role: 'user' or 'system' (UI expects this)
-    """
-    sender_type = "user" if role == "user" else "system"
-    sender_name = user if sender_type == "user" else AUTO_USER
-    conn = db()
+def ensure_shard_layout(shard: int) -> None:
+    """Sharded ids are = shard (mod SHARDS): refuse a file whose threads were
+    created unsharded or with another ONEINBOX_SHARDS (they can't be routed)."""
+    if SHARDS == 1:
+        return
+    conn = _connect(shard=shard)
     try:
-        cur = conn.execute(
-            "INSERT INTO messages(thread_id, platform, sender_type, sender_name, content, intent, confidence, is_auto) VALUES (?,?,?,?,?,?,?,?)",
-            (thread_id, platform, sender_type, sender_name, text, intent, confidence, 1 if is_auto else 0),
-        )
-        mid = int(cur.lastrowid)
-        conn.commit()
+        bad = conn.execute("SELECT id FROM threads WHERE id % ? != ? LIMIT 1", (SHARDS, shard)).fetchone()
     finally:
         conn.close()
+    if bad:
+        raise RuntimeError(f"{shard_path(shard)} holds threads not laid out for ONEINBOX_SHARDS={SHARDS} (e.g. id {bad[0]})")
 
-    # Provide the shape expected by the front-end (index.html normMsg)
-    # Use thread external id in payload
-    ext = conn  # placeholder for mypy; will re-open quickly
-    _, _, ext_id = ensure_customer_and_thread(platform, user)  # safe: returns same ext_id
-    return {
-        "id": str(mid),
-        "seq": mid,
-        "thread_id": ext_id,
-        "platform": platform,
-        "role": role,
-        "user": user,
-        "text": text,
-        "timestamp": _utc_iso(),
-        "typing": False,
-        "client_only": False,
-        "reply_to": reply_to,
-    }
+def ensure_shard_count(shard: int = 0) -> None:
+    """Lightweight migration: record ONEINBOX_SHARDS in the file (storage_meta),
+    once ensure_shard_layout() agrees, so every start can compare it cheaply
+    (check_shard_count) instead of scanning threads."""
+    ensure_shard_layout(shard)
+    conn = _connect(shard=shard)
+    try:
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO storage_meta(key, value) VALUES ('shards', ?)", (str(SHARDS),))
+    finally:
+        conn.close()
 
-# =========================
-# Rule engine
-# =========================
+def next_row_id(conn: sqlite3.Connection, table: str, clock: bool = False) -> Optional[int]:
+    """Sharded mode: the next id for an AUTOINCREMENT table, = the connection's
+    shard (mod SHARDS), so ids are unique across files and shard_of() finds a
+    row's file; further ids in the same transaction step by SHARDS. clock: not
+    below epoch_ms * SHARD_ID_TICKS_PER_MS, so message ids from different files
+    interleave in time order. Call inside the write transaction. None when
+    unsharded (SQLite assigns the id)."""
+    if SHARDS == 1:
+        return None
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    base = (int(row[0]) if row else 0) + 1
+    if clock:
+        base = max(base, int(time.time() * 1000) * SHARD_ID_TICKS_PER_MS)
+    return base + (getattr(conn, "shard", 0) - base) % SHARDS
 
-KW = {
-  "catalog": ["catalogo","catálogo","productos","producto","que vendes","qué vendes","que venden","qué venden","vendes","venden","tenes","tenés","tienen",
-              "mochila","mochilas","remera","remeras","calzado","zapatilla","zapatillas","zapatos","zapatito","remera","remeritas"],
-  "price": ["precio","costo","vale","cuanto","cuánto","valor"],
-  "hours": ["horario","horarios","abren","cierran","atienden","atencion","atención"],
-  "shipping": ["envio","envío","delivery","envian","envían","envío a domicilio"],
-  "refund": ["reembolso","devolucion","devolución","me cobraron","cobro","cobrar","cargo","duplicado"],
-  "account": ["contraseña","contrasena","codigo","código","bloqueo","bloqueada","no puedo entrar","login","iniciar sesion","iniciar sesión"],
-  "status": ["estado","novedades","tarda","proceso","tramite","trámite","seguimiento"]
-}
+def strip_accents(s: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", s) if not unicodedata.combining(c))
 
-SLOTS = {
-  "catalog": ["categoria"],
-  "shipping": ["direccion", "zona"],
-  "refund": ["numero_orden", "monto"],
-  "account": ["email_o_telefono"]
-}
+def norm_text(s: str) -> str:
+    s = strip_accents(s or "").lower()
+    s = re.sub(r"\s+", " ", s).strip()
+    return s
 
-RESP = {
-  "price": [
-    "Nuestros precios varían según el producto. ¿Qué artículo te interesa?",
-    "¡Claro! Decime qué producto estás buscando y te paso el precio.",
-  ],
-  "hours": [
-    "Atendemos de lunes a viernes de 8:00 a 18:00. ¿En qué te ayudo?",
-    "Nuestro horario es 8:00–18:00 (L–V). ¿Querés que te asesore con algo específico?",
-  ],
-  "shipping": [
-    "Hacemos envíos. ¿Me pasás tu dirección y zona para cotizar tiempo de entrega?",
-    "Sí, enviamos a domicilio. ¿Cuál es tu dirección y zona?",
-  ],
-  "refund": [
-    "Entiendo. Para ayudarte con el reembolso necesito el número de orden y el monto.",
-    "Vamos a resolverlo. Pasame número de orden y monto para verificar el cobro.",
-  ],
-  "account": [
-    "Te ayudo con el acceso. ¿Me confirmás tu email o teléfono asociado a la cuenta?",
-    "Entendido. Necesito tu email o teléfono para revisar el ingreso.",
-  ],
-  "status": [
-    "Puedo revisar el estado. ¿Tenés un número de caso/orden para ubicarlo?",
-    "Dale, ¿me pasás el número de caso/orden para ver el estado?",
-  ],
-  "fallback": [
-    "Gracias por tu mensaje. Un agente te responderá pronto. ¿Podés darme un poco más de detalle?",
-    "Recibido. ¿Me contás un poco más para ayudarte mejor?",
-  ]
-}
+def thread_external_id(platform: str, user: str) -> str:
+    return f"{platform}:{user.strip()}"
 
-def classify(text: str) -> Tuple[str, float]:
-    t = norm_text(text)
-    for intent, kws in KW.items():
-        for kw in kws:
-            if norm_text(kw) in t:
-                return intent, 0.85
-    return "fallback", 0.35
+class IdentityCache:
+    """Bounded LRU: (platform, user_name) -> (customer_id, thread_db_id, thread_external_id).
+    Entries are added only after the creating transaction commits."""
 
-def extract(text: str, intent: str) -> Dict[str, str]:
-    # MVP: very light extraction; extend later
-    t = (text or "").strip()
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[Tuple[str, str], Tuple[int, int, str]]" = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[Tuple[int, int, str]]:
+        with self._lock:
+            hit = self._lru.get(key)
+            if hit is not None:
+                self._lru.move_to_end(key)
+            return hit
+
+    def put(self, key: Tuple[str, str], value: Tuple[int, int, str]) -> None:
+        with self._lock:
+            self._lru[key] = value
+            self._lru.move_to_end(key)
+            while len(self._lru) > IDENTITY_CACHE_MAX:
+                self._lru.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+IDENTITIES = IdentityCache()
+
+def ensure_customer_and_thread(uow: UnitOfWork, platform: str, user_name: str) -> Tuple[int, int, str]:
+    """Returns (customer_id, thread_db_id, thread_external_id).
+
+    Warm: one LRU lookup. Cold: indexed lookups on
+    customer_identities(platform, platform_user_id) and
+    threads(platform, external_thread_id), created with upserts.
+    Runs on the caller's transaction; does not commit."""
+    user_name = (user_name or "Usuario").strip() or "Usuario"
+    key = (platform, user_name)
+    hit = IDENTITIES.get(key)
+    if hit is not None:
+        return hit
+
+    conn = uow.conn
+    ext_id = thread_external_id(platform, user_name)
+    with SQL_TIMES.time("identity.lookup"):
+        row = conn.execute(
+            "SELECT ci.customer_id, t.id AS thread_id FROM customer_identities ci "
+            "LEFT JOIN threads t ON t.platform = ci.platform AND t.external_thread_id = ? "
+            "WHERE ci.platform = ? AND ci.platform_user_id = ?",
+            (ext_id, platform, user_name),
+        ).fetchone()
+    if row:
+        customer_id = int(row["customer_id"])
+        thread_id = int(row["thread_id"]) if row["thread_id"] is not None else None
+    else:
+        # First contact on this platform: link to a customer with the same name (MVP)
+        with SQL_TIMES.time("customer.link"):
+            crow = conn.execute("SELECT id FROM customers WHERE display_name = ? ORDER BY id LIMIT 1", (user_name,)).fetchone()
+        if crow:
+            customer_id = int(crow["id"])
+        else:
+            with SQL_TIMES.time("customer.insert"):
+                customer_id = int(conn.execute("INSERT INTO customers(display_name, opt_in) VALUES (?, 1)", (user_name,)).lastrowid)
+        with SQL_TIMES.time("identity.upsert"):
+            customer_id = int(conn.execute(
+                "INSERT INTO customer_identities(customer_id, platform, platform_user_id, handle) VALUES (?,?,?,?) "
+                "ON CONFLICT(platform, platform_user_id) DO UPDATE SET updated_at = customer_identities.updated_at "
+                "RETURNING customer_id",
+                (customer_id, platform, user_name, user_name),
+            ).fetchone()[0])
+        thread_id = None
+
+    if thread_id is None:
+        with SQL_TIMES.time("thread.upsert"):
+            thread_id = int(conn.execute(
+                "INSERT INTO threads(id, platform, customer_id, external_thread_id, status, priority, tags) VALUES (?,?,?,?,?,?,?) "
+                "ON CONFLICT(platform, external_thread_id) DO UPDATE SET customer_id = COALESCE(threads.customer_id, excluded.customer_id) "
+                "RETURNING id",
+                (next_row_id(conn, "threads"), platform, customer_id, ext_id, "open", "normal", None),
+            ).fetchone()[0])
+
+    value = (customer_id, thread_id, ext_id)
+    uow.on_commit(lambda: IDENTITIES.put(key, value))
+    return value
+
+def _legacy_tags_state(tags: Optional[str]) -> Dict[str, Any]:
+    # Before threads.state_json existed, state lived in threads.tags as {"_state": {...}}
+    if not tags:
+        return {}
+    try:
+        blob = json.loads(tags)
+        if isinstance(blob, dict) and isinstance(blob.get("_state"), dict):
+            return blob["_state"]
+    except Exception:
+        return {}
+    return {}
+
+class StateCache:
+    """Write-through LRU of rule-engine state, keyed by thread id.
+
+    put() writes threads.state_json in the caller's transaction and bumps
+    threads.state_version; the cached copy is tagged with that version once
+    it commits. get() probes threads.state_version only, and reads and parses
+    state_json only when it differs from the cached version, so a state written by another
+    process (web or reply worker) is never served stale. Callers serialize on
+    a per-thread lock for the read-modify-write; across processes, on the
+    write transaction (BEGIN IMMEDIATE)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[int, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._stripes = [threading.RLock() for _ in range(STATE_LOCK_STRIPES)]  # re-entrant: batches pre-lock
+        self.counters = {"hits": 0, "misses": 0, "writes": 0}
+
+    def lock(self, uow: UnitOfWork, thread_id: int) -> None:
+        """Hold the thread's lock until `uow` closes (after its commit callbacks)."""
+        lk = self._stripes[thread_id % STATE_LOCK_STRIPES]
+        lk.acquire()
+        uow.on_close(lk.release)
+
+    def lock_many(self, uow: UnitOfWork, thread_ids: Iterable[int]) -> None:
+        """lock() for several threads. Stripes are taken once each, in stripe
+        order, so two batches sharing stripes can't wait on each other."""
+        for stripe in sorted({tid % STATE_LOCK_STRIPES for tid in thread_ids}):
+            lk = self._stripes[stripe]
+            lk.acquire()
+            uow.on_close(lk.release)
+
+    def get(self, conn: sqlite3.Connection, thread_id: int) -> Dict[str, Any]:
+        with SQL_TIMES.time("state.probe"):
+            probe = conn.execute("SELECT state_version FROM threads WHERE id = ?", (thread_id,)).fetchone()
+        with self._lock:
+            hit = self._lru.get(thread_id)
+            if hit is not None and probe is not None and hit[0] == int(probe[0]):
+                self._lru.move_to_end(thread_id)
+                self.counters["hits"] += 1
+                return copy.deepcopy(hit[1])
+        self.counters["misses"] += 1
+        # Re-read the version with the blob: it may have moved since the probe
+        with SQL_TIMES.time("state.load"):
+            row = conn.execute("SELECT state_version, state_json, tags FROM threads WHERE id = ?", (thread_id,)).fetchone()
+        version = int(row["state_version"]) if row else 0
+        state = {}
+        if row:
+            try:
+                state = json.loads(row["state_json"]) if row["state_json"] else _legacy_tags_state(row["tags"])
+            except Exception:
+                state = {}
+        if not isinstance(state, dict):
+            state = {}
+        self._remember(thread_id, version, state)
+        return copy.deepcopy(state)
+
+    def put(self, uow: UnitOfWork, thread_id: int, state: Dict[str, Any]) -> None:
+        state = copy.deepcopy(state or {})
+        with SQL_TIMES.time("state.save"):
+            row = uow.conn.execute(
+                "UPDATE threads SET state_json = ?, state_version = state_version + 1, updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now')) "
+                "WHERE id = ? RETURNING state_version",
+                (json.dumps(state, ensure_ascii=False), thread_id),
+            ).fetchone()
+        if row is None:
+            return
+        self.counters["writes"] += 1
+        uow.on_commit(lambda: self._remember(thread_id, int(row[0]), state))
+
+    def _remember(self, thread_id: int, version: int, state: Dict[str, Any]) -> None:
+        with self._lock:
+            current = self._lru.get(thread_id)
+            if current is None or current[0] <= version:
+                self._lru[thread_id] = (version, state)
+            self._lru.move_to_end(thread_id)
+            while len(self._lru) > STATE_CACHE_MAX:
+                self._lru.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters, cached=len(self._lru))
+
+STATE = StateCache()
+
+def load_thread_state(conn: sqlite3.Connection, thread_id: int) -> Dict[str, Any]:
+    """Rule-engine state for a thread (threads.state_json, via STATE)."""
+    return STATE.get(conn, thread_id)
+
+def save_thread_state(uow: UnitOfWork, thread_id: int, state: Dict[str, Any]) -> None:
+    """Written in `uow`'s transaction; STATE keeps the copy once it commits."""
+    STATE.put(uow, thread_id, state)
+
+# =========================
+# Event sink (automation_events)
+# =========================
+
+EVENT_INSERT_SQL = "INSERT INTO automation_events(thread_id, message_id, event_type, status, details_json, created_at) VALUES (?,?,?,?,?,?)"
+
+class EventSink:
+    """Background group-commit writer for automation_events.
+
+    Producers enqueue rows without touching the DB; one writer thread drains the
+    queue and commits them with executemany, every EVENT_BATCH_SIZE rows or
+    EVENT_FLUSH_MS, whichever comes first (one transaction per shard). The queue
+    is bounded: when it is full, submit() waits up to EVENT_PUT_TIMEOUT_S and
+    then drops (counted)."""
+
+    def __init__(self) -> None:
+        self._q: "queue.Queue[Any]" = queue.Queue(maxsize=EVENT_QUEUE_MAX)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._stopping = False
+        # best-effort counters (plain ints under the GIL)
+        self.counters = {"enqueued": 0, "written": 0, "dropped": 0, "late": 0, "failed": 0, "batches": 0}
+
+    def _ensure_started(self) -> None:
+        # Lazy start, and restart after fork (each worker process owns its writer)
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._q = queue.Queue(maxsize=EVENT_QUEUE_MAX)  # a queue inherited across fork is not usable
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="event-sink", daemon=True)
+            self._thread.start()
+
+    def submit(self, row: Tuple[Any, ...]) -> bool:
+        """Enqueue one automation_events row (columns as EVENT_INSERT_SQL)."""
+        self._ensure_started()
+        try:
+            self._q.put((time.monotonic(), row), timeout=EVENT_PUT_TIMEOUT_S)
+        except queue.Full:
+            self.counters["dropped"] += 1
+            return False
+        self.counters["enqueued"] += 1
+        return True
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Block until everything enqueued so far is committed."""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        try:
+            self._q.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Drain and stop the writer (registered with atexit)."""
+        self.flush(timeout)
+        self._stopping = True
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counters, queue_depth=self._q.qsize())
+
+    def _run(self) -> None:
+        conns = [db(shard=shard) for shard in range(SHARDS)]
+        try:
+            while not self._stopping:
+                try:
+                    item = self._q.get(timeout=EVENT_FLUSH_MS / 1000.0)
+                except queue.Empty:
+                    continue
+                batch: List[Tuple[float, Tuple[Any, ...]]] = []
+                markers: List[threading.Event] = []
+                deadline = time.monotonic() + EVENT_FLUSH_MS / 1000.0
+                while True:
+                    if isinstance(item, threading.Event):
+                        markers.append(item)  # flush() marker: commit what we have now
+                        break
+                    batch.append(item)
+                    if len(batch) >= EVENT_BATCH_SIZE:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._q.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if batch:
+                    by_shard: Dict[int, List[Tuple[float, Tuple[Any, ...]]]] = {}
+                    for item in batch:
+                        by_shard.setdefault(shard_of(item[1][0]), []).append(item)  # row[0]: thread_id
+                    for shard, part in by_shard.items():
+                        self._write(conns[shard], part)
+                for m in markers:
+                    m.set()
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[Tuple[float, Tuple[Any, ...]]]) -> None:
+        rows = [r for _, r in batch]
+        try:
+            with conn:
+                conn.executemany(EVENT_INSERT_SQL, rows)
+            written = len(rows)
+        except sqlite3.Error:
+            # e.g. FK failure after /api/clear removed the thread: isolate bad rows
+            written = 0
+            for r in rows:
+                try:
+                    with conn:
+                        conn.execute(EVENT_INSERT_SQL, r)
+                    written += 1
+                except sqlite3.Error:
+                    self.counters["failed"] += 1
+        now = time.monotonic()
+        self.counters["written"] += written
+        self.counters["batches"] += 1
+        self.counters["late"] += sum(1 for t0, _ in batch if (now - t0) * 1000.0 > EVENT_LATE_MS)
+
+EVENTS = EventSink()
+atexit.register(EVENTS.close)
+
+def log_event(uow: UnitOfWork, thread_id: int, message_id: Optional[int], event_type: str, status: str = "ok", details: Optional[dict] = None) -> None:
+    """Record a pipeline event. With EVENT_ASYNC the row is handed to the sink
+    only once the request transaction commits (no events for rolled-back work)."""
+    row = (thread_id, message_id, event_type, status, json.dumps(details or {}, ensure_ascii=False) if details else None, _utc_iso_ms())
+    if EVENT_ASYNC:
+        uow.on_commit(lambda: EVENTS.submit(row))
+    else:
+        uow.conn.execute(EVENT_INSERT_SQL, row)
+
+# =========================
+# Live updates (in-process fan-out for /api/stream)
+# =========================
+
+class Subscriber:
+    def __init__(self) -> None:
+        self.q: "queue.Queue[Tuple[str, dict, Optional[int]]]" = queue.Queue(maxsize=SSE_CLIENT_BUFFER)
+        self.overflow = False
+
+class MessageHub:
+    """Fan-out of committed messages to connected /api/stream clients.
+    publish() never blocks: a client whose buffer is full is flagged and
+    disconnected with a resync event (it resumes from the DB via Last-Event-ID)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subs: List[Subscriber] = []
+
+    def subscribe(self) -> Subscriber:
+        sub = Subscriber()
+        with self._lock:
+            self._subs.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        with self._lock:
+            if sub in self._subs:
+                self._subs.remove(sub)
+
+    def publish(self, kind: str, data: dict, event_id: Optional[int] = None) -> None:
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            if sub.overflow:
+                continue
+            try:
+                sub.q.put_nowait((kind, data, event_id))
+            except queue.Full:
+                sub.overflow = True
+
+    def publish_message(self, msg: dict) -> None:
+        self.publish("message", msg, int(msg["seq"]))
+        self.publish("stats", {"total": 1, msg["platform"]: 1})
+
+    def clients(self) -> int:
+        with self._lock:
+            return len(self._subs)
+
+HUB = MessageHub()
+
+# =========================
+# Message counters (/api/stats, metrics_daily)
+# =========================
+
+# :n messages of one (day, platform, sender kind, intent) group; :ms (optional) is
+# one reply's response time, folded into the running mean avg_response_ms
+METRICS_UPSERT_SQL = """
+INSERT INTO metrics_daily(day, platform, total_messages, user_messages, bot_messages, intent_counts_json, avg_response_ms, response_count)
+VALUES (:day, :platform, :n, :is_user * :n, (1 - :is_user) * :n, CASE WHEN :intent IS NULL THEN NULL ELSE json_object(:intent, :n) END,
+        :ms, CASE WHEN :ms IS NULL THEN 0 ELSE 1 END)
+ON CONFLICT(day, platform) DO UPDATE SET
+  total_messages = total_messages + :n,
+  user_messages = user_messages + :is_user * :n,
+  bot_messages = bot_messages + (1 - :is_user) * :n,
+  intent_counts_json = CASE WHEN :intent IS NULL THEN intent_counts_json
+    ELSE json_set(COALESCE(intent_counts_json, '{}'), '$."' || :intent || '"',
+                  COALESCE(json_extract(intent_counts_json, '$."' || :intent || '"'), 0) + :n) END,
+  avg_response_ms = CASE WHEN :ms IS NULL THEN avg_response_ms
+    ELSE (COALESCE(avg_response_ms, 0) * response_count + :ms) / (response_count + 1) END,
+  response_count = response_count + CASE WHEN :ms IS NULL THEN 0 ELSE 1 END,
+  updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+"""
+
+def _empty_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {"total": 0, "user": 0, "bot": 0, "intents": {}}
+    out.update({p: 0 for p in PLATFORMS})
+    return out
+
+class StatsCounters:
+    """Message counts for /api/stats, O(1) to read.
+
+    Every insert bumps the in-memory counters (after commit) and its
+    metrics_daily(day, platform) row (inside the same transaction). The memory
+    copy is rebuilt from metrics_daily (summed over shards) on first use and
+    every STATS_REFRESH_S, which also folds in rows written by other worker
+    processes."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._c = _empty_stats()
+        self._loaded_at: Optional[float] = None
+
+    def load(self, conns: Sequence[sqlite3.Connection]) -> None:
+        c = _empty_stats()
+        rows = [r for conn in conns for r in conn.execute(
+            "SELECT platform, total_messages, user_messages, bot_messages, intent_counts_json FROM metrics_daily"
+        )]
+        for r in rows:
+            c["total"] += r["total_messages"]
+            c["user"] += r["user_messages"]
+            c["bot"] += r["bot_messages"]
+            if r["platform"] in c:
+                c[r["platform"]] += r["total_messages"]
+            try:
+                for intent, n in json.loads(r["intent_counts_json"] or "{}").items():
+                    c["intents"][intent] = c["intents"].get(intent, 0) + int(n)
+            except Exception:
+                pass
+        with self._lock:
+            self._c = c
+            self._loaded_at = time.monotonic()
+
+    def record(self, platform: str, is_user: bool, intent: Optional[str], n: int = 1) -> None:
+        with self._lock:
+            c = self._c
+            c["total"] += n
+            c[platform] = c.get(platform, 0) + n
+            c["user" if is_user else "bot"] += n
+            if intent:
+                c["intents"][intent] = c["intents"].get(intent, 0) + n
+
+    def reset(self) -> None:
+        with self._lock:
+            self._c = _empty_stats()
+
+    def snapshot(self, conns: Sequence[sqlite3.Connection]) -> Dict[str, Any]:
+        """conns: one connection per shard (only used when a reload is due)."""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > STATS_REFRESH_S:
+            self.load(conns)
+        with self._lock:
+            return dict(self._c, intents=dict(self._c["intents"]))
+
+STATS = StatsCounters()
+
+def record_message_metrics(uow: UnitOfWork, platform: str, sender_type: str, intent: Optional[str], day: Optional[str] = None, n: int = 1, response_ms: Optional[float] = None) -> None:
+    is_user = sender_type == "user"
+    with SQL_TIMES.time("metrics.upsert"):
+        uow.conn.execute(METRICS_UPSERT_SQL, {
+            "day": day or _utc_iso()[:10], "platform": platform, "is_user": 1 if is_user else 0,
+            "intent": intent, "n": n, "ms": response_ms,
+        })
+    uow.on_commit(lambda: STATS.record(platform, is_user, intent, n))
+
+def ensure_metrics_backfill(shard: int = 0) -> None:
+    """One-time: messages stored before counters existed are folded into
+    metrics_daily by run_rollup(), in ROLLUP_CHUNK id ranges up to the current
+    max id (newer ones are counted as they are inserted). Only registers the
+    job here, so startup doesn't scan history."""
+    conn = _connect(shard=shard)
+    try:
+        with conn:
+            if conn.execute("SELECT 1 FROM metrics_daily LIMIT 1").fetchone() or not conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+                return
+            conn.execute(
+                "INSERT OR IGNORE INTO checkpoints(name, last_id, until_id) SELECT 'metrics_backfill', 0, MAX(id) FROM messages"
+            )
+    finally:
+        conn.close()
+
+# id: next_row_id() (NULL unsharded: AUTOINCREMENT)
+MESSAGE_INSERT_SQL = (
+    "INSERT INTO messages(id, thread_id, platform, sender_type, sender_name, content, intent, confidence, is_auto, created_at, "
+    "external_message_id, reply_to) VALUES (?,?,?,?,?,?,?,?,?,COALESCE(?, strftime('%Y-%m-%dT%H:%M:%fZ','now')),?,?)"
+)
+
+def insert_message(uow: UnitOfWork, thread_id: int, ext_id: str, platform: str, role: str, user: str, text: str, reply_to: Optional[str] = None, intent: Optional[str] = None, confidence: Optional[float] = None, is_auto: bool = False, created_at: Optional[str] = None, response_ms: Optional[float] = None,
+                   external_message_id: Optional[str] = None) -> dict:
+    """
+    role: 'user' or 'system' (UI expects this)
+    ext_id: thread external id, already known to the caller (no re-resolve)
+    reply_to: for replies, the inbound message id (stored in messages.reply_to)
+    created_at: original timestamp for backfills (default: now)
+    external_message_id: platform message id / idempotency key of an inbound (unique per platform)
+    response_ms: for replies, time since the inbound arrived (-> metrics_daily.avg_response_ms)
+    Published to HUB once the transaction commits.
+    """
+    sender_type = "user" if role == "user" else "system"
+    sender_name = user if sender_type == "user" else AUTO_USER
+    with SQL_TIMES.time("message.insert"):
+        cur = uow.conn.execute(
+            MESSAGE_INSERT_SQL,
+            (next_row_id(uow.conn, "messages", clock=True), thread_id, platform, sender_type, sender_name, text, intent, confidence,
+             1 if is_auto else 0, created_at, external_message_id, int(reply_to) if reply_to else None),
+        )
+    mid = int(cur.lastrowid)
+    record_message_metrics(uow, platform, sender_type, intent, day=created_at[:10] if created_at else None, response_ms=response_ms)
+
+    # Provide the shape expected by the front-end (index.html normMsg)
+    msg = {
+        "id": str(mid),
+        "seq": mid,
+        "thread_id": ext_id,
+        "platform": platform,
+        "role": role,
+        "user": user,
+        "text": text,
+        "timestamp": created_at or _utc_iso(),
+        "typing": False,
+        "client_only": False,
+        "reply_to": reply_to,
+    }
+    uow.on_commit(lambda: HUB.publish_message(msg))
+    return msg
+
+# =========================
+# Rule engine
+# =========================
+
+KW = {
+  "catalog": ["catalogo","catálogo","productos","producto","que vendes","qué vendes","que venden","qué venden","vendes","venden","tenes","tenés","tienen",
+              "mochila","mochilas","remera","remeras","calzado","zapatilla","zapatillas","zapatos","zapatito","remera","remeritas"],
+  "price": ["precio","costo","vale","cuanto","cuánto","valor"],
+  "hours": ["horario","horarios","abren","cierran","atienden","atencion","atención"],
+  "shipping": ["envio","envío","delivery","envian","envían","envío a domicilio"],
+  "refund": ["reembolso","devolucion","devolución","me cobraron","cobro","cobrar","cargo","duplicado"],
+  "account": ["contraseña","contrasena","codigo","código","bloqueo","bloqueada","no puedo entrar","login","iniciar sesion","iniciar sesión"],
+  "status": ["estado","novedades","tarda","proceso","tramite","trámite","seguimiento"]
+}
+
+SLOTS = {
+  "catalog": ["categoria"],
+  "shipping": ["direccion", "zona"],
+  "refund": ["numero_orden", "monto"],
+  "account": ["email_o_telefono"]
+}
+
+RESP = {
+  "price": [
+    "Nuestros precios varían según el producto. ¿Qué artículo te interesa?",
+    "¡Claro! Decime qué producto estás buscando y te paso el precio.",
+  ],
+  "hours": [
+    "Atendemos de lunes a viernes de 8:00 a 18:00. ¿En qué te ayudo?",
+    "Nuestro horario es 8:00–18:00 (L–V). ¿Querés que te asesore con algo específico?",
+  ],
+  "shipping": [
+    "Hacemos envíos. ¿Me pasás tu dirección y zona para cotizar tiempo de entrega?",
+    "Sí, enviamos a domicilio. ¿Cuál es tu dirección y zona?",
+  ],
+  "refund": [
+    "Entiendo. Para ayudarte con el reembolso necesito el número de orden y el monto.",
+    "Vamos a resolverlo. Pasame número de orden y monto para verificar el cobro.",
+  ],
+  "account": [
+    "Te ayudo con el acceso. ¿Me confirmás tu email o teléfono asociado a la cuenta?",
+    "Entendido. Necesito tu email o teléfono para revisar el ingreso.",
+  ],
+  "status": [
+    "Puedo revisar el estado. ¿Tenés un número de caso/orden para ubicarlo?",
+    "Dale, ¿me pasás el número de caso/orden para ver el estado?",
+  ],
+  "fallback": [
+    "Gracias por tu mensaje. Un agente te responderá pronto. ¿Podés darme un poco más de detalle?",
+    "Recibido. ¿Me contás un poco más para ayudarte mejor?",
+  ]
+}
+
+# Canonical catalog categories and the user words that map to them (order = precedence)
+CATEGORY_KW = {
+  "mochilas": ["mochila", "mochilas", "backpack"],
+  "remeras": ["remera", "remeras", "camiseta", "camisetas", "remerita", "remeritas"],
+  "calzado": ["calzado", "zapatilla", "zapatillas", "zapato", "zapatos", "zapatito", "zapatitos"],
+}
+
+# Cheap keyword gates for slot extractors (regex only runs when a gate matched)
+SLOT_KW = {
+  "numero_orden": ["orden", "order", "pedido"],
+  "email_o_telefono": ["@"],
+}
+
+Label = Tuple[str, str, Any]  # (kind, value, rank): kind in intent/category/slot, lower rank wins (ints, or (priority, id) for rules)
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over pre-normalized keywords.
+
+    One scan over norm_text(text) reports every label whose keyword occurs as a
+    substring (same semantics as `norm_text(kw) in t`), so the cost depends on
+    the text length, not on how many keywords are loaded."""
+
+    def __init__(self, patterns: List[Tuple[str, Label]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[Label, ...]] = [()]
+        for kw, label in patterns:
+            kw = norm_text(kw)
+            if not kw:
+                continue
+            state = 0
+            for ch in kw:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({}); self._fail.append(0); self._out.append(())
+                state = nxt
+            if label not in self._out[state]:
+                self._out[state] += (label,)
+
+        # BFS: failure links + output sets merged along them
+        pending = list(self._goto[0].values())
+        while pending:
+            state = pending.pop(0)
+            for ch, nxt in self._goto[state].items():
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                fn = self._goto[f].get(ch, 0)
+                self._fail[nxt] = fn if fn != nxt else 0
+                self._out[nxt] += tuple(l for l in self._out[self._fail[nxt]] if l not in self._out[nxt])
+                pending.append(nxt)
+
+    def scan(self, text_norm: str) -> "TextMatch":
+        goto, fail, out = self._goto, self._fail, self._out
+        hits = set()
+        state = 0
+        for ch in text_norm:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                hits.update(out[state])
+        return TextMatch(text_norm, hits)
+
+@dataclass
+class TextMatch:
+    text_norm: str
+    hits: set = field(default_factory=set)
+
+    def _best(self, kind: str) -> Optional[str]:
+        ranked = [(rank, value) for k, value, rank in self.hits if k == kind]
+        return min(ranked)[1] if ranked else None
+
+    def intent(self) -> Tuple[str, float]:
+        best = self._best("intent")
+        return (best, 0.85) if best else ("fallback", 0.35)
+
+    def category(self) -> Optional[str]:
+        return self._best("category")
+
+    def has_slot(self, slot: str) -> bool:
+        return any(k == "slot" and v == slot for k, v, _ in self.hits)
+
+def table_version(conn: sqlite3.Connection, table: str) -> int:
+    """Write counter of a table (table_versions, bumped by ensure_table_version's triggers)."""
+    row = conn.execute("SELECT version FROM table_versions WHERE name = ?", (table,)).fetchone()
+    return int(row[0]) if row else 0
+
+def ensure_table_version(conn: sqlite3.Connection, table: str) -> None:
+    """table_versions row for `table` plus triggers bumping it on every insert,
+    update and delete: caches compare one integer, whatever column changed."""
+    conn.execute("CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("INSERT OR IGNORE INTO table_versions(name) VALUES (?)", (table,))
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_a{event[0].lower()}_version AFTER {event} ON {table} "
+            f"BEGIN UPDATE table_versions SET version = version + 1 WHERE name = '{table}'; END"
+        )
+
+def ensure_rules_version() -> None:
+    """Lightweight migration: rules edits (enabled, priority, keywords...) bump
+    table_versions, so MATCHER reloads without relying on updated_at."""
+    conn = _connect()
+    try:
+        with conn:
+            ensure_table_version(conn, "rules")
+    finally:
+        conn.close()
+
+def rules_version(conn: sqlite3.Connection) -> int:
+    """Cheap change signature for the rules table (any write bumps it)."""
+    return table_version(conn, "rules")
+
+def ensure_rules() -> None:
+    """Seed the rules table from KW (one rule per intent, KW order = priority). Idempotent."""
+    conn = _connect()
+    try:
+        with conn:
+            if conn.execute("SELECT COUNT(*) FROM rules").fetchone()[0] == 0:
+                conn.executemany(
+                    "INSERT INTO rules(intent, keywords_json, priority, enabled) VALUES (?,?,?,1)",
+                    [(intent, json.dumps(kws, ensure_ascii=False), (i + 1) * 10) for i, (intent, kws) in enumerate(KW.items())],
+                )
+    finally:
+        conn.close()
+
+def build_matcher(conn: Optional[sqlite3.Connection]) -> KeywordMatcher:
+    patterns: List[Tuple[str, Label]] = []
+    rows = []
+    if conn is not None:
+        rows = conn.execute(
+            "SELECT id, intent, keywords_json, priority FROM rules WHERE enabled=1 ORDER BY priority ASC, id ASC"
+        ).fetchall()
+    if rows:
+        for r in rows:
+            try:
+                kws = json.loads(r["keywords_json"] or "[]")
+            except Exception:
+                kws = []
+            # rank (priority, id): equal priorities fall back to the lower rule id, as in the query
+            patterns += [(str(kw), ("intent", str(r["intent"]), (int(r["priority"]), int(r["id"])))) for kw in kws]
+    else:
+        for i, (intent, kws) in enumerate(KW.items()):
+            patterns += [(kw, ("intent", intent, ((i + 1) * 10, i))) for kw in kws]
+    for i, (cat, kws) in enumerate(CATEGORY_KW.items()):
+        patterns += [(kw, ("category", cat, i)) for kw in kws]
+    for slot, kws in SLOT_KW.items():
+        patterns += [(kw, ("slot", slot, 0)) for kw in kws]
+    return KeywordMatcher(patterns)
+
+class VersionedCache:
+    """Process-wide object built from DB tables, rebuilt when version_fn(conn)
+    changes. The version is checked at most every `reload_s` seconds."""
+
+    def __init__(self, version_fn: Callable[[sqlite3.Connection], Any], build_fn: Callable[[sqlite3.Connection], Any], reload_s: float, name: str = "cache"):
+        self.name = name
+        self._version_fn = version_fn
+        self._build_fn = build_fn
+        self.reload_s = reload_s
+        self._lock = threading.Lock()
+        self._value: Any = None
+        self._version: Any = None
+        self._checked = 0.0
+
+    def get(self, conn: Optional[sqlite3.Connection] = None) -> Any:
+        now = time.monotonic()
+        if self._value is not None and now - self._checked < self.reload_s:
+            return self._value
+        with self._lock:
+            if self._value is not None and now - self._checked < self.reload_s:
+                return self._value
+            own = conn is None
+            conn = conn or db()
+            try:
+                with SQL_TIMES.time(f"{self.name}.version"):
+                    version = self._version_fn(conn)
+                if self._value is None or version != self._version:
+                    with SQL_TIMES.time(f"{self.name}.build"):
+                        self._value = self._build_fn(conn)
+                    self._version = version
+            finally:
+                if own:
+                    conn.close()
+            self._checked = now
+            return self._value
+
+    def invalidate(self) -> None:
+        self._checked = 0.0
+        self._version = None
+
+MATCHER = VersionedCache(rules_version, build_matcher, RULES_RELOAD_S, name="rules")
+
+def home_conn(conn: Optional[sqlite3.Connection]) -> Optional[sqlite3.Connection]:
+    """`conn` if it is on shard 0 (rules, products), else None: the cache opens its own."""
+    return conn if getattr(conn, "shard", 0) == 0 else None
+
+def match_text(text: str, conn: Optional[sqlite3.Connection] = None) -> TextMatch:
+    return MATCHER.get(conn).scan(norm_text(text))
+
+def classify(text: str, match: Optional[TextMatch] = None) -> Tuple[str, float]:
+    return (match or match_text(text)).intent()
+
+def extract(text: str, intent: str, match: Optional[TextMatch] = None) -> Dict[str, str]:
+    # MVP: very light extraction; extend later
+    t = (text or "").strip()
     out: Dict[str, str] = {}
+    if intent in ("catalog", "refund", "account"):
+        match = match or match_text(t)
     if intent == "catalog":
-        tn = norm_text(t)
         # detect category from message (mochilas / remeras / calzado)
-        if any(k in tn for k in ["mochila", "mochilas", "backpack"]):
-            out["categoria"] = "mochilas"
-        elif any(k in tn for k in ["remera", "remeras", "camiseta", "camisetas", "remerita", "remeritas"]):
-            out["categoria"] = "remeras"
-        elif any(k in tn for k in ["calzado", "zapatilla", "zapatillas", "zapato", "zapatos", "zapatito", "zapatitos"]):
-            out["categoria"] = "calzado"
+        cat = match.category()
+        if cat:
+            out["categoria"] = cat
     if intent == "refund":
-        m = re.search(r"(?:orden|order|pedido)\s*#?\s*([A-Za-z0-9\-]{4,})", t, re.I)
-        if m: out["numero_orden"] = m.group(1)
+        if match.has_slot("numero_orden"):
+            m = re.search(r"(?:orden|order|pedido)\s*#?\s*([A-Za-z0-9\-]{4,})", t, re.I)
+            if m: out["numero_orden"] = m.group(1)
         m2 = re.search(r"\$?\s*([0-9]+(?:\.[0-9]{1,2})?)", t)
         if m2: out["monto"] = m2.group(1)
     if intent == "shipping":
         if len(t) > 12:
             out["direccion"] = t[:80]
     if intent == "account":
-        m = re.search(r"[\w\.\-+]+@[\w\.\-]+\.\w+", t)
-        if m: out["email_o_telefono"] = m.group(0)
+        if match.has_slot("email_o_telefono"):
+            m = re.search(r"[\w\.\-+]+@[\w\.\-]+\.\w+", t)
+            if m: out["email_o_telefono"] = m.group(0)
     return out
 
-def detect_category(text: str) -> Optional[str]:
-    t = norm_text(text)
-    # Map many user words to canonical categories
-    cat_map = [
-        ("mochilas", ["mochila", "mochilas", "backpack"]),
-        ("remeras", ["remera", "remeras", "camiseta", "camisetas", "remerita", "remeritas"]),
-        ("calzado", ["calzado", "zapatilla", "zapatillas", "zapato", "zapatos", "zapatito", "zapatitos"]),
-    ]
-    for cat, kws in cat_map:
-        for kw in kws:
-            if norm_text(kw) in t:
-                return cat
-    return None
+def detect_category(text: str, match: Optional[TextMatch] = None) -> Optional[str]:
+    return (match or match_text(text)).category()
 
 def format_price(value: float, currency: str) -> str:
     try:
@@ -338,49 +1742,80 @@ def format_price(value: float, currency: str) -> str:
         return f"{int(round(v)):,}".replace(",", ".") + " Gs"
     return f"{v:.2f} {currency}".strip()
 
-def list_categories() -> List[str]:
-    conn = db()
-    try:
-        rows = conn.execute("SELECT DISTINCT category FROM products WHERE active=1 ORDER BY category ASC").fetchall()
-        return [str(r["category"]) for r in rows]
-    finally:
-        conn.close()
+class CatalogIndex:
+    """Immutable snapshot of the active catalog.
 
-def fetch_products(category: Optional[str] = None, text: Optional[str] = None, limit: int = 6) -> List[sqlite3.Row]:
-    conn = db()
-    try:
-        if category:
-            return conn.execute(
-                "SELECT id, name, category, price, currency, stock FROM products WHERE active=1 AND category=? ORDER BY stock DESC, id ASC LIMIT ?",
-                (category, limit),
-            ).fetchall()
-        # If no category, do a soft search over keywords/name
-        if text:
-            t = norm_text(text)
-            rows = conn.execute(
-                "SELECT id, name, category, price, currency, stock, keywords_json FROM products WHERE active=1"
-            ).fetchall()
-            hits = []
-            for r in rows:
-                name_n = norm_text(r["name"])
+    - by_category: ids pre-sorted by (stock DESC, id)
+    - matcher: Aho-Corasick over pre-normalized names/keywords -> product ids
+      (same substring semantics as the old per-row scan, one pass over the text)
+    - rendered render_product_list() replies, cached per (category, limit)"""
+
+    def __init__(self, rows: List[sqlite3.Row]):
+        self.products: Dict[int, sqlite3.Row] = {}
+        self.by_category: Dict[str, List[int]] = {}
+        patterns: List[Tuple[str, Label]] = []
+        for r in rows:  # already ordered by stock DESC, id ASC
+            pid = int(r["id"])
+            self.products[pid] = r
+            self.by_category.setdefault(str(r["category"]), []).append(pid)
+            try:
+                kws = json.loads(r["keywords_json"] or "[]")
+            except Exception:
                 kws = []
-                try:
-                    kws = json.loads(r["keywords_json"] or "[]")
-                except Exception:
-                    kws = []
-                if name_n and name_n in t:
-                    hits.append(r); continue
-                for kw in kws:
-                    if norm_text(str(kw)) in t:
-                        hits.append(r); break
-            return hits[:limit]
-        return []
-    finally:
-        conn.close()
+            for kw in [r["name"]] + list(kws):
+                patterns.append((str(kw), ("product", str(pid), pid)))
+        self.categories = sorted(self.by_category)
+        self.matcher = KeywordMatcher(patterns)
+        self._rendered: Dict[Tuple[Optional[str], int], str] = {}
+        self._lock = threading.Lock()
+
+    def in_category(self, category: str, limit: int) -> List[sqlite3.Row]:
+        return [self.products[pid] for pid in self.by_category.get(category, [])[:limit]]
+
+    def search(self, text: str, limit: int) -> List[sqlite3.Row]:
+        hits = self.matcher.scan(norm_text(text)).hits
+        ids = sorted(rank for kind, _, rank in hits if kind == "product")
+        return [self.products[pid] for pid in ids[:limit]]
+
+    def render_category(self, category: str, limit: int) -> str:
+        key = (category, limit)
+        out = self._rendered.get(key)
+        if out is None:
+            out = render_product_list(self, self.in_category(category, limit), category)
+            with self._lock:
+                self._rendered[key] = out
+        return out
+
+def catalog_version(conn: sqlite3.Connection) -> int:
+    """Change signature for products (any write bumps it: price, stock, active...)."""
+    return table_version(conn, "products")
+
+def build_catalog(conn: sqlite3.Connection) -> CatalogIndex:
+    rows = conn.execute(
+        "SELECT id, name, category, price, currency, stock, keywords_json FROM products WHERE active=1 ORDER BY stock DESC, id ASC"
+    ).fetchall()
+    return CatalogIndex(rows)
+
+CATALOG = VersionedCache(catalog_version, build_catalog, CATALOG_RELOAD_S, name="catalog")
 
-def render_product_list(rows: List[sqlite3.Row], category: Optional[str]) -> str:
+def _catalog(src: Any) -> CatalogIndex:
+    return src if isinstance(src, CatalogIndex) else CATALOG.get(src)
+
+def list_categories(conn: Any) -> List[str]:
+    return list(_catalog(conn).categories)
+
+def fetch_products(conn: Any, category: Optional[str] = None, text: Optional[str] = None, limit: int = 6) -> List[sqlite3.Row]:
+    cat = _catalog(conn)
+    if category:
+        return cat.in_category(category, limit)
+    # If no category, do a soft search over keywords/name
+    if text:
+        return cat.search(text, limit)
+    return []
+
+def render_product_list(conn: Any, rows: List[sqlite3.Row], category: Optional[str]) -> str:
     if not rows:
-        cats = list_categories()
+        cats = list_categories(conn)
         cats_txt = ", ".join(cats) if cats else "mochilas, remeras, calzado"
         return f"No encontré productos para esa búsqueda. ¿Te interesa alguna de estas categorías: {cats_txt}?"
     lines = []
@@ -403,13 +1838,24 @@ def pick_response(intent: str) -> str:
     options = RESP.get(intent) or RESP["fallback"]
     return random.choice(options)
 
-def respond(thread_db_id: int, platform: str, user: str, text: str) -> Tuple[str, str, float]:
+def respond(uow: UnitOfWork, thread_db_id: int, platform: str, user: str, text: str) -> Tuple[str, str, float]:
     """
     Returns (response_text, intent, confidence)
-    Persists state per thread in threads.tags._state
+    Persists state per thread (threads.state_json) when `uow` commits
     """
-    state = load_thread_state(thread_db_id) or {}
-    intent, conf = classify(text)
+    STATE.lock(uow, thread_db_id)
+    state = load_thread_state(uow.conn, thread_db_id) or {}
+    out, intent, conf = decide_reply(uow.conn, state, text)
+    save_thread_state(uow, thread_db_id, state)
+    return out, intent, conf
+
+def decide_reply(conn: sqlite3.Connection, state: Dict[str, Any], text: str) -> Tuple[str, str, float]:
+    """The rule engine proper: reads only; updates `state` (intent, slots) in place.
+    Returns (response_text, intent, confidence)."""
+    t0 = time.perf_counter()
+    conn = home_conn(conn)
+    match = match_text(text, conn)  # single pass: intents, category, slot gates
+    intent, conf = classify(text, match)
     slots = state.get("slots", {}) if isinstance(state.get("slots"), dict) else {}
 
     # If previously in an intent flow, stick to it unless new intent strong
@@ -418,7 +1864,8 @@ def respond(thread_db_id: int, platform: str, user: str, text: str) -> Tuple[str
         intent = prev_intent
 
     # Extract slots and update state
-    extracted = extract(text, intent)
+    extracted = extract(text, intent, match)
+    STAGE_TIMES.since("classify", t0)
     slots.update(extracted)
     state["intent"] = intent
     state["slots"] = slots
@@ -427,16 +1874,13 @@ def respond(thread_db_id: int, platform: str, user: str, text: str) -> Tuple[str
     if intent == "catalog":
         cat = slots.get("categoria")
         if not cat:
-            cats = list_categories()
+            cats = list_categories(CATALOG.get(conn))
             cats_txt = ", ".join(cats) if cats else "mochilas, remeras, calzado"
             out = f"¡Claro! Ahora mismo tenemos estas categorías: {cats_txt}. ¿Cuál te interesa?"
-            save_thread_state(thread_db_id, state)
             return out, intent, conf
 
-        # Fetch products for the selected category (or search within message)
-        rows = fetch_products(category=cat, text=text, limit=8)
-        out = render_product_list(rows, cat)
-        save_thread_state(thread_db_id, state)
+        # Products for the selected category (rendered reply is cached per category)
+        out = CATALOG.get(conn).render_category(cat, limit=8)
         return out, intent, conf
 
     missing = next_missing(intent, state)
@@ -451,131 +1895,2001 @@ def respond(thread_db_id: int, platform: str, user: str, text: str) -> Tuple[str
             "categoria": "¿Qué categoría te interesa? (mochilas / remeras / calzado)",
         }
         out = prompts.get(missing, "¿Me pasás ese dato para ayudarte?")
-        save_thread_state(thread_db_id, state)
         return out, intent, conf
 
     # Final response
     out = pick_response(intent)
-    save_thread_state(thread_db_id, state)
     return out, intent, conf
 
 # =========================
-# Routes
+# Schema migrations
 # =========================
 
-@app.route("/")
-def index():
-    return render_template("index.html")
-
-@app.route("/api/messages")
-def api_messages():
-    # Return most recent messages (cap) in the format expected by the UI.
-    conn = db()
+def apply_base_schema(shard: int = 0) -> None:
+    """oneinbox_schema.sql on a new (empty) file. A DB created before versioning
+    already has the tables; the steps after this one upgrade it."""
+    conn = _connect(shard=shard)
     try:
-        rows = conn.execute(
-            "SELECT m.id, m.platform, m.sender_type, m.sender_name, m.content, m.intent, m.confidence, m.is_auto, m.created_at, t.external_thread_id "
-            "FROM messages m JOIN threads t ON t.id = m.thread_id "
-            "ORDER BY m.id DESC LIMIT ?",
-            (MSG_CAP,),
-        ).fetchall()
-    finally:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone():
+            return
+        if not os.path.exists(SCHEMA_PATH):
+            raise FileNotFoundError("Missing schema file: oneinbox_schema.sql")
+        with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+            conn.executescript(f.read())
+        conn.commit()
+    finally:
         conn.close()
 
-    msgs = []
-    # Reverse to chronological order
-    for r in reversed(rows):
-        role = "user" if r["sender_type"] == "user" else "system"
-        # For system/bot messages, UI uses AUTO_USER; keep sender_name for user
-        user = r["sender_name"] if role == "user" else AUTO_USER
-        msgs.append({
-            "id": str(r["id"]),
-            "seq": int(r["id"]),
-            "thread_id": str(r["external_thread_id"] or ""),
-            "platform": str(r["platform"]),
-            "role": role,
-            "user": user,
-            "text": str(r["content"] or ""),
-            "timestamp": str(r["created_at"] or _utc_iso()),
-            "typing": False,
-            "client_only": False,
-        })
+# Ordered steps, numbered from 1: a shard file at PRAGMA user_version = n has
+# the first n applied. Append new steps (indexes, columns...) at the end; never
+# reorder or remove one. Steps are idempotent, so a pre-versioning DB (version
+# 0 with tables) runs them all once. home_only: shard 0 alone (rules, catalog).
+MIGRATIONS: List[Tuple[str, Callable[[int], None], bool]] = [
+    ("base_schema", apply_base_schema, False),
+    ("thread_state_column", ensure_thread_state_column, False),
+    ("metrics_response_column", ensure_metrics_response_column, False),
+    ("message_keys", ensure_message_keys, False),
+    ("reply_jobs", ensure_reply_jobs, False),
+    ("rollups", ensure_rollups, False),
+    ("identity_indexes", ensure_identity_indexes, False),
+    ("thread_latest_message", ensure_thread_latest_message, False),
+    ("fts_external_content", ensure_fts_external_content, False),
+    ("products", lambda shard: ensure_products(), True),
+    ("rules", lambda shard: ensure_rules(), True),
+    ("metrics_backfill", ensure_metrics_backfill, False),
+    ("shard_count", ensure_shard_count, False),
+    ("rules_version", lambda shard: ensure_rules_version(), True),
+    ("products_version", lambda shard: ensure_products(), True),
+    ("thread_state_version", ensure_thread_state_version, False),
+    ("thread_platform_index", ensure_thread_platform_index, False),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
-    return jsonify({"messages": msgs})
+_SCHEMA_LOCK = threading.Lock()
+_schema_pid: Optional[int] = None  # process whose DB files were found current
 
-@app.route("/api/generate")
-def api_generate():
-    platform = random.choice(PLATFORMS)
-    user = random.choice([
-        "Sofía","Lucas","Valentina","Mateo","Camila","Diego","Ana","Bruno","María","Nico","Carla","Julián","Mica","Tomás","Paula","Fede","Mauri","Jime","Abi","Enzo","Gabi"
-    ])
-    seeds = [
-        "Hola", "Buenas", "Buen día", "Quiero comprar algo",
-        "¿Cuál es el precio?", "¿Horarios de atención?", "¿Tienen envío?",
-        "Me cobraron dos veces", "No puedo entrar a mi cuenta", "¿Hay stock?"
-    ]
-    text = random.choice(seeds)
+def schema_version(shard: int = 0) -> int:
+    """PRAGMA user_version of a shard file (0 if the file doesn't exist yet)."""
+    if not os.path.exists(shard_path(shard)):
+        return 0
+    conn = sqlite3.connect(shard_path(shard))
+    try:
+        return int(conn.execute("PRAGMA user_version").fetchone()[0])
+    finally:
+        conn.close()
+
+def check_shard_count() -> None:
+    """Refuse to run when a shard file was laid out for another ONEINBOX_SHARDS
+    (threads would be routed to the wrong file). Shard 0 always exists once
+    migrated, and every file records the same count."""
+    if not os.path.exists(shard_path(0)):
+        return
+    conn = sqlite3.connect(shard_path(0))
+    try:
+        row = conn.execute("SELECT value FROM storage_meta WHERE key = 'shards'").fetchone()
+    except sqlite3.OperationalError:  # not migrated yet: ensure_shard_count() scans instead
+        row = None
+    finally:
+        conn.close()
+    if row is not None and int(row[0]) != SHARDS:
+        raise RuntimeError(f"{shard_path(0)} was created with ONEINBOX_SHARDS={row[0]}, not {SHARDS}")
+
+@contextmanager
+def migration_lock() -> Iterator[None]:
+    """Exclusive lock on <DB_PATH>.migrate.lock, held across processes (flock;
+    msvcrt on Windows): concurrent starters wait, then find nothing to do."""
+    with open(DB_PATH + ".migrate.lock", "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # gives up after ~10 s: keep waiting
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def migrate() -> Dict[int, Tuple[int, int]]:
+    """Bring every shard file to SCHEMA_VERSION under migration_lock(). Each step
+    commits its number as user_version, so an interrupted run resumes at the
+    failed step. Then applies the storage profile's journal_mode: switching it
+    writes the file header, after which the schema's auto_vacuum = INCREMENTAL
+    would be ignored, so a new file gets its tables first. Returns
+    {shard: (version before, after)}."""
+    out: Dict[int, Tuple[int, int]] = {}
+    with migration_lock():
+        check_shard_count()
+        for shard in range(SHARDS):
+            before = schema_version(shard)
+            if before > SCHEMA_VERSION:
+                raise RuntimeError(f"{shard_path(shard)} is at schema version {before}, newer than this code ({SCHEMA_VERSION})")
+            for number, (name, step, home_only) in enumerate(MIGRATIONS, 1):
+                if number <= before:
+                    continue
+                if shard == 0 or not home_only:
+                    step(shard)
+                conn = _connect(shard=shard)
+                try:
+                    conn.execute(f"PRAGMA user_version = {number}")
+                finally:
+                    conn.close()
+            ensure_storage_profile(shard)
+            out[shard] = (before, SCHEMA_VERSION)
+    return out
+
+def ensure_schema() -> None:
+    """Once per process, before its first connection: read every shard's
+    user_version and the recorded shard count (no DDL when current). Behind:
+    migrate() when MIGRATE_MODE is "auto", else refuse to start."""
+    global _schema_pid
+    if _schema_pid == os.getpid():
+        return
+    with _SCHEMA_LOCK:
+        if _schema_pid == os.getpid():
+            return
+        check_shard_count()
+        behind = [shard for shard in range(SHARDS) if schema_version(shard) != SCHEMA_VERSION]
+        if behind:
+            if MIGRATE_MODE != "auto":
+                raise RuntimeError(f"schema of shard(s) {behind} is not at version {SCHEMA_VERSION}: run `flask --app app migrate`")
+            migrate()
+        _schema_pid = os.getpid()
+
+def create_app() -> Flask:
+    """App factory for WSGI servers (e.g. gunicorn 'app:create_app()'): checks
+    the schema version (migrating when ONEINBOX_MIGRATE=auto) before serving."""
+    ensure_schema()
+    return app
+
+# =========================
+# Pipeline
+# =========================
+
+class InboundKeyCache:
+    """Bounded LRU: (platform, external_message_id) -> (inbound, reply) payloads,
+    so a webhook retry storm is answered from memory. Misses fall back to one
+    probe of ux_messages_platform_external (+ one for the reply, found through
+    messages.reply_to within the inbound's thread). Entries are added only
+    after the storing transaction commits; a queued inbound is cached without
+    its reply until a lookup finds one."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[Tuple[str, str], Tuple[dict, Optional[dict]]]" = OrderedDict()
+        self.counters = {"hits": 0, "db_hits": 0, "misses": 0}
+
+    def lookup(self, conn: sqlite3.Connection, platform: str, key: str) -> Optional[Tuple[dict, Optional[dict]]]:
+        """The stored (inbound, reply) for a platform message id, or None if new."""
+        with self._lock:
+            hit = self._lru.get((platform, key))
+            if hit is not None:
+                self._lru.move_to_end((platform, key))
+        if hit is not None and hit[1] is not None:
+            self.counters["hits"] += 1
+            return hit
+        if hit is None:
+            with SQL_TIMES.time("message.by_external_id"):
+                row = conn.execute(MESSAGE_SELECT + "WHERE m.platform = ? AND m.external_message_id = ?", (platform, key)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            hit = (message_payload(row), None)
+        self.counters["db_hits"] += 1
+        inbound_id = int(hit[0]["seq"])
+        with SQL_TIMES.time("message.reply_to"):
+            row = conn.execute(
+                MESSAGE_SELECT + "JOIN messages i ON i.id = ? "
+                "WHERE m.thread_id = i.thread_id AND m.created_at >= i.created_at AND m.reply_to = i.id LIMIT 1",
+                (inbound_id,),
+            ).fetchone()
+        hit = (hit[0], message_payload(row) if row else None)
+        self.put(platform, key, hit)
+        return hit
+
+    def put(self, platform: str, key: str, value: Tuple[dict, Optional[dict]]) -> None:
+        with self._lock:
+            self._lru[(platform, key)] = value
+            self._lru.move_to_end((platform, key))
+            while len(self._lru) > INBOUND_KEY_CACHE_MAX:
+                self._lru.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters, cached=len(self._lru))
+
+INBOUND_KEYS = InboundKeyCache()
+
+def inbound_key(d: Any, headers: Any = None) -> Optional[str]:
+    """Platform message id / idempotency key of an inbound call: the
+    Idempotency-Key header, else external_message_id / message_id /
+    idempotency_key in the body. ValueError if too long."""
+    raw = headers.get("Idempotency-Key") if headers is not None else None
+    if not raw and isinstance(d, dict):
+        raw = d.get("external_message_id") or d.get("message_id") or d.get("idempotency_key")
+    key = str(raw).strip() if raw else ""
+    if len(key) > INBOUND_KEY_MAX_LEN:
+        raise ValueError(f"message id longer than {INBOUND_KEY_MAX_LEN} characters")
+    return key or None
+
+def is_duplicate_key(error: sqlite3.IntegrityError) -> bool:
+    """The violation is ux_messages_platform_external (a platform message id
+    stored already), not a stale cached identity."""
+    return "messages.external_message_id" in str(error)
+
+def process_inbound(conn: sqlite3.Connection, platform: str, user: str, text: str, source: str, key: Optional[str] = None) -> Tuple[dict, dict]:
+    """ingest -> classify -> respond -> persist -> events, as one atomic transaction.
+    Returns (inbound, system) payloads; nothing is visible if any stage fails.
+    key: platform message id (see accept_inbound); a stored one raises IntegrityError."""
+    started = time.perf_counter()
+    try:
+        result = _process_inbound(conn, platform, user, text, source, started, key)
+    except sqlite3.IntegrityError as e:
+        if is_duplicate_key(e):
+            raise  # the key is stored already: accept_inbound answers with it
+        # A cached identity may point at a thread deleted elsewhere (e.g. a clear
+        # in another worker): drop the cache and retry once from the DB.
+        IDENTITIES.clear()
+        result = _process_inbound(conn, platform, user, text, source, started, key)
+    MESSAGE_TIMES.since(source, started)
+    return result
+
+def _process_inbound(conn: sqlite3.Connection, platform: str, user: str, text: str, source: str, started: float, key: Optional[str]) -> Tuple[dict, dict]:
+    with UnitOfWork(conn) as uow:
+        t = time.perf_counter()
+        ids = ensure_customer_and_thread(uow, platform, user)
+        STAGE_TIMES.since("identity", t)
+        inbound, system = run_pipeline(uow, ids, platform, user, text, source, started=started, key=key)
+        if key:
+            uow.on_commit(lambda: INBOUND_KEYS.put(platform, key, (inbound, system)))
+        return inbound, system
+
+def run_pipeline(uow: UnitOfWork, ids: Tuple[int, int, str], platform: str, user: str, text: str, source: str, created_at: Optional[str] = None, started: Optional[float] = None,
+                 key: Optional[str] = None) -> Tuple[dict, dict]:
+    """Pipeline stages for one inbound message, on the caller's transaction.
+    `started` (perf_counter) is when the message arrived; defaults to now."""
+    started = started or time.perf_counter()
+    inbound = ingest_inbound(uow, ids, platform, user, text, source, created_at, key)
+    system = reply_inbound(uow, ids, platform, user, text, int(inbound["seq"]), started)
+    return inbound, system
+
+def ingest_inbound(uow: UnitOfWork, ids: Tuple[int, int, str], platform: str, user: str, text: str, source: str, created_at: Optional[str] = None,
+                   key: Optional[str] = None) -> dict:
+    """ingest + normalize: store the inbound message (with its platform message id, if any)."""
+    _, thread_db_id, ext_id = ids
+    t = time.perf_counter()
+    inbound = insert_message(uow, thread_db_id, ext_id, platform, "user", user, text, is_auto=False, created_at=created_at, external_message_id=key)
+    log_event(uow, thread_db_id, int(inbound["seq"]), "ingest", "ok", {"source": source})
+    t = STAGE_TIMES.since("ingest", t)
+    log_event(uow, thread_db_id, int(inbound["seq"]), "normalize", "ok", {"text_norm": norm_text(text)})
+    STAGE_TIMES.since("normalize", t)
+    return inbound
+
+def reply_inbound(uow: UnitOfWork, ids: Tuple[int, int, str], platform: str, user: str, text: str, inbound_id: int, started: float) -> dict:
+    """classify/respond + persist: run the bot on a stored inbound message and store its reply."""
+    t = time.perf_counter()
+    out, intent, conf = respond(uow, ids[1], platform, user, text)
+    STAGE_TIMES.since("respond", t)
+    return store_reply(uow, ids, platform, inbound_id, out, intent, conf, started)
+
+def store_reply(uow: UnitOfWork, ids: Tuple[int, int, str], platform: str, inbound_id: int, out: str, intent: str, conf: float, started: float) -> dict:
+    """persist: the bot's reply to `inbound_id`, plus its classify/respond/persist events."""
+    _, thread_db_id, ext_id = ids
+    t = time.perf_counter()
+    log_event(uow, thread_db_id, inbound_id, "classify", "ok", {"intent": intent, "confidence": conf})
+    response_ms = (t - started) * 1000.0
+    system = insert_message(uow, thread_db_id, ext_id, platform, "system", AUTO_USER, out, reply_to=str(inbound_id), intent=intent, confidence=conf, is_auto=True,
+                            response_ms=response_ms)
+    log_event(uow, thread_db_id, int(system["seq"]), "respond", "ok", {"intent": intent, "response_ms": round(response_ms, 3)})
+    log_event(uow, thread_db_id, int(system["seq"]), "persist", "ok", {})
+    STAGE_TIMES.since("persist", t)
+    return system
+
+# =========================
+# Reply queue (queued ingestion)
+# =========================
+
+REPLY_JOB_CLAIM_SQL = """
+UPDATE reply_jobs SET status = 'running', attempts = attempts + 1, locked_by = :worker, locked_at = :now
+WHERE id = (
+  SELECT j.id FROM reply_jobs j
+  WHERE j.status = 'queued' AND j.available_at <= :now
+    AND NOT EXISTS (SELECT 1 FROM reply_jobs p
+                    WHERE p.thread_id = j.thread_id AND p.id < j.id AND p.status IN ('queued', 'running'))
+  ORDER BY j.id LIMIT 1)
+RETURNING id, thread_id, message_id, attempts, created_at
+"""
+
+class ReplyQueue:
+    """Durable queue of pending bot replies (reply_jobs), drained by worker threads.
+
+    enqueue() adds a job in the inbound message's transaction, so the webhook
+    can ack as soon as that commits. Workers claim one job at a time; a thread's
+    jobs run in id order (a job waits while an older one of its thread is queued
+    or running, including a retry's backoff). The reply and the job's deletion
+    commit together. Failures are logged as 'error' events and retried with
+    backoff up to JOB_MAX_ATTEMPTS, then kept as 'failed'."""
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._cv = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._pid: Optional[int] = None
+        self._stop = threading.Event()
+        self.counters = {"enqueued": 0, "claimed": 0, "done": 0, "retried": 0, "exhausted": 0}
+
+    def enqueue(self, uow: UnitOfWork, thread_id: int, message_id: int) -> int:
+        with SQL_TIMES.time("job.insert"):
+            job_id = int(uow.conn.execute(
+                "INSERT INTO reply_jobs(thread_id, message_id, available_at, created_at) VALUES (?,?,?,?)",
+                (thread_id, message_id, _utc_iso_ms(), _utc_iso_ms()),
+            ).lastrowid)
+        uow.on_commit(self._enqueued)
+        return job_id
+
+    def _enqueued(self) -> None:
+        self.counters["enqueued"] += 1
+        self.ensure_started()
+        with self._cv:
+            self._cv.notify()
+
+    def has_work(self, conn: sqlite3.Connection) -> bool:
+        now = _utc_iso_ms()
+        return conn.execute(
+            "SELECT 1 FROM reply_jobs WHERE (status = 'queued' AND available_at <= ?) "
+            "OR (status = 'running' AND locked_at < ?) LIMIT 1",
+            (now, _utc_iso_ms(-JOB_LEASE_S)),
+        ).fetchone() is not None
+
+    def claim(self, conn: sqlite3.Connection, worker: str) -> Optional[sqlite3.Row]:
+        with UnitOfWork(conn) as uow:
+            # Leases of crashed workers expire back to 'queued' (attempt already counted)
+            uow.conn.execute(
+                "UPDATE reply_jobs SET status = 'queued', locked_by = NULL WHERE status = 'running' AND locked_at < ?",
+                (_utc_iso_ms(-JOB_LEASE_S),),
+            )
+            with SQL_TIMES.time("job.claim"):
+                job = uow.conn.execute(REPLY_JOB_CLAIM_SQL, {"worker": worker, "now": _utc_iso_ms()}).fetchone()
+        if job is not None:
+            self.counters["claimed"] += 1
+            JOB_TIMES.observe("wait", max(0.0, _age_s(job["created_at"])))
+        return job
+
+    def process(self, conn: sqlite3.Connection, job: sqlite3.Row) -> bool:
+        """Run the bot for a claimed job. Returns True when the reply was stored.
+
+        The rule engine runs before the write transaction, on a copy of the
+        thread state, so a slow reply never holds the write lock (webhook acks
+        wait only for short inserts). Inside the transaction the state is
+        re-read under the thread's lock; if something else changed it meanwhile
+        the reply is decided again from the current state."""
+        t0 = time.perf_counter()
+        try:
+            m = conn.execute(
+                "SELECT m.thread_id, m.platform, m.content, t.external_thread_id "
+                "FROM messages m JOIN threads t ON t.id = m.thread_id WHERE m.id = ?",
+                (job["message_id"],),
+            ).fetchone()
+            if m is not None:
+                tid = int(m["thread_id"])
+                seen = load_thread_state(conn, tid) or {}
+                state = copy.deepcopy(seen)
+                reply = decide_reply(conn, state, m["content"])
+                STAGE_TIMES.since("respond", t0)
+            with UnitOfWork(conn) as uow:
+                if m is not None:
+                    STATE.lock(uow, tid)
+                    current = load_thread_state(uow.conn, tid) or {}
+                    if current != seen:
+                        state = current
+                        reply = decide_reply(uow.conn, state, m["content"])
+                    save_thread_state(uow, tid, state)
+                    started = t0 - max(0.0, _age_s(job["created_at"]))  # arrival, on the perf_counter clock
+                    store_reply(uow, (0, tid, m["external_thread_id"]), m["platform"], int(job["message_id"]), *reply, started)
+                uow.conn.execute("DELETE FROM reply_jobs WHERE id = ?", (job["id"],))
+        except Exception as e:
+            self._failed(conn, job, e)
+            return False
+        self.counters["done"] += 1
+        JOB_TIMES.since("process", t0)
+        return True
+
+    def _failed(self, conn: sqlite3.Connection, job: sqlite3.Row, error: BaseException) -> None:
+        attempt = int(job["attempts"])
+        final = attempt >= JOB_MAX_ATTEMPTS
+        details: Dict[str, Any] = {"job_id": job["id"], "attempt": attempt, "error": f"{type(error).__name__}: {error}"}
+        try:
+            with UnitOfWork(conn) as uow:
+                if final:
+                    uow.conn.execute(
+                        "UPDATE reply_jobs SET status = 'failed', locked_by = NULL, last_error = ? WHERE id = ?",
+                        (details["error"], job["id"]),
+                    )
+                else:
+                    delay = JOB_RETRY_BASE_S * 2 ** (attempt - 1)
+                    details["retry_in_s"] = delay
+                    uow.conn.execute(
+                        "UPDATE reply_jobs SET status = 'queued', locked_by = NULL, last_error = ?, available_at = ? WHERE id = ?",
+                        (details["error"], _utc_iso_ms(delay), job["id"]),
+                    )
+                log_event(uow, int(job["thread_id"]), int(job["message_id"]), "error", "error", dict(details, final=final))
+        except sqlite3.Error:
+            pass  # the lease expires and the job is retried
+        self.counters["exhausted" if final else "retried"] += 1
+
+    def run_once(self, conn: sqlite3.Connection, worker: str = "inline") -> bool:
+        """Claim and process one job if any is ready (CLI, tests). Returns whether one ran."""
+        job = self.claim(conn, worker)
+        if job is None:
+            return False
+        self.process(conn, job)
+        return True
+
+    def depth(self, conns: Sequence[sqlite3.Connection]) -> Dict[str, Any]:
+        """Jobs per status and the oldest queued job's age, over one connection per shard."""
+        out: Dict[str, Any] = {"queued": 0, "running": 0, "failed": 0}
+        oldest: List[str] = []
+        for conn in conns:
+            for r in conn.execute("SELECT status, COUNT(*) AS n FROM reply_jobs GROUP BY status"):
+                out[r["status"]] += r["n"]
+            row = conn.execute("SELECT MIN(created_at) FROM reply_jobs WHERE status = 'queued'").fetchone()
+            if row[0]:
+                oldest.append(row[0])
+        out["oldest_queued_s"] = round(max(0.0, _age_s(min(oldest))), 3) if oldest else 0.0
+        return out
+
+    def drain(self, timeout: float = 30.0) -> bool:
+        """Wait until no job is queued or running (failed ones stay). False on timeout."""
+        deadline = time.monotonic() + timeout
+        conns = [db(shard=shard) for shard in range(SHARDS)]
+        try:
+            while time.monotonic() < deadline:
+                d = self.depth(conns)
+                if not d["queued"] and not d["running"]:
+                    return True
+                if not self._threads:
+                    for conn in conns:
+                        self.run_once(conn)
+                else:
+                    time.sleep(0.02)
+            return False
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def stats(self, conns: Sequence[sqlite3.Connection]) -> Dict[str, Any]:
+        return dict(self.counters, workers=len(self._threads), **self.depth(conns))
+
+    def ensure_started(self) -> None:
+        if self.workers <= 0 or (self._threads and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._run, args=(f"{os.getpid()}-{i}",), name=f"reply-worker-{i}", daemon=True)
+                             for i in range(self.workers)]
+            for t in self._threads:
+                t.start()
+
+    def close(self, timeout: float = 5.0) -> None:
+        if not self._threads or self._pid != os.getpid():
+            return
+        self._stop.set()
+        with self._cv:
+            self._cv.notify_all()
+        for t in self._threads:
+            t.join(timeout / max(1, len(self._threads)))
+
+    def _run(self, worker: str) -> None:
+        conns = [db(shard=shard) for shard in range(SHARDS)]
+        try:
+            while not self._stop.is_set():
+                ran = False
+                for conn in conns:  # one job per shard per round: no shard starves the others
+                    try:
+                        if self.has_work(conn) and self.run_once(conn, worker):
+                            ran = True
+                    except Exception:
+                        pass  # e.g. locked by another process for longer than busy_timeout; retry after the poll
+                if ran:
+                    continue
+                with self._cv:
+                    self._cv.wait(JOB_POLL_S)
+        finally:
+            for conn in conns:
+                conn.close()
+
+REPLY_QUEUE = ReplyQueue(REPLY_WORKERS)
+atexit.register(REPLY_QUEUE.close)
+
+def enqueue_inbound(conn: sqlite3.Connection, platform: str, user: str, text: str, source: str, key: Optional[str] = None) -> Tuple[dict, int]:
+    """ingest -> normalize -> reply job, as one transaction; the bot runs on a worker.
+    Returns (inbound payload, job id)."""
+    def once() -> Tuple[dict, int]:
+        with UnitOfWork(conn) as uow:
+            t = time.perf_counter()
+            ids = ensure_customer_and_thread(uow, platform, user)
+            STAGE_TIMES.since("identity", t)
+            inbound = ingest_inbound(uow, ids, platform, user, text, source, key=key)
+            if key:
+                uow.on_commit(lambda: INBOUND_KEYS.put(platform, key, (inbound, None)))
+            return inbound, REPLY_QUEUE.enqueue(uow, ids[1], int(inbound["seq"]))
+
+    started = time.perf_counter()
+    try:
+        result = once()
+    except sqlite3.IntegrityError as e:
+        if is_duplicate_key(e):
+            raise
+        IDENTITIES.clear()  # see process_inbound
+        result = once()
+    JOB_TIMES.since("ack", started)
+    return result
+
+def accept_inbound(conn: sqlite3.Connection, platform: str, user: str, text: str, source: str, key: Optional[str], queued: bool) -> Tuple[Dict[str, Any], int]:
+    """api_send / api_webhook body and status. With a platform message id, a
+    retry is answered with the stored inbound and reply (`duplicate`) without
+    running the rule engine or storing anything; a concurrent retry that loses
+    the race on ux_messages_platform_external is answered the same way."""
+    dup = INBOUND_KEYS.lookup(conn, platform, key) if key else None
+    if dup is None:
+        try:
+            if queued:
+                inbound, job_id = enqueue_inbound(conn, platform, user, text, source, key)
+                return {"messages": [inbound], "job_id": job_id}, 202
+            inbound, system = process_inbound(conn, platform, user, text, source, key)
+            return {"messages": [inbound, system]}, 200
+        except sqlite3.IntegrityError as e:
+            dup = INBOUND_KEYS.lookup(conn, platform, key) if key and is_duplicate_key(e) else None
+            if dup is None:
+                raise
+    return {"messages": [m for m in dup if m is not None], "duplicate": True}, 200
+
+# =========================
+# Bulk ingestion
+# =========================
+
+def _parse_timestamp(value: Any) -> str:
+    """ISO 8601 -> the stored created_at format (UTC, milliseconds)."""
+    dt = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def parse_inbound(d: Any, strict: bool = False) -> Tuple[str, str, str, Optional[str]]:
+    """api_send fields -> (platform, user, text, created_at).
+    strict (bulk input): unknown platforms, empty text and bad timestamps raise
+    ValueError instead of being coerced, and so does a message id, since bulk
+    ingest does not deduplicate (send those through /api/send)."""
+    if not isinstance(d, dict):
+        raise ValueError("item must be a JSON object")
+    if strict and inbound_key(d):
+        raise ValueError("message_id is not supported in bulk ingest; use /api/send")
+    raw = str(d.get("platform") or d.get("app") or d.get("channel") or "whatsapp").lower()
+    if strict and raw not in PLATFORMS:
+        raise ValueError(f"unknown platform: {raw}")
+    platform = raw if raw in PLATFORMS else "whatsapp"
+
+    user = str(d.get("user_name") or d.get("user") or d.get("sender") or "Usuario").strip() or "Usuario"
+    text = str(d.get("message") or d.get("text") or d.get("content") or "").strip()
+    if strict and not text:
+        raise ValueError("empty message")
+
+    created_at = None
+    ts = d.get("timestamp") or d.get("created_at")
+    if strict and ts:
+        created_at = _parse_timestamp(ts)
+    return platform, user, text, created_at
+
+def iter_jsonl(lines: Iterable[Any]) -> Iterator[Any]:
+    """Yields one parsed object per non-blank line, or a ValueError for bad lines."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"invalid JSON: {e}")
+
+def resolve_identities(uow: UnitOfWork, keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple[int, int, str]]:
+    """Bulk ensure_customer_and_thread: cache first, then one indexed
+    row-value IN query per 400 keys, creating only what is still missing."""
+    out: Dict[Tuple[str, str], Tuple[int, int, str]] = {}
+    misses: List[Tuple[str, str]] = []
+    for key in dict.fromkeys(keys):
+        hit = IDENTITIES.get(key)
+        if hit is not None:
+            out[key] = hit
+        else:
+            misses.append(key)
+
+    found: List[Tuple[Tuple[str, str], Tuple[int, int, str]]] = []
+    for i in range(0, len(misses), 400):
+        part = misses[i:i + 400]
+        rows = uow.conn.execute(
+            "SELECT ci.platform, ci.platform_user_id, ci.customer_id, t.id AS thread_id, t.external_thread_id "
+            "FROM customer_identities ci JOIN threads t "
+            "ON t.platform = ci.platform AND t.external_thread_id = ci.platform || ':' || ci.platform_user_id "
+            f"WHERE (ci.platform, ci.platform_user_id) IN (VALUES {','.join(['(?,?)'] * len(part))})",
+            [v for key in part for v in key],
+        ).fetchall()
+        for r in rows:
+            key = (str(r["platform"]), str(r["platform_user_id"]))
+            value = (int(r["customer_id"]), int(r["thread_id"]), str(r["external_thread_id"]))
+            out[key] = value
+            found.append((key, value))
+    uow.on_commit(lambda: [IDENTITIES.put(k, v) for k, v in found])
+
+    for key in misses:
+        if key not in out:
+            out[key] = ensure_customer_and_thread(uow, key[0], key[1])
+    return out
+
+@dataclass
+class BatchReport:
+    accepted: int = 0
+    replies: int = 0
+    rejected: int = 0
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    first_seq: Optional[int] = None
+    last_seq: Optional[int] = None
+    started: float = field(default_factory=time.perf_counter)
+
+    def reject(self, index: int, error: Any) -> None:
+        self.rejected += 1
+        if len(self.errors) < BATCH_MAX_ERRORS:
+            self.errors.append({"index": index, "error": str(error)})
+
+    def as_dict(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        return {
+            "accepted": self.accepted, "replies": self.replies, "rejected": self.rejected, "errors": self.errors,
+            "first_seq": self.first_seq, "last_seq": self.last_seq,
+            "elapsed_s": round(elapsed, 3), "msgs_per_s": round(self.accepted / elapsed, 1) if elapsed > 0 else None,
+        }
+
+def ingest_batch(conn: sqlite3.Connection, items: Iterable[Any], respond_each: bool = False, chunk_size: int = BATCH_CHUNK, source: str = "batch") -> BatchReport:
+    """Ingest many api_send-shaped items, one transaction per `chunk_size` items.
+
+    Without respond_each, inbound rows, 'ingest' events and metrics are written
+    with executemany (no rule engine). With respond_each every item runs the full
+    pipeline, in input order. Invalid items are rejected and reported by index;
+    a chunk that fails as a whole is rejected with its error. Sharded: each
+    chunk is split by thread shard (one transaction per shard); connections to
+    shards other than `conn`'s are opened here."""
+    report = BatchReport()
+    conns = {getattr(conn, "shard", 0): conn}
+
+    def flush(chunk: List[Tuple[int, Tuple[str, str, str, Optional[str]]]]) -> None:
+        by_shard: Dict[int, List[Tuple[int, Tuple[str, str, str, Optional[str]]]]] = {}
+        for entry in chunk:
+            platform, user = entry[1][0], entry[1][1]
+            by_shard.setdefault(shard_for(thread_external_id(platform, user)), []).append(entry)
+        for shard, part in sorted(by_shard.items()):
+            if shard not in conns:
+                conns[shard] = db(shard=shard)
+            _ingest_chunk_safe(conns[shard], part, respond_each, source, report)
+
+    chunk: List[Tuple[int, Tuple[str, str, str, Optional[str]]]] = []
+    try:
+        for index, item in enumerate(items):
+            if isinstance(item, Exception):
+                report.reject(index, item)
+                continue
+            try:
+                chunk.append((index, parse_inbound(item, strict=True)))
+            except ValueError as e:
+                report.reject(index, e)
+                continue
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    finally:
+        for shard, c in conns.items():
+            if c is not conn:
+                c.close()
+    return report
+
+def _ingest_chunk_safe(conn: sqlite3.Connection, chunk: List[Tuple[int, Tuple[str, str, str, Optional[str]]]], respond_each: bool, source: str, report: BatchReport) -> None:
+    for attempt in (0, 1):
+        try:
+            _ingest_chunk(conn, chunk, respond_each, source, report)
+            return
+        except sqlite3.IntegrityError as e:
+            IDENTITIES.clear()  # stale cached ids: retry once from the DB
+            error: Exception = e
+        except sqlite3.Error as e:
+            error = e
+            break
+    for index, _ in chunk:
+        report.reject(index, error)
+
+def _ingest_chunk(conn: sqlite3.Connection, chunk: List[Tuple[int, Tuple[str, str, str, Optional[str]]]], respond_each: bool, source: str, report: BatchReport) -> None:
+    with UnitOfWork(conn) as uow:
+        ids = resolve_identities(uow, [(p, u) for _, (p, u, _, _) in chunk])
+
+        if respond_each:
+            # Take the per-thread state locks up front, in a fixed order
+            STATE.lock_many(uow, (ids[(p, u)][1] for _, (p, u, _, _) in chunk))
+            seqs: List[int] = []
+            for _, (platform, user, text, created_at) in chunk:
+                inbound, system = run_pipeline(uow, ids[(platform, user)], platform, user, text, source, created_at)
+                seqs += [inbound["seq"], system["seq"]]
+            replies = len(chunk)
+        else:
+            first = next_row_id(uow.conn, "messages", clock=True)
+            rows = [(None if first is None else first + i * SHARDS, ids[(p, u)][1], p, "user", u, text, None, None, 0, ts, None, None)
+                    for i, (_, (p, u, text, ts)) in enumerate(chunk)]
+            uow.conn.executemany(MESSAGE_INSERT_SQL, rows)
+            if first is None:
+                # One writer (BEGIN IMMEDIATE) + AUTOINCREMENT: the chunk got consecutive ids
+                last = int(uow.conn.execute("SELECT last_insert_rowid()").fetchone()[0])
+                seqs = list(range(last - len(rows) + 1, last + 1))
+            else:
+                seqs = [r[0] for r in rows]
+            details = json.dumps({"source": source}, ensure_ascii=False)
+            now = _utc_iso_ms()
+            uow.conn.executemany(EVENT_INSERT_SQL, [(r[1], mid, "ingest", "ok", details, now) for r, mid in zip(rows, seqs)])
+
+            groups: Dict[Tuple[str, str], int] = {}
+            for r in rows:
+                key = ((r[9] or now)[:10], r[2])
+                groups[key] = groups.get(key, 0) + 1
+            for (day, platform), n in groups.items():
+                record_message_metrics(uow, platform, "user", None, day=day, n=n)
+            by_platform: Dict[str, int] = {}
+            for (_, platform), n in groups.items():
+                by_platform[platform] = by_platform.get(platform, 0) + n
+            uow.on_commit(lambda: HUB.publish("stats", dict(by_platform, total=len(rows))))
+            replies = 0
+
+    report.accepted += len(chunk)
+    report.replies += replies
+    if seqs:
+        report.first_seq = report.first_seq or min(seqs)
+        report.last_seq = max(report.last_seq or 0, max(seqs))
+
+# =========================
+# Retention (archive files) and reset
+# =========================
+
+ARCHIVE_COLUMNS = {
+    "messages": "id, thread_id, platform, sender_type, sender_name, content, intent, confidence, is_auto, created_at, external_message_id, reply_to",
+    "automation_events": "id, thread_id, message_id, event_type, status, details_json, created_at",
+}
+
+ARCHIVE_DDL = """
+CREATE TABLE IF NOT EXISTS arch.messages (
+  id INTEGER PRIMARY KEY, thread_id INTEGER NOT NULL, platform TEXT NOT NULL, sender_type TEXT NOT NULL,
+  sender_name TEXT, content TEXT NOT NULL, intent TEXT, confidence REAL, is_auto INTEGER NOT NULL, created_at TEXT NOT NULL,
+  external_message_id TEXT, reply_to INTEGER
+);
+CREATE INDEX IF NOT EXISTS arch.ix_messages_thread_time ON messages(thread_id, created_at);
+CREATE TABLE IF NOT EXISTS arch.automation_events (
+  id INTEGER PRIMARY KEY, thread_id INTEGER NOT NULL, message_id INTEGER, event_type TEXT NOT NULL,
+  status TEXT NOT NULL, details_json TEXT, created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS arch.ix_automation_events_message ON automation_events(message_id);
+"""
+
+EVENT_TYPES = ("ingest", "normalize", "classify", "respond", "persist", "error")
+
+def archive_path(month: str, shard: int = 0) -> str:
+    """Archive file for a 'YYYY-MM' partition of a shard (ATTACH it to query old rows)."""
+    return os.path.join(ARCHIVE_DIR, f"oneinbox-{month}.db" if shard == 0 else f"oneinbox-{month}.shard{shard}.db")
+
+class _Archiver:
+    """Moves rows of one table into monthly archive files over one connection.
+
+    Per chunk: copy into the attached partition (a transaction on the archive
+    file only), then delete from main what the archive now holds (a short
+    UnitOfWork). WAL makes multi-file commits atomic per file only, so the two
+    steps are separate and idempotent: a crash in between leaves rows in both
+    places and the next pass finishes the move."""
+
+    def __init__(self, conn: sqlite3.Connection, chunk_size: int, report: Dict[str, Any]) -> None:
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.report = report
+        self.month: Optional[str] = None
+
+    def attach(self, month: str) -> None:
+        if month == self.month:
+            return
+        self.detach()
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        self.conn.execute("ATTACH DATABASE ? AS arch", (archive_path(month, getattr(self.conn, "shard", 0)),))
+        self.conn.executescript(ARCHIVE_DDL)
+        cols = {r["name"] for r in self.conn.execute("PRAGMA arch.table_info(messages)")}
+        for col, decl in (("external_message_id", "TEXT"), ("reply_to", "INTEGER")):
+            if col not in cols:  # partition written before these columns existed
+                self.conn.execute(f"ALTER TABLE arch.messages ADD COLUMN {col} {decl}")
+        self.month = month
+        if month not in self.report["partitions"]:
+            self.report["partitions"].append(month)
+
+    def detach(self) -> None:
+        if self.month is not None:
+            self.conn.execute("DETACH DATABASE arch")
+            self.month = None
+
+    def move(self, table: str, key_col: str, key: str, cutoff: str) -> None:
+        cols = ARCHIVE_COLUMNS[table]
+        while True:
+            # (key_col, created_at) is indexed for both tables
+            rows = self.conn.execute(
+                f"SELECT id, substr(created_at, 1, 7) AS month FROM {table} WHERE {key_col} = ? AND created_at < ? "
+                f"ORDER BY created_at LIMIT ?",
+                (key, cutoff, self.chunk_size),
+            ).fetchall()
+            if not rows:
+                return
+            by_month: Dict[str, List[int]] = {}
+            for r in rows:
+                by_month.setdefault(r["month"], []).append(r["id"])
+            for month, ids in sorted(by_month.items()):
+                self.attach(month)
+                marks = ",".join("?" * len(ids))
+                with self.conn:
+                    self.conn.execute(f"INSERT OR IGNORE INTO arch.{table}({cols}) SELECT {cols} FROM main.{table} WHERE id IN ({marks})", ids)
+                with UnitOfWork(self.conn) as uow:
+                    if table == "messages":
+                        uow.conn.execute(f"DELETE FROM reply_jobs WHERE message_id IN ({marks})", ids)
+                    n = uow.conn.execute(
+                        f"DELETE FROM main.{table} WHERE id IN ({marks}) AND id IN (SELECT id FROM arch.{table} WHERE id IN ({marks}))",
+                        ids + ids,
+                    ).rowcount
+                self.report[table] += n
+
+def run_retention(days: int, chunk_size: int = ARCHIVE_CHUNK, vacuum: bool = True) -> Dict[str, Any]:
+    """Archive messages and automation_events older than `days` into monthly
+    files under ARCHIVE_DIR, then FTS optimize and incremental vacuum.
+
+    Events go first, so deleting their messages never touches them. The
+    connection runs with foreign keys off: the per-row FK actions would scan
+    automation_events (no index on message_id); archived events keep their
+    message_id, which now points into the archive. metrics_daily keeps the
+    totals (and event_metrics_daily the event counts: the rollup catches up
+    first), so /api/stats still counts archived history. Shards are processed
+    one after another, each into its own partition files."""
+    started = time.perf_counter()
+    cutoff = _utc_iso_ms(-days * 86400.0)
+    report: Dict[str, Any] = {"cutoff": cutoff, "messages": 0, "automation_events": 0, "partitions": []}
+    run_rollup()  # count events before they leave the main file
+    for shard in range(SHARDS):
+        conn = db(shard=shard)
+        try:
+            conn.execute("PRAGMA foreign_keys = OFF")
+            moved = report["messages"]
+            arch = _Archiver(conn, chunk_size, report)
+            try:
+                for event_type in EVENT_TYPES:
+                    arch.move("automation_events", "event_type", event_type, cutoff)
+                for platform in PLATFORMS:
+                    arch.move("messages", "platform", platform, cutoff)
+            finally:
+                arch.detach()
+            if report["messages"] > moved:
+                with UnitOfWork(conn) as uow:
+                    uow.conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+                report["fts_optimized"] = True
+            if vacuum:
+                pages = incremental_vacuum(conn)
+                if pages is not None:
+                    report["vacuum_pages"] = report.get("vacuum_pages", 0) + pages
+                else:
+                    report.setdefault("vacuum_pages", None)
+        finally:
+            conn.close()
+    report["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return report
+
+def incremental_vacuum(conn: sqlite3.Connection) -> Optional[int]:
+    """Return free pages to the OS in VACUUM_STEP_PAGES steps (short write locks).
+    None when the DB was not created with auto_vacuum=INCREMENTAL."""
+    if int(conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+        return None
+    released = 0
+    while True:
+        free = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        if not free:
+            return released
+        with UnitOfWork(conn) as uow:
+            uow.conn.execute(f"PRAGMA incremental_vacuum({min(free, VACUUM_STEP_PAGES)})").fetchall()
+        left = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        if left >= free:
+            return released  # nothing released (e.g. pages still pinned by a reader)
+        released += free - left
+
+# Data tables emptied by /api/clear (rules and products stay)
+RESET_TABLES = ("automation_events", "reply_jobs", "messages", "messages_fts", "threads", "customer_identities", "customers", "metrics_daily",
+                "event_metrics_daily")
+
+def reset_store() -> None:
+    """Empty RESET_TABLES by dropping and recreating them from their own DDL
+    in sqlite_master (indexes, triggers and migrated columns included): cost
+    no longer grows with the rows, no per-row FTS or activity triggers fire.
+    AUTOINCREMENT counters are kept so ids (SSE/poll cursors) never go back.
+    One transaction per shard."""
+    for shard in range(SHARDS):
+        _reset_shard(shard)
+    STATS.reset()
+    STATE.clear()
+    IDENTITIES.clear()
+    INBOUND_KEYS.clear()
+    HUB.publish("clear", {})
+
+def _reset_shard(shard: int) -> None:
+    conn = db(shard=shard)
+    try:
+        conn.execute("PRAGMA foreign_keys = OFF")  # else DROP TABLE runs an implicit DELETE with FK actions
+        with UnitOfWork(conn) as uow:
+            marks = ",".join("?" * len(RESET_TABLES))
+            objects = uow.conn.execute(
+                f"SELECT type, name, sql FROM sqlite_master WHERE tbl_name IN ({marks}) AND sql IS NOT NULL", RESET_TABLES
+            ).fetchall()
+            seqs = uow.conn.execute(f"SELECT name, seq FROM sqlite_sequence WHERE name IN ({marks})", RESET_TABLES).fetchall()
+            tables = [o for o in objects if o["type"] == "table"]
+            for o in tables:
+                uow.conn.execute(f'DROP TABLE IF EXISTS "{o["name"]}"')  # indexes and triggers go with it
+            # Plain tables, then virtual ones (triggers reference both), then indexes and triggers
+            ordered = sorted(tables, key=lambda o: o["sql"].upper().startswith("CREATE VIRTUAL"))
+            ordered += [o for o in objects if o["type"] == "index"] + [o for o in objects if o["type"] == "trigger"]
+            for o in ordered:
+                uow.conn.execute(o["sql"])
+            uow.conn.executemany("INSERT INTO sqlite_sequence(name, seq) VALUES (?, ?)", [(r["name"], r["seq"]) for r in seqs])
+    finally:
+        conn.close()
+
+# =========================
+# Rollups (event counts, metrics backfill)
+# =========================
+
+# automation_events ids in (:after, :upto] -> per (day, platform, type, status) counts.
+# A late event (old created_at, new id) is folded into its own day.
+EVENT_ROLLUP_SQL = """
+INSERT INTO event_metrics_daily(day, platform, event_type, status, n)
+SELECT substr(e.created_at, 1, 10), COALESCE(t.platform, 'unknown'), e.event_type, e.status, COUNT(*)
+FROM automation_events e LEFT JOIN threads t ON t.id = e.thread_id
+WHERE e.id > :after AND e.id <= :upto
+GROUP BY 1, 2, 3, 4
+ON CONFLICT(day, platform, event_type, status) DO UPDATE SET
+  n = n + excluded.n,
+  updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+"""
+
+def _fold_events(uow: UnitOfWork, after: int, upto: int) -> None:
+    uow.conn.execute(EVENT_ROLLUP_SQL, {"after": after, "upto": upto})
+
+def _fold_messages(uow: UnitOfWork, after: int, upto: int) -> None:
+    # Same upserts as live inserts (so STATS picks them up too); avg_response_ms has no history
+    for r in uow.conn.execute(
+        "SELECT substr(created_at, 1, 10) AS day, platform, sender_type, intent, COUNT(*) AS n "
+        "FROM messages WHERE id > ? AND id <= ? GROUP BY 1, 2, 3, 4",
+        (after, upto),
+    ).fetchall():
+        record_message_metrics(uow, r["platform"], r["sender_type"], r["intent"], day=r["day"], n=r["n"])
+
+# checkpoint name -> (source table, fold)
+ROLLUPS: Dict[str, Tuple[str, Callable[[UnitOfWork, int, int], None]]] = {
+    "event_rollup": ("automation_events", _fold_events),
+    "metrics_backfill": ("messages", _fold_messages),
+}
+
+def rollup_step(conn: sqlite3.Connection, name: str, chunk_size: int = ROLLUP_CHUNK) -> int:
+    """Fold the next `chunk_size` source rows past the `name` checkpoint and
+    move the checkpoint, in one transaction: a crash or a concurrent run (other
+    worker) can't count a row twice. Returns the rows covered (0: caught up)."""
+    table, fold = ROLLUPS[name]
+    with UnitOfWork(conn) as uow:
+        row = uow.conn.execute("SELECT last_id, until_id FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            if name == "metrics_backfill":
+                return 0  # registered by ensure_metrics_backfill only
+            row = (0, None)
+        after, until = int(row[0]), row[1]
+        hi = uow.conn.execute(
+            f"SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?", (after, chunk_size - 1)
+        ).fetchone()
+        upto = int(hi[0]) if hi else int(uow.conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0])
+        if until is not None:
+            upto = min(upto, int(until))
+        if upto <= after:
+            return 0
+        with SQL_TIMES.time(f"rollup.{name}"):
+            fold(uow, after, upto)
+            n = int(uow.conn.execute(f"SELECT COUNT(*) FROM {table} WHERE id > ? AND id <= ?", (after, upto)).fetchone()[0])
+        uow.conn.execute(
+            "INSERT INTO checkpoints(name, last_id, until_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id, updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now'))",
+            (name, upto, until),
+        )
+    return n
+
+def run_rollup(chunk_size: int = ROLLUP_CHUNK, max_chunks: Optional[int] = None) -> Dict[str, Any]:
+    """Catch every rollup up on every shard (pending metrics backfill first),
+    one transaction per chunk so writers are never held for long. max_chunks
+    bounds a background pass; the next one continues from the checkpoints."""
+    started = time.perf_counter()
+    report: Dict[str, Any] = {name: 0 for name in ROLLUPS}
+    EVENTS.flush()
+    for shard in range(SHARDS):
+        conn = db(shard=shard)
+        try:
+            for name in ("metrics_backfill", "event_rollup"):
+                chunks = 0
+                while max_chunks is None or chunks < max_chunks:
+                    n = rollup_step(conn, name, chunk_size)
+                    if not n:
+                        break
+                    report[name] += n
+                    chunks += 1
+        finally:
+            conn.close()
+    report["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return report
+
+# =========================
+# Reclassification (offline, process pool)
+# =========================
+
+_RECLASSIFY_MATCHER: Optional[KeywordMatcher] = None
+
+# Bot replies in id order, with the text of the inbound they answer: reply_to,
+# or (replies stored before it existed) the thread's latest earlier user message
+RECLASSIFY_SELECT = """
+SELECT m.id, m.platform, m.created_at, m.intent, m.confidence,
+  COALESCE((SELECT i.content FROM messages i WHERE i.id = m.reply_to),
+           (SELECT i.content FROM messages i WHERE i.thread_id = m.thread_id AND i.sender_type = 'user' AND i.created_at <= m.created_at
+            ORDER BY i.created_at DESC, i.id DESC LIMIT 1)) AS inbound
+FROM messages m
+WHERE m.id > ? AND m.is_auto = 1 AND m.intent IS NOT NULL
+ORDER BY m.id LIMIT ?
+"""
+
+def _reclassify_init(matcher: KeywordMatcher) -> None:
+    global _RECLASSIFY_MATCHER
+    _RECLASSIFY_MATCHER = matcher
+
+def _reclassify_chunk(rows: List[Tuple[int, str]]) -> List[Tuple[int, str, float, Dict[str, str]]]:
+    """Pool task: (id, content) -> (id, intent, confidence, extracted slots), no DB access."""
+    out = []
+    for mid, content in rows:
+        match = _RECLASSIFY_MATCHER.scan(norm_text(content))
+        intent, conf = classify(content, match)
+        out.append((mid, intent, conf, extract(content, intent, match)))
+    return out
+
+def reclassify(workers: int = 0, chunk_size: int = RECLASSIFY_CHUNK, dry_run: bool = False, restart: bool = False, sample: int = 20) -> Dict[str, Any]:
+    """Re-label stored bot replies with the current rules, classifying the
+    inbound each one answers (messages.reply_to, else the thread's previous
+    user message): messages.intent/confidence are rewritten where they changed,
+    and metrics_daily intent counts move with them in the same transaction.
+    Replies whose inbound is gone (archived) keep their label.
+
+    Each shard is read in id order, `chunk_size` rows at a time; chunks are
+    classified by a pool of `workers` processes (default: one per CPU) while
+    the next ones are read, and written back in id order with one executemany
+    and the 'reclassify' checkpoint per transaction. An interrupted run resumes
+    after the last written chunk (restart: from the beginning); a finished one
+    clears its checkpoint. dry_run writes nothing and reports the changes.
+    Only the classification is replayed: a reply whose intent came from the
+    conversation flow (a pending question) may get the plain label instead."""
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    report: Dict[str, Any] = {"dry_run": dry_run, "workers": workers, "scanned": 0, "changed": 0, "transitions": {}, "sample": []}
+    timing = {"read_s": 0.0, "classify_wait_s": 0.0, "write_s": 0.0}
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork" if "fork" in methods else methods[0])  # fork: workers don't re-import the app
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_reclassify_init, initargs=(MATCHER.get(),)) as pool:
+        for shard in range(SHARDS):
+            conn = db(shard=shard)
+            try:
+                _reclassify_shard(conn, pool, workers, chunk_size, dry_run, restart, sample, report, timing)
+            finally:
+                conn.close()
+    elapsed = time.perf_counter() - started
+    report["transitions"] = dict(sorted(report["transitions"].items(), key=lambda kv: -kv[1]))
+    report["timing"] = dict({k: round(v, 3) for k, v in timing.items()}, elapsed_s=round(elapsed, 3),
+                            rows_per_s=round(report["scanned"] / elapsed, 1) if elapsed > 0 else None)
+    return report
+
+def _reclassify_shard(conn: sqlite3.Connection, pool: ProcessPoolExecutor, workers: int, chunk_size: int, dry_run: bool, restart: bool,
+                      sample: int, report: Dict[str, Any], timing: Dict[str, float]) -> None:
+    row = None if restart else conn.execute("SELECT last_id FROM checkpoints WHERE name = 'reclassify'").fetchone()
+    after = int(row[0]) if row else 0
+    # Rows the metrics backfill hasn't reached yet get counted with their new intent by it
+    row = conn.execute("SELECT last_id, until_id FROM checkpoints WHERE name = 'metrics_backfill'").fetchone()
+    uncounted = (int(row["last_id"]), int(row["until_id"] or 0)) if row else (0, 0)
+    inflight: "deque[Tuple[List[Tuple[int, Optional[str], Optional[float], str, str]], Any]]" = deque()
+
+    def write_next() -> None:
+        current, future = inflight.popleft()
+        t = time.perf_counter()
+        results = future.result()
+        t = _add_elapsed(timing, "classify_wait_s", t)
+        changes = []
+        deltas: Dict[Tuple[str, str, str], int] = {}
+        for (mid, old_intent, old_conf, day, platform), (_, intent, conf, slots) in zip(current, results):
+            if old_intent == intent and old_conf == conf:
+                continue
+            changes.append((intent, conf, mid))
+            if old_intent != intent and not uncounted[0] < mid <= uncounted[1]:
+                for label, n in ((old_intent, -1), (intent, 1)):
+                    if label:
+                        deltas[(day, platform, label)] = deltas.get((day, platform, label), 0) + n
+            key = f"{old_intent or 'null'}->{intent}"
+            report["transitions"][key] = report["transitions"].get(key, 0) + 1
+            if len(report["sample"]) < sample:
+                report["sample"].append({"id": mid, "from": old_intent, "to": intent, "confidence": conf, "slots": slots})
+        report["scanned"] += len(current)
+        report["changed"] += len(changes)
+        if not dry_run:
+            with UnitOfWork(conn) as uow:
+                uow.conn.executemany("UPDATE messages SET intent = ?, confidence = ? WHERE id = ?", changes)
+                uow.conn.executemany(
+                    "UPDATE metrics_daily SET intent_counts_json = json_set(COALESCE(intent_counts_json, '{}'), '$.\"' || :intent || '\"', "
+                    "COALESCE(json_extract(intent_counts_json, '$.\"' || :intent || '\"'), 0) + :n), updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now')) "
+                    "WHERE day = :day AND platform = :platform",
+                    [{"day": d, "platform": p, "intent": i, "n": n} for (d, p, i), n in deltas.items() if n],
+                )
+                uow.conn.execute(
+                    "INSERT INTO checkpoints(name, last_id) VALUES ('reclassify', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id, updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now'))",
+                    (current[-1][0],),
+                )
+        _add_elapsed(timing, "write_s", t)
+
+    while True:
+        t = time.perf_counter()
+        rows = conn.execute(RECLASSIFY_SELECT, (after, chunk_size)).fetchall()
+        _add_elapsed(timing, "read_s", t)
+        if not rows:
+            break
+        after = int(rows[-1]["id"])
+        rows = [r for r in rows if r["inbound"] is not None]
+        if not rows:
+            continue
+        current = [(int(r["id"]), r["intent"], r["confidence"], str(r["created_at"])[:10], str(r["platform"])) for r in rows]
+        inflight.append((current, pool.submit(_reclassify_chunk, [(int(r["id"]), str(r["inbound"])) for r in rows])))
+        if len(inflight) >= 2 * workers:  # bounded read-ahead
+            write_next()
+    while inflight:
+        write_next()
+    if not dry_run:
+        with UnitOfWork(conn) as uow:
+            uow.conn.execute("DELETE FROM checkpoints WHERE name = 'reclassify'")
+
+def _add_elapsed(timing: Dict[str, float], key: str, t0: float) -> float:
+    now = time.perf_counter()
+    timing[key] += now - t0
+    return now
+
+# =========================
+# Export (NDJSON, streamed)
+# =========================
+
+EXPORT_MESSAGE_SELECT = (
+    "SELECT m.id, m.thread_id, m.platform, m.sender_type, m.sender_name, m.content, m.intent, m.confidence, m.is_auto, m.created_at, "
+    "m.external_message_id, m.reply_to, t.external_thread_id FROM messages m JOIN threads t ON t.id = m.thread_id "
+)
+EXPORT_EVENT_SELECT = (
+    "SELECT e.id, e.thread_id, e.message_id, e.event_type, e.status, e.details_json, e.created_at "
+    "FROM automation_events e JOIN threads t ON t.id = e.thread_id "
+)
+
+def parse_export_cursor(raw: Optional[str]) -> Tuple[int, str, int]:
+    """'<shard>.<m|e>.<last id>' (as in the export's cursor records) -> tuple; ValueError if malformed."""
+    if not raw:
+        return 0, "m", 0
+    parts = raw.split(".")
+    if len(parts) != 3 or parts[1] not in ("m", "e") or not (parts[0].isdigit() and parts[2].isdigit()) or int(parts[0]) >= SHARDS:
+        raise ValueError(f"bad export cursor: {raw!r}")
+    return int(parts[0]), parts[1], int(parts[2])
+
+def parse_event_floors(raw: Optional[str]) -> List[int]:
+    """since_event_id: one id, or one per shard ('a,b,c') since event ids are per shard file."""
+    floors = [int(x) for x in (raw or "0").split(",")]
+    if len(floors) == 1:
+        return floors * SHARDS
+    if len(floors) != SHARDS:
+        raise ValueError(f"since_event_id needs 1 or {SHARDS} ids")
+    return floors
+
+def export_ndjson(since_id: int = 0, since_event_id: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                  platform: Optional[str] = None, events: bool = False, threads: bool = True, cursor: Optional[str] = None,
+                  compress: bool = True) -> Iterator[bytes]:
+    """Stream messages (then, with `events`, automation_events) as NDJSON,
+    gzip-compressed unless compress=False, shard by shard in id order.
+
+    Rows are read in EXPORT_CHUNK keyset pages, each on a pooled connection
+    borrowed just for that query (no read transaction spans the export, so
+    WAL checkpoints keep up). A `thread` record precedes a thread's first
+    message (with `threads`). After every page a `cursor` record says where to
+    resume (?cursor= / --cursor); the last record is `end`, with counts and
+    the highest ids seen (since_id / since_event_id of the next incremental
+    export; event ids are per shard, so the latter is 'a,b,c' when sharded).
+    Memory stays flat whatever the export size."""
+    start_shard, start_phase, start_last = parse_export_cursor(cursor)
+    event_floors = parse_event_floors(since_event_id)
+    started = time.perf_counter()
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31: gzip container
+    seen: "OrderedDict[int, None]" = OrderedDict()
+    totals = {"messages": 0, "events": 0, "threads": 0, "max_message_id": since_id}
+    max_event_ids = list(event_floors)
+
+    def encode(records: List[Dict[str, Any]]) -> bytes:
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        return gz.compress(data) if gz else data
+
+    def filters(alias: str) -> Tuple[str, List[Any]]:
+        where, params = "", []
+        if since:
+            where += f" AND {alias}.created_at >= ?"; params.append(since)
+        if until:
+            where += f" AND {alias}.created_at < ?"; params.append(until)
+        if platform:
+            where += " AND t.platform = ?"; params.append(platform)
+        return where, params
+
+    for shard in range(start_shard, SHARDS):
+        for phase in ("m", "e") if events else ("m",):
+            if shard == start_shard and phase == "m" and start_phase == "e":
+                continue
+            floor = since_id if phase == "m" else event_floors[shard]
+            last = max(floor, start_last) if (shard, phase) == (start_shard, start_phase) else floor
+            where, params = filters("m" if phase == "m" else "e")
+            sql = (EXPORT_MESSAGE_SELECT + "WHERE m.id > ?" + where + " ORDER BY m.id LIMIT ?") if phase == "m" else \
+                  (EXPORT_EVENT_SELECT + "WHERE e.id > ?" + where + " ORDER BY e.id LIMIT ?")
+            while True:
+                with READ_POOLS[shard].connection() as conn:
+                    rows = conn.execute(sql, [last] + params + [EXPORT_CHUNK]).fetchall()
+                    new_threads = [] if phase == "e" or not threads else \
+                        sorted({int(r["thread_id"]) for r in rows if int(r["thread_id"]) not in seen})
+                    thread_rows = {int(r["id"]): r for i in range(0, len(new_threads), 500) for r in conn.execute(
+                        "SELECT t.id, t.platform, t.external_thread_id, t.customer_id, c.display_name, t.status, t.priority, "
+                        "t.created_at, t.last_activity_at FROM threads t LEFT JOIN customers c ON c.id = t.customer_id "
+                        f"WHERE t.id IN ({','.join('?' * len(new_threads[i:i + 500]))})", new_threads[i:i + 500])}
+                if not rows:
+                    break
+                records: List[Dict[str, Any]] = []
+                for r in rows:
+                    if phase == "e":
+                        records.append({
+                            "type": "event", "id": r["id"], "thread": r["thread_id"], "message_id": r["message_id"],
+                            "event_type": r["event_type"], "status": r["status"],
+                            "details": json.loads(r["details_json"]) if r["details_json"] else None, "created_at": r["created_at"],
+                        })
+                        continue
+                    tid = int(r["thread_id"])
+                    if tid in thread_rows and tid not in seen:
+                        t = thread_rows[tid]
+                        records.append({
+                            "type": "thread", "id": tid, "thread_id": t["external_thread_id"], "platform": t["platform"],
+                            "customer_id": t["customer_id"], "user": t["display_name"], "status": t["status"],
+                            "priority": t["priority"], "created_at": t["created_at"], "last_activity_at": t["last_activity_at"],
+                        })
+                        totals["threads"] += 1
+                    if threads:
+                        seen[tid] = None
+                        seen.move_to_end(tid)
+                        if len(seen) > EXPORT_THREAD_CACHE:
+                            seen.popitem(last=False)
+                    records.append({
+                        "type": "message", "id": r["id"], "thread": tid, "thread_id": r["external_thread_id"], "platform": r["platform"],
+                        "role": "user" if r["sender_type"] == "user" else "system", "sender_type": r["sender_type"],
+                        "user": r["sender_name"], "text": r["content"], "intent": r["intent"], "confidence": r["confidence"],
+                        "is_auto": bool(r["is_auto"]), "external_message_id": r["external_message_id"], "reply_to": r["reply_to"],
+                        "created_at": r["created_at"],
+                    })
+                last = int(rows[-1]["id"])
+                kind = "messages" if phase == "m" else "events"
+                totals[kind] += len(rows)
+                if phase == "m":
+                    totals["max_message_id"] = max(totals["max_message_id"], last)
+                else:
+                    max_event_ids[shard] = max(max_event_ids[shard], last)
+                records.append({"type": "cursor", "cursor": f"{shard}.{phase}.{last}"})
+                chunk = encode(records)
+                if chunk:
+                    yield chunk
+                if len(rows) < EXPORT_CHUNK:
+                    break
+    totals["max_event_id"] = ",".join(map(str, max_event_ids)) if SHARDS > 1 else max_event_ids[0]
+    tail = encode([dict(totals, type="end", elapsed_s=round(time.perf_counter() - started, 3))])
+    yield tail + gz.flush() if gz else tail
+
+# =========================
+# Routes
+# =========================
+
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+def _int_arg(name: str, default: int, lo: int, hi: int) -> int:
+    try:
+        v = int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        v = default
+    return max(lo, min(hi, v))
+
+def message_payload(r: sqlite3.Row) -> dict:
+    """Row from messages JOIN threads -> shape expected by the UI (normMsg)."""
+    role = "user" if r["sender_type"] == "user" else "system"
+    # For system/bot messages, UI uses AUTO_USER; keep sender_name for user
+    user = r["sender_name"] if role == "user" else AUTO_USER
+    return {
+        "id": str(r["id"]),
+        "seq": int(r["id"]),
+        "thread_id": str(r["external_thread_id"] or ""),
+        "platform": str(r["platform"]),
+        "role": role,
+        "user": user,
+        "text": str(r["content"] or ""),
+        "timestamp": str(r["created_at"] or _utc_iso()),
+        "typing": False,
+        "client_only": False,
+    }
+
+MESSAGE_SELECT = (
+    "SELECT m.id, m.platform, m.sender_type, m.sender_name, m.content, m.intent, m.confidence, m.is_auto, m.created_at, t.external_thread_id "
+    "FROM messages m JOIN threads t ON t.id = m.thread_id "
+)
 
-    _, thread_db_id, ext_id = ensure_customer_and_thread(platform, user)
+def fan_out(conns: Sequence[sqlite3.Connection], sql: str, params: Sequence[Any], key: Callable[[sqlite3.Row], Any], reverse: bool = False) -> List[sqlite3.Row]:
+    """Run one query on every shard and merge the rows by `key` (the query's own
+    ORDER BY); callers trim to their LIMIT."""
+    if len(conns) == 1:
+        return conns[0].execute(sql, params).fetchall()
+    return sorted((r for conn in conns for r in conn.execute(sql, params)), key=key, reverse=reverse)
 
-    # inbound
-    inbound = insert_message(thread_db_id, platform, "user", user, text, is_auto=False)
-    log_event(thread_db_id, int(inbound["seq"]), "ingest", "ok", {"source": "auto_generate"})
-    log_event(thread_db_id, int(inbound["seq"]), "normalize", "ok", {"text_norm": norm_text(text)})
+def settled_cursor(since: int, cursor: int) -> int:
+    """Sharded: another file may still commit an id just below the newest one
+    read, so a poll cursor only passes ids older than SHARD_SETTLE_S (the next
+    poll may repeat a few messages; the UI dedupes them by id)."""
+    if SHARDS == 1:
+        return cursor
+    settled = int((time.time() - SHARD_SETTLE_S) * 1000) * SHARD_ID_TICKS_PER_MS
+    return max(since, min(cursor, settled))
 
-    # respond
-    out, intent, conf = respond(thread_db_id, platform, user, text)
-    log_event(thread_db_id, int(inbound["seq"]), "classify", "ok", {"intent": intent, "confidence": conf})
-    system = insert_message(thread_db_id, platform, "system", AUTO_USER, out, reply_to=inbound["id"], intent=intent, confidence=conf, is_auto=True)
-    log_event(thread_db_id, int(system["seq"]), "respond", "ok", {"intent": intent})
-    log_event(thread_db_id, int(system["seq"]), "persist", "ok", {})
+@app.route("/api/messages")
+def api_messages():
+    """Messages in chronological order, in the format expected by the UI.
+
+    ?since_seq=N  only rows with id > N (keyset on messages.id), oldest first
+    ?limit=K      page size (default MSG_PAGE_SIZE, max MSG_CAP)
+    Without since_seq, returns the latest page. Responses carry an ETag derived
+    from the current max id (per shard), so an unchanged poll is answered 304
+    without a scan. Sharded, every shard is read and the pages merged by id."""
+    since = _int_arg("since_seq", 0, 0, 2**63 - 1)
+    limit = _int_arg("limit", MSG_PAGE_SIZE, 1, MSG_CAP)
+    conns = get_read_dbs()
+
+    maxes = [int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]) for conn in conns]
+    max_id = max(maxes)
+    etag = f"m{'.'.join(map(str, maxes))}-s{since}-l{limit}"
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    by_id = lambda r: r["id"]
+    if since:
+        rows = fan_out(conns, MESSAGE_SELECT + "WHERE m.id > ? ORDER BY m.id ASC LIMIT ?", (since, limit + 1), by_id)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        # Latest page; reverse to chronological order
+        rows = fan_out(conns, MESSAGE_SELECT + "ORDER BY m.id DESC LIMIT ?", (limit,), by_id, reverse=True)[:limit][::-1]
+        has_more = False
 
+    msgs = [message_payload(r) for r in rows]
+    cursor = settled_cursor(since, msgs[-1]["seq"] if msgs else (since or max_id))
+    resp = jsonify({"messages": msgs, "cursor": cursor, "has_more": has_more})
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+THREAD_STATUSES = ("open", "closed", "pending")
+THREAD_PRIORITIES = ("low", "normal", "high", "urgent")
+
+THREAD_SELECT = (
+    "SELECT t.id, t.platform, t.external_thread_id, t.status, t.priority, t.last_activity_at, "
+    "t.last_message_id, t.last_message_preview, c.display_name, m.sender_type AS last_sender_type "
+    "FROM threads t LEFT JOIN customers c ON c.id = t.customer_id LEFT JOIN messages m ON m.id = t.last_message_id "
+)
+
+def thread_payload(r: sqlite3.Row) -> dict:
+    return {
+        "id": int(r["id"]),
+        "thread_id": str(r["external_thread_id"] or ""),
+        "platform": str(r["platform"]),
+        "user": r["display_name"],
+        "status": r["status"],
+        "priority": r["priority"],
+        "last_activity_at": r["last_activity_at"],
+        "last_message": None if r["last_message_id"] is None else {
+            "id": str(r["last_message_id"]),
+            "preview": r["last_message_preview"],
+            "role": None if r["last_sender_type"] is None else ("user" if r["last_sender_type"] == "user" else "system"),
+        },
+    }
+
+def _keyset_cursor(name: str) -> Optional[Tuple[str, int]]:
+    # "<timestamp>|<id>" as returned in next_cursor
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    ts, _, rid = raw.rpartition("|")
+    try:
+        return ts, int(rid)
+    except ValueError:
+        return None
+
+@app.route("/api/threads")
+def api_threads():
+    """Conversations, most recent activity first, keyset-paginated.
+
+    ?status= ?priority= ?platform=  filters
+    ?limit=K                        page size (default MSG_PAGE_SIZE/2, max MSG_CAP)
+    ?cursor=                        next_cursor of the previous page
+    Walks ix_threads_last_activity (or the status / platform variants), so
+    each page costs O(limit) regardless of how many threads exist (times the
+    shard count: each shard's page is merged)."""
+    limit = _int_arg("limit", MSG_PAGE_SIZE // 2, 1, MSG_CAP)
+    where: List[str] = []
+    params: List[Any] = []
+    for col, allowed in (("status", THREAD_STATUSES), ("priority", THREAD_PRIORITIES), ("platform", tuple(PLATFORMS))):
+        value = request.args.get(col)
+        if value:
+            if value not in allowed:
+                return jsonify({"error": f"invalid {col}", "allowed": list(allowed)}), 400
+            where.append(f"t.{col} = ?"); params.append(value)
+    cursor = _keyset_cursor("cursor")
+    if cursor:
+        where.append("(t.last_activity_at, t.id) < (?, ?)"); params += list(cursor)
+
+    sql = THREAD_SELECT + (("WHERE " + " AND ".join(where) + " ") if where else "")
+    rows = fan_out(get_read_dbs(), sql + "ORDER BY t.last_activity_at DESC, t.id DESC LIMIT ?", params + [limit + 1],
+                   lambda r: (r["last_activity_at"], r["id"]), reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f"{rows[-1]['last_activity_at']}|{rows[-1]['id']}" if has_more else None
+    return jsonify({"threads": [thread_payload(r) for r in rows], "next_cursor": next_cursor, "has_more": has_more})
+
+@app.route("/api/threads/<int:thread_id>/messages")
+def api_thread_messages(thread_id: int):
+    """One conversation's messages, chronological, paged backwards in time on
+    ix_messages_thread_time. ?limit=K, ?before=<next_cursor> for older pages."""
+    limit = _int_arg("limit", MSG_PAGE_SIZE, 1, MSG_CAP)
+    conn = get_read_db(shard_of(thread_id))
+    if conn.execute("SELECT 1 FROM threads WHERE id = ?", (thread_id,)).fetchone() is None:
+        return jsonify({"error": "thread not found"}), 404
+    where, params = "WHERE m.thread_id = ? ", [thread_id]
+    before = _keyset_cursor("before")
+    if before:
+        where += "AND (m.created_at, m.id) < (?, ?) "
+        params += list(before)
+    rows = conn.execute(MESSAGE_SELECT + where + "ORDER BY m.created_at DESC, m.id DESC LIMIT ?", params + [limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f"{rows[-1]['created_at']}|{rows[-1]['id']}" if has_more else None
+    return jsonify({"messages": [message_payload(r) for r in reversed(rows)], "next_cursor": next_cursor, "has_more": has_more})
+
+# Simulated traffic for /api/generate (also used by bench.py)
+GEN_USERS = [
+    "Sofía","Lucas","Valentina","Mateo","Camila","Diego","Ana","Bruno","María","Nico","Carla","Julián","Mica","Tomás","Paula","Fede","Mauri","Jime","Abi","Enzo","Gabi"
+]
+GEN_SEEDS = [
+    "Hola", "Buenas", "Buen día", "Quiero comprar algo",
+    "¿Cuál es el precio?", "¿Horarios de atención?", "¿Tienen envío?",
+    "Me cobraron dos veces", "No puedo entrar a mi cuenta", "¿Hay stock?"
+]
+
+@app.route("/api/generate")
+def api_generate():
+    platform = random.choice(PLATFORMS)
+    user = random.choice(GEN_USERS)
+    text = random.choice(GEN_SEEDS)
+
+    inbound, system = process_inbound(thread_db(platform, user), platform, user, text, source="auto_generate")
     return jsonify({"generated": [inbound, system]})
 
 @app.route("/api/send", methods=["POST"])
 def api_send():
     d = request.get_json(silent=True) or {}
-    raw = (d.get("platform") or d.get("app") or d.get("channel") or "whatsapp").lower()
-    platform = raw if raw in PLATFORMS else "whatsapp"
+    platform, user, text, _ = parse_inbound(d)
+    try:
+        key = inbound_key(d, request.headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body, status = accept_inbound(thread_db(platform, user), platform, user, text, "manual", key, queued=INGEST_MODE == "queue")
+    return jsonify(body), status
+
+@app.route("/api/webhook", methods=["POST"])
+def api_webhook():
+    """Platform webhook (same body as /api/send): stores the inbound message and
+    a reply job, then acks 202 without waiting for the bot. The reply arrives
+    through /api/stream and /api/messages. A retry carrying the same platform
+    message id (see inbound_key) gets the stored messages back instead."""
+    d = request.get_json(silent=True) or {}
+    platform, user, text, _ = parse_inbound(d)
+    try:
+        key = inbound_key(d, request.headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body, status = accept_inbound(thread_db(platform, user), platform, user, text, "webhook", key, queued=True)
+    return jsonify(body), status
 
-    user = (d.get("user_name") or d.get("user") or d.get("sender") or "Usuario").strip() or "Usuario"
-    text = (d.get("message") or d.get("text") or d.get("content") or "").strip()
+@app.route("/api/send_batch", methods=["POST"])
+def api_send_batch():
+    """Bulk ingest: a JSON array, {"items": [...], "respond": bool}, or NDJSON
+    (Content-Type: application/x-ndjson, streamed line by line). ?respond=1
+    runs the bot for every item. Returns accepted/rejected counts and throughput."""
+    respond_each = request.args.get("respond", "").lower() in ("1", "true", "yes")
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        items: Iterable[Any] = iter_jsonl(request.stream)
+    else:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            respond_each = respond_each or bool(body.get("respond"))
+            body = body.get("items")
+        if not isinstance(body, list):
+            return jsonify({"error": "expected a JSON array, {\"items\": [...]} or NDJSON"}), 400
+        items = body
+    report = ingest_batch(get_db(), items, respond_each=respond_each, source="batch")
+    return jsonify(report.as_dict())
 
-    _, thread_db_id, _ = ensure_customer_and_thread(platform, user)
+def fts_query(q: str) -> str:
+    """Plain user text -> FTS5 query: every word quoted (no operator syntax), ANDed."""
+    words = re.findall(r"\w+", q or "")
+    return " ".join('"' + w.replace('"', '""') + '"' for w in words)
 
-    inbound = insert_message(thread_db_id, platform, "user", user, text, is_auto=False)
-    log_event(thread_db_id, int(inbound["seq"]), "ingest", "ok", {"source": "manual"})
-    log_event(thread_db_id, int(inbound["seq"]), "normalize", "ok", {"text_norm": norm_text(text)})
+# Only the "T" separator: bounds are compared as strings against created_at
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}(T[0-9:.]+Z?)?$")
 
-    out, intent, conf = respond(thread_db_id, platform, user, text)
-    log_event(thread_db_id, int(inbound["seq"]), "classify", "ok", {"intent": intent, "confidence": conf})
+@app.route("/api/search")
+def api_search():
+    """Full-text search over messages (FTS5, bm25 ranking).
 
-    system = insert_message(thread_db_id, platform, "system", AUTO_USER, out, reply_to=inbound["id"], intent=intent, confidence=conf, is_auto=True)
-    log_event(thread_db_id, int(system["seq"]), "respond", "ok", {"intent": intent})
-    log_event(thread_db_id, int(system["seq"]), "persist", "ok", {})
+    ?q=        words to match (all of them)
+    ?platform= ?thread= (external thread id) ?intent= ?since= ?until= (ISO dates on created_at)
+    ?sort=rank|recent  ?limit=  ?cursor= (next_cursor from the previous page)"""
+    match = fts_query(request.args.get("q", ""))
+    if not match:
+        return jsonify({"error": "missing q"}), 400
+    sort = request.args.get("sort", "rank")
+    limit = _int_arg("limit", SEARCH_PAGE_SIZE, 1, SEARCH_PAGE_MAX)
+    conns = get_read_dbs()
 
-    return jsonify({"messages": [inbound, system]})
+    where = ["messages_fts MATCH ?"]
+    params: List[Any] = [match]
+    platform = request.args.get("platform")
+    if platform:
+        where.append("m.platform = ?"); params.append(platform)
+    thread = request.args.get("thread")
+    if thread:
+        conns = [get_read_db(shard_for(thread))]
+        trow = conns[0].execute("SELECT id FROM threads WHERE platform = ? AND external_thread_id = ?", (thread.split(":", 1)[0], thread)).fetchone()
+        if not trow:
+            return jsonify({"results": [], "next_cursor": None})
+        where.append("m.thread_id = ?"); params.append(int(trow["id"]))
+    intent = request.args.get("intent")
+    if intent:
+        where.append("m.intent = ?"); params.append(intent)
+    for arg, op in (("since", ">="), ("until", "<")):
+        v = request.args.get(arg)
+        if v:
+            if not _DATE_RE.match(v):
+                return jsonify({"error": f"bad {arg}"}), 400
+            where.append(f"m.created_at {op} ?"); params.append(v)
+
+    cursor = request.args.get("cursor")
+    try:
+        if cursor and sort == "recent":
+            where.append("m.id < ?"); params.append(int(cursor))
+        elif cursor:
+            score, last_id = cursor.split(":", 1)
+            where.append("(bm25(messages_fts), m.id) > (?, ?)"); params += [float(score), int(last_id)]
+    except ValueError:
+        return jsonify({"error": "bad cursor"}), 400
+    order = "m.id DESC" if sort == "recent" else "bm25(messages_fts), m.id"
+
+    try:
+        # Sharded: bm25 scores use each shard's own term statistics (close enough to merge on)
+        rows = fan_out(
+            conns,
+            "SELECT m.id, m.platform, m.sender_type, m.sender_name, m.content, m.intent, m.confidence, m.is_auto, m.created_at, "
+            "t.external_thread_id, bm25(messages_fts) AS score, "
+            "snippet(messages_fts, 0, char(2), char(3), '…', 12) AS snip "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN threads t ON t.id = m.thread_id "
+            f"WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?",
+            params + [limit],
+            (lambda r: r["id"]) if sort == "recent" else (lambda r: (r["score"], r["id"])),
+            reverse=sort == "recent",
+        )[:limit]
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = []
+    for r in rows:
+        item = message_payload(r)
+        item["intent"] = r["intent"]
+        item["score"] = r["score"]
+        # HTML-safe snippet: escape the text, then turn the match markers into <mark>
+        item["snippet"] = html.escape(r["snip"] or "").replace("\x02", "<mark>").replace("\x03", "</mark>")
+        results.append(item)
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = str(last["id"]) if sort == "recent" else f"{last['score']!r}:{last['id']}"
+    return jsonify({"results": results, "next_cursor": next_cursor})
+
+@app.route("/api/export")
+def api_export():
+    """Full-history export as a download, streamed (see export_ndjson).
+
+    ?since_id= ?since_event_id=  only ids above these
+    ?since= ?until=              ISO dates on created_at
+    ?platform=  ?events=1  ?threads=0  ?cursor= (resume)  ?gzip=0 (plain NDJSON)"""
+    args = request.args
+    flag = lambda name, default: args.get(name, default).lower() in ("1", "true", "yes")
+    for name in ("since", "until"):
+        if args.get(name) and not _DATE_RE.match(args[name]):
+            return jsonify({"error": f"bad {name}"}), 400
+    platform = args.get("platform")
+    if platform and platform not in PLATFORMS:
+        return jsonify({"error": "invalid platform", "allowed": PLATFORMS}), 400
+    try:
+        parse_export_cursor(args.get("cursor"))
+        parse_event_floors(args.get("since_event_id"))
+        since_id = int(args.get("since_id", 0))
+    except ValueError:
+        return jsonify({"error": "bad cursor, since_id or since_event_id"}), 400
+    compress = flag("gzip", "1")
+    body = export_ndjson(since_id, args.get("since_event_id"), args.get("since"), args.get("until"), platform,
+                         events=flag("events", "0"), threads=flag("threads", "1"), cursor=args.get("cursor"), compress=compress)
+    resp = app.response_class(body, mimetype="application/gzip" if compress else "application/x-ndjson")
+    if compress:
+        resp.headers["Content-Disposition"] = "attachment; filename=oneinbox-export.ndjson.gz"
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 @app.route("/api/clear", methods=["POST"])
 def api_clear():
-    conn = db()
+    EVENTS.flush()
+    reset_store()
+    return jsonify({"ok": True})
+
+def _sse(kind: str, data: dict, event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/api/stream")
+def api_stream():
+    """Server-Sent Events: `message` (same shape as /api/messages, id = seq),
+    `stats` (count deltas), `clear` and `resync`. Resumes after Last-Event-ID
+    (or ?since_seq) from the DB; otherwise starts at the current tail."""
     try:
-        # Clear in dependency-safe order
-        conn.execute("DELETE FROM automation_events;")
-        conn.execute("DELETE FROM messages;")
-        conn.execute("DELETE FROM threads;")
-        conn.execute("DELETE FROM customer_identities;")
-        conn.execute("DELETE FROM customers;")
-        conn.execute("DELETE FROM metrics_daily;")
-        # Also clear FTS table if present
+        last = int(request.headers.get("Last-Event-ID") or request.args.get("since_seq") or -1)
+    except ValueError:
+        last = -1
+
+    def replay(after: int) -> Tuple[int, List[dict]]:
+        # Borrowed per replay, not held for the life of the stream
+        with ExitStack() as stack:
+            conns = [stack.enter_context(pool.connection()) for pool in READ_POOLS]
+            if after < 0:
+                return max(int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]) for conn in conns), []
+            rows = fan_out(conns, MESSAGE_SELECT + "WHERE m.id > ? ORDER BY m.id ASC LIMIT ?", (after, MSG_CAP), lambda r: r["id"])[:MSG_CAP]
+            return after, [message_payload(r) for r in rows]
+
+    def stream():
+        # Subscribe before replaying so nothing committed in between is missed
+        sub = HUB.subscribe()
+        sent = last
+        delivered: set = set()  # recent ids: commits may be published slightly out of order
+
+        def first_delivery(seq: int) -> bool:
+            nonlocal sent, delivered
+            if seq in delivered:
+                return False
+            delivered.add(seq)
+            sent = max(sent, seq)
+            if len(delivered) > 2 * SSE_CLIENT_BUFFER:
+                delivered = {i for i in delivered if i > sent - SSE_CLIENT_BUFFER}
+            return True
+
         try:
-            conn.execute("DELETE FROM messages_fts;")
-        except Exception:
-            pass
-        conn.commit()
+            sent, backlog = replay(sent)
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            for m in backlog:
+                if first_delivery(m["seq"]):
+                    yield _sse("message", m, m["seq"])
+            while True:
+                try:
+                    kind, data, event_id = sub.q.get(timeout=SSE_HEARTBEAT_S)
+                except queue.Empty:
+                    # Idle: heartbeat, and pick up rows committed by other processes
+                    yield ": ping\n\n"
+                    for m in replay(sent)[1]:
+                        if first_delivery(m["seq"]):
+                            yield _sse("message", m, m["seq"])
+                    continue
+                if sub.overflow:
+                    yield _sse("resync", {"since_seq": sent})
+                    return
+                if kind == "message" and event_id is not None and not first_delivery(event_id):
+                    continue  # already delivered by a replay
+                yield _sse(kind, data, event_id)
+        finally:
+            HUB.unsubscribe(sub)
+
+    resp = app.response_class(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # let nginx pass events through unbuffered
+    return resp
+
+@app.route("/api/stats")
+def api_stats():
+    """Message counts (total, per platform, user/bot, per intent) from STATS."""
+    return jsonify(STATS.snapshot(get_read_dbs()))
+
+ANALYTICS_METRICS = ("messages", "intents", "events")
+_DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+@app.route("/api/analytics")
+def api_analytics():
+    """Daily time series served from the rollups only (metrics_daily,
+    event_metrics_daily): the cost grows with the days asked for, not with the
+    stored messages. Sharded, every shard's rows are summed.
+
+    ?metric=messages|intents|events  per platform / per intent / per event type:status
+    ?from= ?to=                      days, inclusive (default: the last ANALYTICS_DEFAULT_DAYS)
+    ?platform=  ?intent=             filters
+    ?bucket=day|month"""
+    metric = request.args.get("metric", "messages")
+    if metric not in ANALYTICS_METRICS:
+        return jsonify({"error": "invalid metric", "allowed": list(ANALYTICS_METRICS)}), 400
+    bucket = request.args.get("bucket", "day")
+    if bucket not in ("day", "month"):
+        return jsonify({"error": "invalid bucket", "allowed": ["day", "month"]}), 400
+    today = _utc_iso()[:10]
+    start = request.args.get("from") or (datetime.utcnow() - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)).strftime("%Y-%m-%d")
+    end = request.args.get("to") or today
+    if not _DAY_RE.match(start) or not _DAY_RE.match(end):
+        return jsonify({"error": "from/to must be YYYY-MM-DD"}), 400
+    platform = request.args.get("platform")
+    if platform and platform not in PLATFORMS:
+        return jsonify({"error": "invalid platform", "allowed": PLATFORMS}), 400
+
+    width = 10 if bucket == "day" else 7
+    where, params = "day BETWEEN ? AND ?", [start, end]
+    if platform:
+        where += " AND platform = ?"; params.append(platform)
+    if metric == "messages":
+        sql = ("SELECT substr(day, 1, ?) AS t, platform AS k, SUM(total_messages) AS n, SUM(user_messages) AS user, "
+               "SUM(bot_messages) AS bot, SUM(avg_response_ms * response_count) AS ms, SUM(response_count) AS responses "
+               f"FROM metrics_daily WHERE {where} GROUP BY 1, 2")
+    elif metric == "intents":
+        intent = request.args.get("intent")
+        if intent:
+            where += " AND j.key = ?"; params.append(intent)
+        sql = f"SELECT substr(day, 1, ?) AS t, j.key AS k, SUM(j.value) AS n FROM metrics_daily, json_each(intent_counts_json) AS j WHERE {where} GROUP BY 1, 2"
+    else:
+        sql = f"SELECT substr(day, 1, ?) AS t, event_type || ':' || status AS k, SUM(n) AS n FROM event_metrics_daily WHERE {where} GROUP BY 1, 2"
+
+    points: Dict[Tuple[str, str], Dict[str, float]] = {}
+    for conn in get_read_dbs():
+        for r in conn.execute(sql, [width] + params):
+            p = points.setdefault((r["k"], r["t"]), {})
+            for col in r.keys()[2:]:
+                p[col] = p.get(col, 0) + (r[col] or 0)
+    series: Dict[str, List[Dict[str, Any]]] = {}
+    for (k, t), p in sorted(points.items()):
+        point: Dict[str, Any] = {"t": t, "n": int(p["n"])}
+        if metric == "messages":
+            point.update(user=int(p["user"]), bot=int(p["bot"]),
+                         avg_response_ms=round(p["ms"] / p["responses"], 3) if p["responses"] else None)
+        series.setdefault(k, []).append(point)
+    return jsonify({"metric": metric, "bucket": bucket, "from": start, "to": end, "series": series})
+
+@app.route("/api/events/stats")
+def api_events_stats():
+    return jsonify(EVENTS.stats())
+
+@app.route("/api/jobs/stats")
+def api_jobs_stats():
+    """Reply queue back-pressure: depth per status, oldest queued age, worker counters."""
+    return jsonify(REPLY_QUEUE.stats(get_read_dbs()))
+
+def _prom_counters(name: str, help_text: str, values: Dict[str, Any], label: str, gauges: Tuple[str, ...] = ()) -> List[str]:
+    # monotonically increasing keys as <name>_total{label=...}; point-in-time keys as <name>_<key> gauges
+    lines = [f"# HELP {name}_total {help_text}", f"# TYPE {name}_total counter"]
+    lines += [f'{name}_total{{{label}="{k}"}} {v}' for k, v in sorted(values.items()) if k not in gauges]
+    for k in gauges:
+        lines += [f"# TYPE {name}_{k} gauge", f"{name}_{k} {values.get(k, 0)}"]
+    return lines
+
+@app.route("/api/metrics")
+def api_metrics():
+    """Prometheus text format: latency histograms (pipeline stages, hot-path SQL,
+    end-to-end per message) plus event sink, state cache and message counters.
+    Values are per worker process."""
+    lines: List[str] = []
+    for hist in (MESSAGE_TIMES, STAGE_TIMES, SQL_TIMES, JOB_TIMES):
+        lines += hist.render()
+    lines += _prom_counters("oneinbox_events", "automation_events sink counters.", EVENTS.stats(), "state", gauges=("queue_depth",))
+    lines += _prom_counters("oneinbox_state_cache", "Rule-engine state cache counters.", STATE.stats(), "op", gauges=("cached",))
+    lines += _prom_counters("oneinbox_inbound_dedup", "Platform message id lookups (retries answered from memory / DB).", INBOUND_KEYS.stats(), "op", gauges=("cached",))
+    snap = STATS.snapshot(get_read_dbs())
+    lines += ["# HELP oneinbox_messages_total Stored messages per platform (metrics_daily).", "# TYPE oneinbox_messages_total counter"]
+    lines += [f'oneinbox_messages_total{{platform="{p}"}} {snap.get(p, 0)}' for p in PLATFORMS]
+    jobs = REPLY_QUEUE.stats(get_read_dbs())
+    lines += _prom_counters("oneinbox_reply_jobs", "Reply queue counters (this process).", {k: jobs[k] for k in REPLY_QUEUE.counters}, "op")
+    for k in ("queued", "running", "failed", "oldest_queued_s", "workers"):
+        lines += [f"# TYPE oneinbox_reply_jobs_{k} gauge", f"oneinbox_reply_jobs_{k} {jobs[k]}"]
+    pools: Dict[str, int] = {}
+    for pool in READ_POOLS:
+        for k, v in pool.stats().items():
+            pools[k] = pools.get(k, 0) + v
+    lines += _prom_counters("oneinbox_read_pool", "Read-only connection pool counters (all shards).", pools, "op", gauges=("idle",))
+    lines += _prom_counters("oneinbox_storage_maintenance", "WAL checkpoint / optimize runs.", MAINTENANCE.stats(), "op")
+    lines += ["# TYPE oneinbox_sse_clients gauge", f"oneinbox_sse_clients {HUB.clients()}"]
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+# =========================
+# CLI
+# =========================
+
+@app.cli.command("migrate")
+@click.option("--check", is_flag=True, help="Only report versions; exit 1 if a shard is not current.")
+def migrate_command(check: bool) -> None:
+    """Apply pending schema migrations to every shard (safe to run concurrently)."""
+    if check:
+        versions = {shard: schema_version(shard) for shard in range(SHARDS)}
+        for shard, version in versions.items():
+            click.echo(f"shard {shard}: version {version} / {SCHEMA_VERSION}")
+        if any(v != SCHEMA_VERSION for v in versions.values()):
+            raise SystemExit(1)
+        return
+    for shard, (before, after) in migrate().items():
+        click.echo(f"shard {shard}: version {before} -> {after}")
+
+@app.cli.command("import-jsonl")
+@click.argument("path", type=click.File("r", encoding="utf-8"))
+@click.option("--respond", "respond_each", is_flag=True, help="Run the bot for every imported message.")
+@click.option("--chunk-size", default=BATCH_CHUNK, show_default=True, help="Items per transaction.")
+def import_jsonl_command(path, respond_each: bool, chunk_size: int) -> None:
+    """Stream a JSONL file (one api_send object per line, '-' for stdin) into the DB."""
+    conn = db()
+    try:
+        report = ingest_batch(conn, iter_jsonl(path), respond_each=respond_each, chunk_size=chunk_size, source="import")
     finally:
         conn.close()
-    return jsonify({"ok": True})
+    EVENTS.flush()
+    click.echo(json.dumps(report.as_dict(), ensure_ascii=False))
+    if report.rejected:
+        sys.exit(1)
+
+@app.cli.command("export")
+@click.option("--out", "out", default="-", show_default=True, help="Output file ('-': stdout); gzip unless --no-gzip.")
+@click.option("--since-id", default=0, help="Only messages with a higher id.")
+@click.option("--since-event-id", default=None, help="Only events with a higher id (one per shard: 'a,b,c').")
+@click.option("--since", default=None, help="ISO date: created_at >= this.")
+@click.option("--until", default=None, help="ISO date: created_at < this.")
+@click.option("--platform", type=click.Choice(PLATFORMS), default=None)
+@click.option("--events/--no-events", default=False, show_default=True, help="Also export automation_events.")
+@click.option("--threads/--no-threads", default=True, show_default=True, help="Thread records before their messages.")
+@click.option("--cursor", default=None, help="Resume after a cursor record of an interrupted export.")
+@click.option("--gzip/--no-gzip", "compress", default=True, show_default=True)
+def export_command(out: str, since_id: int, since_event_id: Optional[str], since: Optional[str], until: Optional[str], platform: Optional[str],
+                   events: bool, threads: bool, cursor: Optional[str], compress: bool) -> None:
+    """Stream messages (and optionally events) as NDJSON, same format as /api/export."""
+    for name, value in (("since", since), ("until", until)):
+        if value and not _DATE_RE.match(value):
+            raise click.BadParameter(f"bad date: {value}", param_hint=f"--{name}")
+    try:
+        parse_export_cursor(cursor)
+        parse_event_floors(since_event_id)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    f = sys.stdout.buffer if out == "-" else open(out, "wb")
+    try:
+        for chunk in export_ndjson(since_id, since_event_id, since, until, platform, events=events, threads=threads, cursor=cursor, compress=compress):
+            f.write(chunk)
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+
+@app.cli.command("reply-workers")
+@click.option("--workers", default=REPLY_WORKERS, show_default=True, help="Worker threads.")
+def reply_workers_command(workers: int) -> None:
+    """Run reply workers in this process (for web workers started with ONEINBOX_REPLY_WORKERS=0)."""
+    REPLY_QUEUE.workers = max(1, workers)
+    REPLY_QUEUE.ensure_started()
+    click.echo(f"{REPLY_QUEUE.workers} reply workers running; Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        REPLY_QUEUE.close()
+        EVENTS.flush()
+
+@app.cli.command("archive")
+@click.option("--older-than-days", "days", default=RETENTION_DAYS or 90, show_default=True, help="Archive rows older than this.")
+@click.option("--chunk-size", default=ARCHIVE_CHUNK, show_default=True, help="Rows moved per transaction.")
+@click.option("--no-vacuum", is_flag=True, help="Skip the incremental vacuum.")
+@click.option("--enable-incremental-vacuum", is_flag=True, help="One-time: switch the DB to auto_vacuum=INCREMENTAL (full VACUUM).")
+def archive_command(days: int, chunk_size: int, no_vacuum: bool, enable_incremental_vacuum: bool) -> None:
+    """Move old messages/events into monthly archive files (ARCHIVE_DIR)."""
+    if enable_incremental_vacuum:
+        for shard in range(SHARDS):
+            conn = db(shard=shard)
+            try:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+    report = run_retention(days, chunk_size=chunk_size, vacuum=not no_vacuum)
+    EVENTS.flush()
+    click.echo(json.dumps(report, ensure_ascii=False))
+
+@app.cli.command("rollup")
+@click.option("--chunk-size", default=ROLLUP_CHUNK, show_default=True, help="Source rows folded per transaction.")
+def rollup_command(chunk_size: int) -> None:
+    """Fold new automation_events (and any pending metrics backfill) into the daily rollups."""
+    report = run_rollup(chunk_size=chunk_size)
+    click.echo(json.dumps(report, ensure_ascii=False))
+
+@app.cli.command("reclassify")
+@click.option("--workers", default=0, help="Classifier processes (default: one per CPU).")
+@click.option("--chunk-size", default=RECLASSIFY_CHUNK, show_default=True, help="Messages per task and per UPDATE transaction.")
+@click.option("--dry-run", is_flag=True, help="Report what would change; write nothing.")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint of an interrupted run.")
+@click.option("--sample", default=20, show_default=True, help="Changed messages listed in the report.")
+def reclassify_command(workers: int, chunk_size: int, dry_run: bool, restart: bool, sample: int) -> None:
+    """Re-label stored bot replies from their inbound text with the current rules (resumable)."""
+    report = reclassify(workers=workers, chunk_size=chunk_size, dry_run=dry_run, restart=restart, sample=sample)
+    click.echo(json.dumps(report, ensure_ascii=False))
+
+@app.cli.command("db-maintenance")
+def db_maintenance_command() -> None:
+    """Checkpoint (TRUNCATE) the WAL and run PRAGMA optimize now (every shard)."""
+    runs = []
+    for shard in range(SHARDS):
+        conn = db(shard=shard)
+        try:
+            runs.append(MAINTENANCE.run_once(conn, optimize=True, truncate=True))
+        finally:
+            conn.close()
+    out = runs[0] if SHARDS == 1 else {"shards": runs}
+    click.echo(json.dumps(dict(out, profile=STORAGE_PROFILE), ensure_ascii=False))
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    create_app().run(debug=True, port=5000)
 
@@ -0,0 +1,300 @@
+"""Offline load test / benchmark for the OneInBox message pipeline.
+
+Drives /api/send, /api/webhook, /api/generate, /api/messages and /api/clear through the Flask
+test client (no network, no server) against a throwaway SQLite database that is
+first seeded with synthetic history drawn from the same user and phrase pools
+as /api/generate.
+
+Reports per endpoint: throughput, p50/p95/p99 latency, SQL statements and
+COMMITs per request; plus background writes (event sink, reply workers) and DB
+file growth. Output is JSON (sorted keys) so two runs can be diffed:
+
+    python bench.py --seed-messages 100000 --requests 5000 --out before.json
+    python bench.py --seed-messages 100000 --requests 5000 --out after.json --compare before.json
+
+Same --seed => same traffic. Use --seed-messages 2000000 for a "millions of
+stored messages" run (seeding goes through the bulk importer).
+"""
+import argparse, json, os, platform as pyplatform, random, shutil, sqlite3, sys, tempfile, threading, time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+ENDPOINTS = ["send", "webhook", "generate", "messages", "clear"]
+DEFAULT_MIX = "send=40,generate=30,messages=30,clear=0"
+
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"unknown endpoint in --mix: {name}")
+        mix[name] = int(weight or 0)
+    if not any(mix.values()):
+        raise SystemExit("--mix needs at least one positive weight")
+    return mix
+
+
+def percentile(sorted_ms: List[float], p: float) -> Optional[float]:
+    # nearest-rank percentile
+    if not sorted_ms:
+        return None
+    k = max(0, min(len(sorted_ms) - 1, int(round(p / 100.0 * len(sorted_ms) + 0.5)) - 1))
+    return round(sorted_ms[k], 3)
+
+
+def db_bytes(path: str) -> int:
+    return sum(os.path.getsize(path + sfx) for sfx in ("", "-wal", "-shm") if os.path.exists(path + sfx))
+
+
+class SqlCounter:
+    """sqlite3 trace callback: statements/COMMITs per request thread; anything
+    executed on threads outside a measured request counts as background."""
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.background = {"statements": 0, "commits": 0}
+
+    def trace(self, stmt: str) -> None:
+        if stmt.startswith("--"):
+            return  # statements inside triggers
+        is_commit = stmt.lstrip().upper().startswith("COMMIT")
+        c = getattr(self.local, "c", None)
+        if c is None:
+            with self.lock:
+                self.background["statements"] += 1
+                self.background["commits"] += int(is_commit)
+            return
+        c["statements"] += 1
+        c["commits"] += int(is_commit)
+
+    def begin(self) -> None:
+        self.local.c = {"statements": 0, "commits": 0}
+
+    def end(self) -> Dict[str, int]:
+        c, self.local.c = self.local.c, None
+        return c
+
+
+def synthetic_users(A: Any, n: int) -> List[str]:
+    base = list(A.GEN_USERS)
+    return base if n <= len(base) else [f"{base[i % len(base)]} {i // len(base)}" for i in range(n)]
+
+
+def seed_items(A: Any, rng: random.Random, users: List[str], n: int) -> Iterator[dict]:
+    for _ in range(n):
+        yield {"platform": rng.choice(A.PLATFORMS), "user": rng.choice(users), "message": rng.choice(A.GEN_SEEDS)}
+
+
+def build_requests(A: Any, rng: random.Random, users: List[str], mix: Dict[str, int], n: int) -> List[Tuple[str, dict]]:
+    names = [k for k, w in mix.items() if w > 0]
+    weights = [mix[k] for k in names]
+    plan = []
+    for _ in range(n):
+        name = rng.choices(names, weights)[0]
+        if name in ("send", "webhook"):
+            plan.append((name, {"platform": rng.choice(A.PLATFORMS), "user": rng.choice(users), "message": rng.choice(A.GEN_SEEDS)}))
+        elif name == "messages":
+            # UI-like polling: first load, delta polls, conditional re-polls
+            plan.append((name, {"kind": rng.choice(["latest", "delta", "conditional"])}))
+        else:
+            plan.append((name, {}))
+    return plan
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="oneinbox-bench-")
+    db_path = args.db or os.path.join(workdir, "bench.db")
+    os.environ["ONEINBOX_DB"] = db_path
+    os.environ["ONEINBOX_SHARDS"] = str(args.shards)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as A  # noqa: E402  (imported after ONEINBOX_DB / ONEINBOX_SHARDS are set)
+    A.ensure_schema()  # create / migrate the DB outside the measured phases
+
+    random.seed(args.seed)  # the app's own random choices (replies, /api/generate)
+    rng = random.Random(args.seed)
+    users = synthetic_users(A, args.users)
+
+    counter = SqlCounter()
+    orig_db: Callable[..., sqlite3.Connection] = A.db
+
+    def traced_db(*args: Any, **kwargs: Any) -> sqlite3.Connection:
+        conn = orig_db(*args, **kwargs)
+        conn.set_trace_callback(counter.trace)
+        return conn
+
+    A.db = traced_db
+
+    # 1) Seed history
+    t0 = time.perf_counter()
+    if args.seed_messages:
+        conn = A.db()
+        try:
+            report = A.ingest_batch(conn, seed_items(A, rng, users, args.seed_messages), chunk_size=20000, source="bench")
+        finally:
+            conn.close()
+        if report.rejected:
+            raise SystemExit(f"seeding rejected {report.rejected} items: {report.errors[:3]}")
+    A.EVENTS.flush()
+    seed_s = time.perf_counter() - t0
+
+    client = A.app.test_client()
+    state = {"cursor": 0, "etag": None}
+    state_lock = threading.Lock()
+
+    def call(name: str, payload: dict) -> int:
+        if name == "send":
+            return client.post("/api/send", json=payload).status_code
+        if name == "webhook":
+            return client.post("/api/webhook", json=payload).status_code
+        if name == "generate":
+            return client.get("/api/generate").status_code
+        if name == "clear":
+            return client.post("/api/clear").status_code
+        kind = payload["kind"]
+        if kind == "latest":
+            r = client.get("/api/messages")
+        elif kind == "delta":
+            r = client.get(f"/api/messages?since_seq={state['cursor']}")
+        else:
+            r = client.get("/api/messages", headers={"If-None-Match": state["etag"] or ""})
+        if r.status_code == 200:
+            body = r.get_json()
+            with state_lock:
+                state["cursor"] = max(state["cursor"], int(body.get("cursor") or 0))
+                state["etag"] = r.headers.get("ETag")
+        return 200 if r.status_code == 304 else r.status_code
+
+    # 2) Warm-up (caches, matcher, catalog index); not measured
+    for name, payload in build_requests(A, rng, users, {"send": 1, "generate": 1, "messages": 1}, args.warmup):
+        call(name, payload)
+    A.EVENTS.flush()
+    counter.background = {"statements": 0, "commits": 0}
+
+    # 3) Measured mix
+    plan = build_requests(A, rng, users, parse_mix(args.mix), args.requests)
+    results: Dict[str, List[Tuple[float, int, int, bool]]] = {k: [] for k in ENDPOINTS}
+    size_before = sum(db_bytes(A.shard_path(s)) for s in range(A.SHARDS))
+
+    def worker(items: List[Tuple[str, dict]]) -> None:
+        for name, payload in items:
+            counter.begin()
+            t = time.perf_counter()
+            status = call(name, payload)
+            ms = (time.perf_counter() - t) * 1000.0
+            c = counter.end()
+            results[name].append((ms, c["statements"], c["commits"], status >= 400))
+
+    t1 = time.perf_counter()
+    if args.threads <= 1:
+        worker(plan)
+    else:
+        threads = [threading.Thread(target=worker, args=(plan[i::args.threads],)) for i in range(args.threads)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+    elapsed = time.perf_counter() - t1
+    A.REPLY_QUEUE.drain(60.0)  # webhook replies are part of the run's writes
+    A.EVENTS.flush()
+    size_after = sum(db_bytes(A.shard_path(s)) for s in range(A.SHARDS))
+    stored = sum(int(orig_db(shard=s).execute("SELECT COUNT(*) FROM messages").fetchone()[0]) for s in range(A.SHARDS))
+
+    # 4) Reset cost on the full store (measured once)
+    clear_ms = None
+    if args.measure_clear:
+        t = time.perf_counter()
+        client.post("/api/clear")
+        clear_ms = round((time.perf_counter() - t) * 1000.0, 3)
+
+    endpoints = {}
+    for name, rows in results.items():
+        if not rows:
+            continue
+        lat = sorted(r[0] for r in rows)
+        endpoints[name] = {
+            "count": len(rows),
+            "errors": sum(1 for r in rows if r[3]),
+            "rps": round(len(rows) / elapsed, 1),
+            "mean_ms": round(sum(lat) / len(lat), 3),
+            "p50_ms": percentile(lat, 50),
+            "p95_ms": percentile(lat, 95),
+            "p99_ms": percentile(lat, 99),
+            "sql_per_req": round(sum(r[1] for r in rows) / len(rows), 2),
+            "commits_per_req": round(sum(r[2] for r in rows) / len(rows), 2),
+        }
+
+    A.db = orig_db
+    for pool in A.READ_POOLS:
+        pool.close()
+    A.EVENTS.close()
+    if not (args.db or args.keep):
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "meta": {
+            "seed": args.seed, "mix": args.mix, "requests": args.requests, "threads": args.threads, "shards": args.shards, "users": len(users),
+            "python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version, "machine": pyplatform.platform(),
+        },
+        "seed_phase": {
+            "messages": args.seed_messages, "elapsed_s": round(seed_s, 3),
+            "msgs_per_s": round(args.seed_messages / seed_s, 1) if seed_s > 0 and args.seed_messages else None,
+        },
+        "endpoints": endpoints,
+        "total": {"requests": len(plan), "elapsed_s": round(elapsed, 3), "rps": round(len(plan) / elapsed, 1) if elapsed > 0 else None},
+        "background": dict(counter.background),
+        "db": {
+            "path": db_path, "messages_stored": stored, "bytes_before": size_before, "bytes_after": size_after,
+            "growth_bytes": size_after - size_before,
+        },
+        "clear_ms": clear_ms,
+    }
+
+
+def compare(new: Dict[str, Any], old: Dict[str, Any]) -> str:
+    lines = [f"{'endpoint':<10} {'metric':<16} {'before':>12} {'after':>12} {'delta':>9}"]
+    for name, cur in sorted(new.get("endpoints", {}).items()):
+        prev = old.get("endpoints", {}).get(name)
+        if not prev:
+            continue
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms", "sql_per_req", "commits_per_req"):
+            a, b = prev.get(metric), cur.get(metric)
+            if a is None or b is None:
+                continue
+            delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            lines.append(f"{name:<10} {metric:<16} {a:>12} {b:>12} {delta:>9}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--seed", type=int, default=1234, help="RNG seed (traffic and bot replies)")
+    p.add_argument("--seed-messages", type=int, default=100000, help="synthetic history stored before measuring")
+    p.add_argument("--users", type=int, default=5000, help="distinct users (threads per platform) in the traffic")
+    p.add_argument("--requests", type=int, default=5000, help="measured requests")
+    p.add_argument("--warmup", type=int, default=200, help="unmeasured requests before the run")
+    p.add_argument("--mix", default=DEFAULT_MIX, help=f"endpoint weights (default: {DEFAULT_MIX})")
+    p.add_argument("--threads", type=int, default=1, help="concurrent client threads")
+    p.add_argument("--shards", type=int, default=1, help="ONEINBOX_SHARDS for the run's database")
+    p.add_argument("--no-clear", dest="measure_clear", action="store_false", help="skip timing /api/clear on the full store")
+    p.add_argument("--db", help="database path (default: a new temp file)")
+    p.add_argument("--keep", action="store_true", help="keep the temp database for inspection")
+    p.add_argument("--out", help="write the JSON report here (default: stdout)")
+    p.add_argument("--compare", help="previous JSON report to diff against (printed to stderr)")
+    args = p.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 PRAGMA foreign_keys = ON;
+PRAGMA auto_vacuum = INCREMENTAL;  -- before any table: lets retention return freed pages
 
 CREATE TABLE customers (
   id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -11,6 +12,9 @@ CREATE TABLE customers (
   updated_at      TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
 );
 
+CREATE INDEX ix_customers_display_name
+ON customers(display_name);
+
 CREATE TABLE customer_identities (
   id               INTEGER PRIMARY KEY AUTOINCREMENT,
   customer_id      INTEGER NOT NULL,
@@ -36,14 +40,28 @@ CREATE TABLE threads (
   status             TEXT NOT NULL DEFAULT 'open' CHECK(status IN ('open','closed','pending')),
   priority           TEXT NOT NULL DEFAULT 'normal' CHECK(priority IN ('low','normal','high','urgent')),
   tags               TEXT,
+  state_json         TEXT,
+  state_version      INTEGER NOT NULL DEFAULT 0,  -- bumped with every state_json write (cache check)
+  last_message_id    INTEGER,  -- latest message by created_at (kept by trg_messages_ai_thread_activity)
+  last_message_preview TEXT,
   last_activity_at   TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
   created_at         TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
   updated_at         TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
   FOREIGN KEY(customer_id) REFERENCES customers(id) ON DELETE SET NULL
 );
 
+CREATE UNIQUE INDEX ux_threads_platform_external
+ON threads(platform, external_thread_id);
+
+-- /api/threads keyset pagination (last_activity_at, id), optionally by platform or status
 CREATE INDEX ix_threads_platform_last_activity
-ON threads(platform, last_activity_at DESC);
+ON threads(platform, last_activity_at DESC, id DESC);
+
+CREATE INDEX ix_threads_last_activity
+ON threads(last_activity_at DESC, id DESC);
+
+CREATE INDEX ix_threads_status_last_activity
+ON threads(status, last_activity_at DESC, id DESC);
 
 CREATE INDEX ix_threads_customer_platform
 ON threads(customer_id, platform);
@@ -59,6 +77,8 @@ CREATE TABLE messages (
   confidence   REAL,
   is_auto      INTEGER NOT NULL DEFAULT 0,
   created_at   TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  external_message_id TEXT,   -- platform message id / idempotency key (inbound)
+  reply_to     INTEGER,       -- inbound message a bot reply answers
   FOREIGN KEY(thread_id) REFERENCES threads(id) ON DELETE CASCADE
 );
 
@@ -68,29 +88,35 @@ ON messages(thread_id, created_at);
 CREATE INDEX ix_messages_platform_time
 ON messages(platform, created_at);
 
--- Full-text search (FTS5)
+-- Webhook retries: one probe finds an already stored platform message
+CREATE UNIQUE INDEX ux_messages_platform_external
+ON messages(platform, external_message_id) WHERE external_message_id IS NOT NULL;
+
+-- Full-text search (FTS5), external content: the index reads bodies from messages
 CREATE VIRTUAL TABLE messages_fts USING fts5(
   content,
-  message_id UNINDEXED
+  content='messages',
+  content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2'
 );
 
 CREATE TRIGGER trg_messages_ai_fts
 AFTER INSERT ON messages
 BEGIN
-  INSERT INTO messages_fts(content, message_id) VALUES (new.content, new.id);
+  INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
 END;
 
 CREATE TRIGGER trg_messages_ad_fts
 AFTER DELETE ON messages
 BEGIN
-  DELETE FROM messages_fts WHERE message_id = old.id;
+  INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
 END;
 
 CREATE TRIGGER trg_messages_au_fts
 AFTER UPDATE OF content ON messages
 BEGIN
-  DELETE FROM messages_fts WHERE message_id = old.id;
-  INSERT INTO messages_fts(content, message_id) VALUES (new.content, new.id);
+  INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+  INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
 END;
 
 CREATE TRIGGER trg_messages_ai_thread_activity
@@ -98,8 +124,11 @@ AFTER INSERT ON messages
 BEGIN
   UPDATE threads
   SET last_activity_at = new.created_at,
+      last_message_id = new.id,
+      last_message_preview = substr(new.content, 1, 140),
       updated_at = (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
-  WHERE id = new.thread_id;
+  WHERE id = new.thread_id
+    AND (last_message_id IS NULL OR new.created_at >= last_activity_at);  -- backfilled history doesn't rewind
 END;
 
 CREATE TABLE automation_events (
@@ -120,6 +149,31 @@ ON automation_events(thread_id, created_at);
 CREATE INDEX ix_automation_events_type_time
 ON automation_events(event_type, created_at);
 
+-- Queued ingestion: one row per inbound message awaiting its bot reply (deleted once replied)
+CREATE TABLE reply_jobs (
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  thread_id    INTEGER NOT NULL,
+  message_id   INTEGER NOT NULL,
+  status       TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued','running','failed')),
+  attempts     INTEGER NOT NULL DEFAULT 0,
+  available_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  locked_by    TEXT,
+  locked_at    TEXT,
+  last_error   TEXT,
+  created_at   TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  FOREIGN KEY(thread_id) REFERENCES threads(id) ON DELETE CASCADE,
+  FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE
+);
+
+CREATE INDEX ix_reply_jobs_status_available
+ON reply_jobs(status, available_at);
+
+CREATE INDEX ix_reply_jobs_thread
+ON reply_jobs(thread_id, id);
+
+CREATE INDEX ix_reply_jobs_message
+ON reply_jobs(message_id);
+
 CREATE TABLE rules (
   id            INTEGER PRIMARY KEY AUTOINCREMENT,
   intent        TEXT NOT NULL,
@@ -133,6 +187,23 @@ CREATE TABLE rules (
 CREATE INDEX ix_rules_enabled_priority
 ON rules(enabled, priority);
 
+-- Write counters of cached tables: the app reloads rules / catalog when these move
+CREATE TABLE table_versions (
+  name    TEXT PRIMARY KEY,
+  version INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO table_versions(name) VALUES ('rules');
+
+CREATE TRIGGER trg_rules_ai_version AFTER INSERT ON rules
+BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'rules'; END;
+
+CREATE TRIGGER trg_rules_au_version AFTER UPDATE ON rules
+BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'rules'; END;
+
+CREATE TRIGGER trg_rules_ad_version AFTER DELETE ON rules
+BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'rules'; END;
+
 CREATE TABLE response_templates (
   id                  INTEGER PRIMARY KEY AUTOINCREMENT,
   intent              TEXT NOT NULL,
@@ -156,6 +227,7 @@ CREATE TABLE metrics_daily (
   bot_messages       INTEGER NOT NULL DEFAULT 0,
   intent_counts_json TEXT,
   avg_response_ms    REAL,
+  response_count     INTEGER NOT NULL DEFAULT 0,  -- samples behind avg_response_ms
   created_at         TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
   updated_at         TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
   PRIMARY KEY(day, platform)
@@ -164,6 +236,31 @@ CREATE TABLE metrics_daily (
 CREATE INDEX ix_metrics_daily_platform_day
 ON metrics_daily(platform, day);
 
+-- Per-day automation_events counts, folded incrementally by the rollup job
+CREATE TABLE event_metrics_daily (
+  day        TEXT NOT NULL,
+  platform   TEXT NOT NULL,
+  event_type TEXT NOT NULL,
+  status     TEXT NOT NULL,
+  n          INTEGER NOT NULL DEFAULT 0,
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+  PRIMARY KEY(day, platform, event_type, status)
+);
+
+-- High-water marks of incremental jobs (rollups, metrics backfill, reclassification)
+CREATE TABLE checkpoints (
+  name       TEXT PRIMARY KEY,
+  last_id    INTEGER NOT NULL DEFAULT 0,
+  until_id   INTEGER,                                  -- bounded jobs stop here
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+);
+
+-- Storage layout facts checked at every start (e.g. shards = ONEINBOX_SHARDS at creation)
+CREATE TABLE storage_meta (
+  key   TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+
 CREATE VIEW v_thread_latest_message AS
 SELECT
   t.id AS thread_id,
@@ -178,9 +275,4 @@ SELECT
   m.created_at AS message_created_at
 FROM threads t
 LEFT JOIN messages m
-  ON m.id = (
-    SELECT id FROM messages
-    WHERE thread_id = t.id
-    ORDER BY created_at DESC
-    LIMIT 1
-  );
+  ON m.id = t.last_message_id;
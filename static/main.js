@@ -4,48 +4,140 @@
 
 // Variables globales
 let autoGenerateInterval = null;
+let lastSeq = 0;        // cursor: último messages.id recibido
+let lastEtag = null;    // ETag de /api/messages para respuestas 304
+let stream = null;      // EventSource de /api/stream
+const stats = { total: 0, whatsapp: 0, instagram: 0, facebook: 0 };
+const MAX_VISIBLE = 50; // mensajes mantenidos en el DOM
+const seenSeqs = new Set(); // ids recientes ya mostrados (el stream puede llegar algo desordenado)
+const SEEN_MAX = 500;
+
+const PLATFORM_LABELS = { whatsapp: "WhatsApp", instagram: "Instagram", facebook: "Facebook" };
+const PLATFORM_ICONS = { whatsapp: "💬", instagram: "📸", facebook: "📘" };
+
+// Adapta el formato de la API al que usa createMessageElement
+function toView(m) {
+    const ts = Date.parse(m.timestamp || "");
+    return {
+        type: m.role === "system" ? "bot" : "user",
+        platform: PLATFORM_LABELS[m.platform] || m.platform,
+        customer: m.user,
+        time: Number.isFinite(ts) ? new Date(ts).toLocaleTimeString("es", { hour: "2-digit", minute: "2-digit" }) : "--:--",
+        content: m.text,
+        icon: m.role === "system" ? "🤖" : (PLATFORM_ICONS[m.platform] || "💬")
+    };
+}
 
 // ============================================
-// CARGAR MENSAJES
+// CARGAR MENSAJES (solo los nuevos desde lastSeq)
 // ============================================
 async function loadMessages() {
     try {
-        const res = await fetch("/api/messages");
-        const messages = await res.json();
-        
-        const box = document.getElementById("messages");
-        
-        if (messages.length === 0) {
+        const url = lastSeq ? `/api/messages?since_seq=${lastSeq}` : `/api/messages?limit=${MAX_VISIBLE}`;
+        const headers = lastEtag ? { "If-None-Match": lastEtag } : {};
+        const res = await fetch(url, { cache: "no-store", headers });
+
+        // 304: nada nuevo desde la última consulta
+        if (res.status === 304) return;
+
+        lastEtag = res.headers.get("ETag");
+        const data = await res.json();
+        const messages = data.messages || [];
+        if (Number.isFinite(data.cursor)) lastSeq = Math.max(lastSeq, data.cursor);
+
+        appendMessages(messages.filter((m) => firstSeen(m.seq)));
+
+        // Quedan más mensajes nuevos: seguir paginando
+        if (data.has_more) await loadMessages();
+
+    } catch (error) {
+        console.error('Error cargando mensajes:', error);
+    }
+}
+
+// true la primera vez que se ve un seq; recuerda solo los SEEN_MAX más recientes
+function firstSeen(seq) {
+    if (seenSeqs.has(seq)) return false;
+    seenSeqs.add(seq);
+    if (seenSeqs.size > SEEN_MAX) seenSeqs.delete(seenSeqs.values().next().value);
+    return true;
+}
+
+// ============================================
+// AGREGAR MENSAJES AL DOM (sin reconstruir la lista)
+// ============================================
+function appendMessages(messages) {
+    const box = document.getElementById("messages");
+
+    if (messages.length === 0) {
+        if (box.children.length === 0) {
             box.innerHTML = `
-                <div class="text-center py-16 opacity-60">
+                <div class="text-center py-16 opacity-60" data-empty="1">
                     <div class="text-6xl mb-4">📭</div>
                     <p class="text-xl font-bold">No hay mensajes aún</p>
                     <p class="text-sm mt-2">Usa el simulador o espera la generación automática</p>
                 </div>
             `;
-            return;
         }
+        return;
+    }
 
-        // Limpiar y renderizar mensajes
-        box.innerHTML = "";
-        
-        // Mostrar solo los últimos 50 mensajes para performance
-        const recentMessages = messages.slice(-50);
-        
-        recentMessages.forEach((m, index) => {
-            const messageDiv = createMessageElement(m, index);
-            box.appendChild(messageDiv);
-        });
+    const placeholder = box.querySelector("[data-empty]");
+    if (placeholder) placeholder.remove();
 
-        // Scroll al final
-        box.scrollTop = box.scrollHeight;
-        
-        // Actualizar estadísticas
-        loadStats();
-        
-    } catch (error) {
-        console.error('Error cargando mensajes:', error);
+    // Agregar solo los mensajes nuevos
+    messages.forEach((m, index) => {
+        const messageDiv = createMessageElement(toView(m), index);
+        box.appendChild(messageDiv);
+    });
+
+    // Mantener solo los últimos MAX_VISIBLE mensajes para performance
+    while (box.children.length > MAX_VISIBLE) {
+        box.removeChild(box.firstElementChild);
     }
+
+    // Scroll al final
+    box.scrollTop = box.scrollHeight;
+}
+
+// ============================================
+// STREAM EN VIVO (Server-Sent Events)
+// ============================================
+function connectStream() {
+    if (stream) stream.close();
+
+    // Reanuda desde el último seq conocido; luego el navegador usa Last-Event-ID
+    stream = new EventSource(`/api/stream?since_seq=${lastSeq}`);
+
+    stream.addEventListener("message", (e) => {
+        const m = JSON.parse(e.data);
+        if (!firstSeen(m.seq)) return;
+        lastSeq = Math.max(lastSeq, m.seq); // solo cursor para reanudar, no filtro
+        appendMessages([m]);
+    });
+
+    stream.addEventListener("stats", (e) => {
+        const delta = JSON.parse(e.data);
+        for (const key of Object.keys(stats)) {
+            if (delta[key]) stats[key] += delta[key];
+        }
+        renderStats();
+    });
+
+    stream.addEventListener("clear", () => {
+        document.getElementById("messages").innerHTML = "";
+        seenSeqs.clear();
+        appendMessages([]);
+        loadStats();
+    });
+
+    // El servidor descartó eventos (cliente lento): recuperar por HTTP y reconectar
+    stream.addEventListener("resync", async () => {
+        stream.close();
+        await loadMessages();
+        await loadStats();
+        connectStream();
+    });
 }
 
 // ============================================
@@ -120,19 +212,22 @@ function createMessageElement(m, index) {
 async function loadStats() {
     try {
         const res = await fetch("/api/stats");
-        const stats = await res.json();
-        
-        // Animar números
-        animateNumber("stat-total", stats.total);
-        animateNumber("stat-whatsapp", stats.whatsapp);
-        animateNumber("stat-instagram", stats.instagram);
-        animateNumber("stat-facebook", stats.facebook);
+        Object.assign(stats, await res.json());
+        renderStats();
         
     } catch (error) {
         console.error('Error cargando estadísticas:', error);
     }
 }
 
+function renderStats() {
+    // Animar números
+    animateNumber("stat-total", stats.total);
+    animateNumber("stat-whatsapp", stats.whatsapp);
+    animateNumber("stat-instagram", stats.instagram);
+    animateNumber("stat-facebook", stats.facebook);
+}
+
 // ============================================
 // ANIMAR NÚMEROS
 // ============================================
@@ -168,8 +263,8 @@ function animateNumber(elementId, targetValue) {
 // ============================================
 async function generateMessage() {
     try {
+        // El mensaje generado llega por /api/stream
         await fetch("/api/generate");
-        await loadMessages();
     } catch (error) {
         console.error('Error generando mensaje:', error);
     }
@@ -215,8 +310,6 @@ async function sendManualMessage() {
                 button.classList.remove("bg-green-500");
             }, 1500);
             
-            // Recargar mensajes
-            await loadMessages();
         }
         
     } catch (error) {
@@ -235,6 +328,8 @@ async function clearMessages() {
     
     try {
         await fetch("/api/clear", { method: "POST" });
+        document.getElementById("messages").innerHTML = "";
+        lastEtag = null;
         await loadMessages();
         
         // Feedback
@@ -267,16 +362,14 @@ document.addEventListener('DOMContentLoaded', function() {
 // INICIALIZACIÓN
 // ============================================
 
-// Cargar mensajes al inicio
-loadMessages();
+// Cargar mensajes y estadísticas al inicio, luego escuchar el stream
+loadMessages().then(connectStream);
+loadStats();
 
 // Auto-generar cada 5 segundos
 autoGenerateInterval = setInterval(generateMessage, 5000);
 
-// Actualizar estadísticas cada 2 segundos
-setInterval(loadStats, 2000);
-
 // Log de inicio
 console.log("🚀 OneInBox iniciado correctamente");
 console.log("⚡ Generación automática: Cada 5 segundos");
-console.log("📊 Actualización de stats: Cada 2 segundos");
+console.log("📡 Mensajes y stats en vivo vía /api/stream");
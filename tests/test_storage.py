@@ -0,0 +1,30 @@
+"""Storage setup checks. app.py reads its configuration at import, so each
+check runs in a fresh interpreter against a temporary database."""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_app(tmp_path, code, **env):
+    env = dict(os.environ, ONEINBOX_DB=str(tmp_path / "oneinbox.db"), PYTHONPATH=ROOT, **env)
+    return subprocess.run([sys.executable, "-c", "import app\n" + code], env=env, capture_output=True, text=True, cwd=ROOT)
+
+
+def test_new_store_has_incremental_auto_vacuum(tmp_path):
+    out = run_app(tmp_path, "conn = app.db()\nprint(conn.execute('PRAGMA auto_vacuum').fetchone()[0], conn.execute('PRAGMA journal_mode').fetchone()[0])")
+    assert out.returncode == 0, out.stderr
+    auto_vacuum, journal_mode = out.stdout.split()
+    assert int(auto_vacuum) == 2
+    assert journal_mode.lower() == "wal"
+
+
+def test_restart_with_other_shard_count_refuses_to_start(tmp_path):
+    send = "c = app.app.test_client()\nfor i in range(5):\n    assert c.post('/api/send', json={'user': f'u{i}', 'text': 'hola'}).status_code == 200"
+    out = run_app(tmp_path, send, ONEINBOX_SHARDS="3")
+    assert out.returncode == 0, out.stderr
+    for shards in ("2", "1", "4"):
+        out = run_app(tmp_path, send, ONEINBOX_SHARDS=shards)
+        assert out.returncode != 0
+        assert "ONEINBOX_SHARDS=3" in out.stderr